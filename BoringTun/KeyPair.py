@@ -1,10 +1,13 @@
-__all__ = ("Key", "PublicKey", "SecretKey", "KeyPair", "x25519_key_to_base64", "x25519_key_to_hex", "check_base64_encoded_x25519_key")
+__all__ = ("Key", "PublicKey", "SecretKey", "KeyPair", "x25519_key_to_base64", "x25519_key_to_hex", "check_base64_encoded_x25519_key", "measureCodecs", "nativeCodecs")
 
+import os
 import typing
 from base64 import b64decode, b64encode
-from binascii import hexlify
+from binascii import Error as BinasciiError, hexlify
+from concurrent.futures import Executor
+from time import perf_counter_ns
 
-from .ctypes import X25519PublicKey, X25519SecretKey
+from .ctypes import X25519PublicKey, X25519SecretKey, getLib
 from .ctypes import check_base64_encoded_x25519_key as ct_check_base64_encoded_x25519_key
 from .ctypes import toPythonString, x25519_key, x25519_key_to_base64 as ct_x25519_key_to_base64, x25519_key_to_hex as ct_x25519_key_to_hex, x25519_key_to_str_free, x25519_public_key, x25519_secret_key
 
@@ -26,11 +29,57 @@ def x25519_key_to_hex(key: x25519_key) -> str:
 
 
 def check_base64_encoded_x25519_key(key: str) -> bool:
-	return bool(ct_check_base64_encoded_x25519_key(key.encode("ascii")))
+	if Key.USE_NATIVE_IMPLS:
+		return bool(ct_check_base64_encoded_x25519_key(key.encode("ascii")))
+
+	# in Python, so parsing configs and keys doesn't require the lib to be loaded
+	try:
+		return len(b64decode(key, validate=True)) == 32
+	except (BinasciiError, ValueError):
+		return False
+
+
+CODEC_OPERATIONS = ("base64", "hex")
+KEY_SIZE = 32
+BASE64_KEY_SIZE = 44
+
+_nativeCodecs = None
+
+
+def measureCodecs(rounds: int = 100) -> typing.Dict[str, bool]:
+	"""Times the native and the Python implementations of each of `CODEC_OPERATIONS` of `Key` on a sample key, loading the lib. Returns whether the native one is faster, per operation, and makes `nativeCodecs` return it. If the lib cannot be loaded, the Python ones are chosen."""
+	global _nativeCodecs  # pylint:disable=global-statement
+
+	try:
+		getLib()
+	except OSError:
+		_nativeCodecs = dict.fromkeys(CODEC_OPERATIONS, False)
+		return _nativeCodecs
+
+	k = Key.fromKeyBytes(bytes(range(KEY_SIZE)))
+	res = {}
+	for op in CODEC_OPERATIONS:
+		times = []
+		for impl in (getattr(k, "_" + op + "Native"), getattr(k, "_" + op + "Python")):
+			impl()  # warming up, i.e. binding the native function
+			start = perf_counter_ns()
+			for i in range(rounds):
+				impl()
+			times.append(perf_counter_ns() - start)
+		res[op] = times[0] < times[1]
+	_nativeCodecs = res
+	return res
+
+
+def nativeCodecs() -> typing.Dict[str, bool]:
+	"""The result of the last `measureCodecs` call. Until it is called, the Python implementations, so encoding keys never loads the lib by itself."""
+	if _nativeCodecs is None:
+		return dict.fromkeys(CODEC_OPERATIONS, False)
+	return _nativeCodecs
 
 
 class Key:
-	__slots__ = ("data",)
+	__slots__ = ("data", "_base64Ascii")
 
 	KEY_TYPE = x25519_key
 
@@ -42,8 +91,9 @@ class Key:
 				raise ValueError("Data must be of type " + self.__class__.KEY_TYPE.__name__, data)
 
 		self.data = data
+		self._base64Ascii = None
 
-	USE_NATIVE_IMPLS = False
+	USE_NATIVE_IMPLS = None  # `None` means the one chosen by `nativeCodecs`: the Python ones unless `measureCodecs` was called
 
 	def _base64Native(self) -> str:
 		return x25519_key_to_base64(self.data)
@@ -58,13 +108,55 @@ class Key:
 		return hexlify(bytes(self)).decode("ascii")
 
 	def base64(self) -> str:
-		if self.__class__.USE_NATIVE_IMPLS:
+		useNative = self.__class__.USE_NATIVE_IMPLS
+		if useNative is None:
+			useNative = nativeCodecs()["base64"]
+
+		if useNative:
 			return self._base64Native()
 
 		return self._base64Python()
 
+	@staticmethod
+	def base64_many(keys: typing.Iterable["Key"], cache: bool = False) -> bytearray:
+		"""Encodes all the `keys` into one buffer by a single `b64encode`, the encoding of the i-th key is at `[44 * i : 44 * (i + 1)]`. If `cache` is set, the encodings are also memoised for `base64Ascii`.
+		Each key is followed by a zero byte, so it takes 33 bytes, a multiple of 3, and its encoding doesn't share chars with the neighbours; the char encoding the zero byte is replaced with the padding."""
+		keys = list(keys)
+		if not keys:
+			return bytearray()
+
+		res = bytearray(b64encode(b"\0".join(bytes(k) for k in keys) + b"\0"))
+		res[BASE64_KEY_SIZE - 1 :: BASE64_KEY_SIZE] = b"=" * len(keys)
+
+		if cache:
+			for i, k in enumerate(keys):
+				k._base64Ascii = bytes(res[i * BASE64_KEY_SIZE : (i + 1) * BASE64_KEY_SIZE])  # pylint:disable=protected-access
+		return res
+
+	@staticmethod
+	def decode_base64_many(encoded: typing.Sequence[str]) -> bytearray:
+		"""Validates and decodes many base64-encoded keys by a single `b64decode`, the inverse of `base64_many`: the padding of each key is replaced with a zero char, so each key decodes into 33 bytes not sharing bits with the neighbours, and the extra bytes are removed. The key `i` is at `[32 * i : 32 * (i + 1)]`. Raises `ValueError` if any of the keys is invalid."""
+		joined = "".join(el[: BASE64_KEY_SIZE - 1] + "A" if len(el) == BASE64_KEY_SIZE and el[-1] == "=" else "!" for el in encoded)
+		res = bytearray(b64decode(joined, validate=True))
+		del res[KEY_SIZE :: KEY_SIZE + 1]
+		if len(res) != KEY_SIZE * len(encoded):
+			# older Pythons stop decoding at a padding in the middle
+			raise ValueError("Invalid base64-encoded key")
+		return res
+
+	def base64Ascii(self) -> bytes:
+		"""`base64()` as ASCII bytes, the form `new_tunnel` wants. It is computed once per key, since the same keys (i.e. the interface one) are used by many tunnels. The cache is invalidated by `__setitem__`, but not by modifying `data` directly."""
+		res = self._base64Ascii
+		if res is None:
+			res = self._base64Ascii = self.base64().encode("ascii")
+		return res
+
 	def hex(self) -> str:
-		if self.__class__.USE_NATIVE_IMPLS:
+		useNative = self.__class__.USE_NATIVE_IMPLS
+		if useNative is None:
+			useNative = nativeCodecs()["hex"]
+
+		if useNative:
 			return self._hexNative()
 
 		return self._hexPython()
@@ -74,6 +166,7 @@ class Key:
 
 	def __setitem__(self, k, v):
 		self.data[k] = v
+		self._base64Ascii = None
 
 	@classmethod
 	def fromKeyBytes(cls, key: bytes) -> x25519_key:
@@ -108,13 +201,41 @@ class SecretKey(Key):
 	def generate(cls) -> "SecretKey":
 		return cls(x25519_secret_key())
 
+	@classmethod
+	def generate_many(cls, count: int) -> typing.List["SecretKey"]:
+		"""Generates `count` keys from a single `os.urandom` call instead of a call into the lib per key. The keys are clamped, as by `wg genkey`."""
+		randomness = bytearray(os.urandom(KEY_SIZE * count))
+		randomness[0::KEY_SIZE] = bytes(b & 248 for b in randomness[0::KEY_SIZE])
+		randomness[KEY_SIZE - 1 :: KEY_SIZE] = bytes(b & 127 | 64 for b in randomness[KEY_SIZE - 1 :: KEY_SIZE])
+		keyType = cls.KEY_TYPE
+		return [cls(keyType.from_buffer_copy(randomness, i)) for i in range(0, len(randomness), KEY_SIZE)]
+
 	def getPublic(self) -> PublicKey:
 		return PublicKey(x25519_public_key(self.data))
 
+	@staticmethod
+	def public_many(secrets: typing.Sequence["SecretKey"], executor: typing.Optional[Executor] = None) -> typing.List[PublicKey]:
+		"""Computes the public keys of `secrets`. The calls into the lib release the GIL, so the keys are computed in chunks in parallel on `executor` (by default the pool of `offload`)."""
+		from .offload import getDefaultExecutor
+
+		if executor is None:
+			executor = getDefaultExecutor()
+
+		chunkSize = max(1, -(-len(secrets) // (os.cpu_count() or 1)))
+		chunks = [secrets[i : i + chunkSize] for i in range(0, len(secrets), chunkSize)]
+		res = []
+		for f in [executor.submit(_publicKeys, chunk) for chunk in chunks]:
+			res.extend(f.result())
+		return res
+
 	def __repr__(self):
 		return self.__class__.__name__ + "<!!!SECRET_DATA!!!>"
 
 
+def _publicKeys(secrets: typing.Sequence[SecretKey]) -> typing.List[PublicKey]:
+	return [PublicKey(x25519_public_key(sec.data)) for sec in secrets]
+
+
 class KeyPair:
 	__slots__ = ("sec", "pub")
 
@@ -130,5 +251,11 @@ class KeyPair:
 		self.sec = sec
 		self.pub = pub
 
+	@classmethod
+	def generate_many(cls, count: int, executor: typing.Optional[Executor] = None) -> typing.List["KeyPair"]:
+		"""Generates `count` key pairs with `SecretKey.generate_many` and `SecretKey.public_many`."""
+		secrets = SecretKey.generate_many(count)
+		return [cls(sec=sec, pub=pub) for sec, pub in zip(secrets, SecretKey.public_many(secrets, executor))]
+
 	def __repr__(self):
 		return self.__class__.__name__ + "(" + "sec=" + repr(self.sec) + ", pub=" + repr(self.pub) + ")"
@@ -1,14 +1,38 @@
-__all__ = ("Tunnel", "Opcode", "Action")
+__all__ = ("Tunnel", "OpenedTunnels", "Opcode", "Action", "BatchResult", "BACKEND_NAME")
 
+import time
 import typing
+from concurrent.futures import Executor
 
-from .config import Interface, Peer, WGConfig
+from .config import KEY_SIZE, NO_KEEPALIVE, Interface, Peer, PeerTable, WGConfig
 from .ctypes import stats
-from .KeyPair import Key
-from .tunnelMiddleLevel import MAX_WIREGUARD_PACKET_SIZE, Action, Opcode, TunnPtr, new_tunnel, tunnel_free, wireguard_force_handshake, wireguard_read, wireguard_stats, wireguard_tick, wireguard_write
+from .bufferPool import BufferPool
+from .KeyPair import BASE64_KEY_SIZE, Key
+from .messageHeaders import MIN_MESSAGE_SIZES, MessageType
+from .backend import BACKEND_NAME, new_tunnel, tunnel_free, wireguard_force_handshake_into, wireguard_read_into, wireguard_read_many, wireguard_stats, wireguard_tick_into, wireguard_write_into, wireguard_write_many
+from .offload import ResultsCallback, TunnelOffloader, getDefaultExecutor
+from .tunnelMiddleLevel import MAX_WIREGUARD_PACKET_SIZE, Action, BatchResult, Opcode, TunnPtr, pooledAction
 
 # pylint:disable=too-many-arguments
 
+DATA_MESSAGE_OVERHEAD = MIN_MESSAGE_SIZES[MessageType.DATA]  # the header and the tag
+HANDSHAKE_INITIATION_SIZE = MIN_MESSAGE_SIZES[MessageType.HANDSHAKE_INITIATION]
+
+
+def minWrapDstSize(src) -> int:
+	"""BoringTun aborts the process (a panic across FFI) if `dst` is shorter than the result. Wrapping produces either a data message or a handshake initiation, if there is no session yet."""
+	return max(len(src) + DATA_MESSAGE_OVERHEAD, HANDSHAKE_INITIATION_SIZE)
+
+
+def minUnwrapDstSize(src) -> int:
+	"""A result of unwrapping is never longer than the message (the plaintext of a data message is shorter than its ciphertext). An empty `src` flushes a queued packet, which may be of any size."""
+	return len(src) if len(src) else MAX_WIREGUARD_PACKET_SIZE
+
+
+def _checkDstSize(dst, minSize: int) -> None:
+	if len(dst) < minSize:
+		raise ValueError("The destination buffer is too small", len(dst), minSize)
+
 
 class Base64TunnelDataCache:
 	"""BoringTun interface is poorly designed, so the lib requires for some API keys in the form of base64 strings.
@@ -23,12 +47,22 @@ class Base64TunnelDataCache:
 		self.psk = peer.psk
 		self._preprocessKeys()
 
+	@classmethod
+	def fromEncoded(cls, sec, pub: bytes, psk) -> "Base64TunnelDataCache":
+		"""`pub` is already encoded, i.e. by `Key.base64_many`."""
+		self = cls.__new__(cls)
+		self.sec = sec
+		self.pub = pub
+		self.psk = psk
+		self._preprocessKeys()
+		return self
+
 	def _preprocessKeys(self):
 		for k in __class__.__slots__:
 			el = getattr(self, k)
 
 			if isinstance(el, Key):
-				el = el.base64()
+				el = el.base64Ascii()
 
 			if isinstance(el, str):
 				el = el.encode("ascii")
@@ -39,7 +73,7 @@ class Base64TunnelDataCache:
 class Tunnel:
 	__slots__ = ("idx", "interface", "peer", "b64c", "openTunnel")
 
-	def __init__(self, interface: Interface, peer: Peer, idx: int = 0) -> None:
+	def __init__(self, interface: Interface, peer: Peer, idx: int = 0, b64c: typing.Optional[Base64TunnelDataCache] = None) -> None:
 
 		if not isinstance(interface, Interface):
 			interface = Interface(interface)
@@ -47,7 +81,7 @@ class Tunnel:
 		self.interface = interface
 		self.peer = peer
 
-		self.b64c = Base64TunnelDataCache(interface, peer)
+		self.b64c = b64c if b64c is not None else Base64TunnelDataCache(interface, peer)
 
 		self.idx = idx
 		self.openTunnel = None
@@ -55,9 +89,50 @@ class Tunnel:
 	@classmethod
 	def fromConfig(cls, cfg: WGConfig, idx: int = 0) -> "Tunnel":
 		if len(cfg.peers) > 1:
-			raise ValueError("Config contains more than 1 peer. Each tunnel is exactly between an interface and one peer. If you need to connect multiple peers, you need multiple tunnels.", cfg.peers)
+			raise ValueError("Config contains more than 1 peer. Each tunnel is exactly between an interface and one peer. If you need to connect multiple peers, you need multiple tunnels, `endpoint.WireGuardEndpoint` serves them through a single socket.", cfg.peers)
 		return cls(cfg.interface, cfg.peers[0], idx=idx)
 
+	@classmethod
+	def open_many(cls, cfg: WGConfig, startIdx: int = 0, executor: typing.Optional[Executor] = None) -> "OpenedTunnels":
+		"""Creates and opens a tunnel for each peer of the config, with the indexes starting from `startIdx`. `new_tunnel` releases the GIL, so the tunnels are created in parallel on `executor` (by default the pool of `offload`).
+		If any of the tunnels fails to open, the ones already opened are closed."""
+		if executor is None:
+			executor = getDefaultExecutor()
+
+		start = time.perf_counter()
+		if isinstance(cfg.peers, PeerTable):
+			tunnels = cls._fromTable(cfg.interface, cfg.peers, startIdx)
+		else:
+			peers = list(cfg.peers)
+			Key.base64_many([k for peer in peers for k in (peer.pub, peer.psk) if isinstance(k, Key)], cache=True)
+			tunnels = [cls(cfg.interface, peer, idx=startIdx + i) for i, peer in enumerate(peers)]
+		encoded = time.perf_counter()
+
+		futures = [executor.submit(t.__enter__) for t in tunnels]
+		error = None
+		for f in futures:
+			try:
+				f.result()
+			except Exception as ex:  # pylint:disable=broad-except
+				error = ex
+		opened = time.perf_counter()
+
+		if error is not None:
+			for t in tunnels:
+				if t.openTunnel is not None:
+					t.__exit__(None, None, None)
+			raise error
+
+		return OpenedTunnels(tunnels, encoded - start, opened - encoded)
+
+	@classmethod
+	def _fromTable(cls, interface: Interface, table: PeerTable, startIdx: int) -> typing.List["Tunnel"]:
+		"""The public keys are encoded right from the buffer of the table and the peers are `PeerView`s, so no `Peer`s are built."""
+		keys = memoryview(table.keys)
+		pubs = Key.base64_many(keys[i * KEY_SIZE : (i + 1) * KEY_SIZE] for i in range(len(table)))
+		psks = table.psks
+		return [cls(interface, table.view(i), idx=startIdx + i, b64c=Base64TunnelDataCache.fromEncoded(interface.sec, bytes(pubs[i * BASE64_KEY_SIZE : (i + 1) * BASE64_KEY_SIZE]), psks.get(i))) for i in range(len(table))]
+
 	def __enter__(self) -> "OpenTunnel":
 		self.openTunnel = OpenTunnel(b64c=self.b64c, keepAlive=self.peer.keepAliveTimeout, idx=self.idx)
 		return self.openTunnel
@@ -67,25 +142,96 @@ class Tunnel:
 		self.openTunnel = None
 
 
+class OpenedTunnels:
+	"""The result of `Tunnel.open_many`: the open `tunnels` (in the order of the peers) and the time spent on preparing the keys and on opening the tunnels, in seconds."""
+
+	__slots__ = ("tunnels", "encodingTime", "openingTime")
+
+	def __init__(self, tunnels: typing.List[Tunnel], encodingTime: float, openingTime: float) -> None:
+		self.tunnels = tunnels
+		self.encodingTime = encodingTime
+		self.openingTime = openingTime
+
+	def __len__(self) -> int:
+		return len(self.tunnels)
+
+	def __getitem__(self, i: int) -> Tunnel:
+		return self.tunnels[i]
+
+	def __iter__(self) -> typing.Iterator[Tunnel]:
+		return iter(self.tunnels)
+
+	def close(self) -> None:
+		for t in self.tunnels:
+			if t.openTunnel is not None:
+				t.__exit__(None, None, None)
+
+	def __repr__(self):
+		return self.__class__.__name__ + "<" + repr(len(self)) + " tunnels, encoding: " + format(self.encodingTime, ".6f") + " s, opening: " + format(self.openingTime, ".6f") + " s>"
+
+
+DEFAULT_POOL_SIZE = 4
+
+
 class OpenTunnel:
-	__slots__ = ("ptr",)
+	"""`pool` holds the scratch buffers for `wrap`, `unwrap`, `tick` and `force_handshake`. It can be shared between tunnels.
+	If `pooledActions` is set, the returned `Action`s carry `memoryview`s into the pooled buffers instead of `bytes` and must be released."""
+
+	__slots__ = ("ptr", "pool", "pooledActions", "metrics", "capture", "__weakref__")
 
-	def __init__(self, b64c: Base64TunnelDataCache, keepAlive, idx: int = 0) -> None:
-		self.ptr = new_tunnel(static_private=b64c.sec, server_static_public=b64c.pub, preshared_key=b64c.psk, keep_alive=keepAlive, index=idx)  # type=TunnPtr
+	def __init__(self, b64c: Base64TunnelDataCache, keepAlive, idx: int = 0, pool: typing.Optional[BufferPool] = None, pooledActions: bool = False) -> None:
+		self.ptr = new_tunnel(static_private=b64c.sec, server_static_public=b64c.pub, preshared_key=b64c.psk, keep_alive=NO_KEEPALIVE if keepAlive is None else keepAlive, index=idx)  # type=TunnPtr
 		if self.ptr is None:
 			raise Exception("Failed to create the tunnel. Make sure that all the keys are Base64 strings and that the pre-shared key is also generated if you use it!")
 
+		if pool is None:
+			pool = BufferPool(MAX_WIREGUARD_PACKET_SIZE, DEFAULT_POOL_SIZE)
+
+		self.pool = pool
+		self.pooledActions = pooledActions
+		self.metrics = None  # see `metrics.enableMetrics`
+		self.capture = None  # see `capture.startCapture`
+
 	def wrap(self, src: bytes) -> Action:
-		return wireguard_write(self.ptr, src, MAX_WIREGUARD_PACKET_SIZE)
+		return pooledAction(self.pool, wireguard_write_into, self.ptr, src, view=self.pooledActions)
 
 	def unwrap(self, src: bytes) -> Action:
-		return wireguard_read(self.ptr, src, MAX_WIREGUARD_PACKET_SIZE)
+		return pooledAction(self.pool, wireguard_read_into, self.ptr, src, view=self.pooledActions)
+
+	def wrap_into(self, src: bytes, dst: bytearray) -> typing.Tuple[Opcode, int]:
+		"""Like `wrap`, but writes the result into a caller-supplied writable buffer instead of allocating a new one. `dst` must be at least `len(src) + 32` bytes and not shorter than a handshake initiation (148 bytes), see `minWrapDstSize`, otherwise `ValueError` is raised.
+		Returns the opcode and the count of bytes written into `dst` (or the error code for `Opcode.WIREGUARD_ERROR`)."""
+		_checkDstSize(dst, minWrapDstSize(src))
+		return wireguard_write_into(self.ptr, src, dst)
+
+	def unwrap_into(self, src: bytes, dst: bytearray) -> typing.Tuple[Opcode, int]:
+		"""Like `unwrap`, but writes the result into a caller-supplied writable buffer instead of allocating a new one. `dst` must be at least `len(src)` bytes, or `MAX_WIREGUARD_PACKET_SIZE` for an empty `src`, see `minUnwrapDstSize`, otherwise `ValueError` is raised."""
+		_checkDstSize(dst, minUnwrapDstSize(src))
+		return wireguard_read_into(self.ptr, src, dst)
+
+	def wrap_many(self, packets: typing.Union[typing.Sequence[bytes], bytes, bytearray, memoryview], offsets: typing.Optional[typing.Sequence[int]] = None, sizes: typing.Optional[typing.Sequence[int]] = None) -> BatchResult:
+		"""Wraps many packets at once into a single output arena. `packets` is either a sequence of packets or a contiguous buffer with `offsets` being the boundaries of the packets in it (`len(offsets)` is the count of packets + 1).
+		If `sizes` are given, `offsets` are the starts of the packets, it allows the packets to be spread over the buffer with gaps, as in the buffers of `udpBatch`."""
+		return wireguard_write_many(self.ptr, packets, offsets, sizes)
+
+	def unwrap_many(self, datagrams: typing.Union[typing.Sequence[bytes], bytes, bytearray, memoryview], offsets: typing.Optional[typing.Sequence[int]] = None, sizes: typing.Optional[typing.Sequence[int]] = None) -> BatchResult:
+		return wireguard_read_many(self.ptr, datagrams, offsets, sizes)
+
+	def tick_into(self, dst: bytearray) -> typing.Tuple[Opcode, int]:
+		return wireguard_tick_into(self.ptr, dst)
+
+	def force_handshake_into(self, dst: bytearray) -> typing.Tuple[Opcode, int]:
+		return wireguard_force_handshake_into(self.ptr, dst)
 
 	def tick(self) -> Action:
-		return wireguard_tick(self.ptr, MAX_WIREGUARD_PACKET_SIZE)
+		return pooledAction(self.pool, wireguard_tick_into, self.ptr, view=self.pooledActions)
 
 	def force_handshake(self) -> Action:
-		return wireguard_force_handshake(self.ptr, MAX_WIREGUARD_PACKET_SIZE)
+		return pooledAction(self.pool, wireguard_force_handshake_into, self.ptr, view=self.pooledActions)
+
+	def offloader(self, onResults: ResultsCallback, executor: typing.Optional[Executor] = None) -> TunnelOffloader:
+		"""Returns an object running `wrap_many` and `unwrap_many` of this tunnel on `executor` (by default a thread pool shared by all the tunnels), keeping the order of the packets. It pays off only for big packets and batches, see `offload.benchmarkCrossover`."""
+		return TunnelOffloader(self, onResults, executor)
 
 	def stats(self) -> stats:
 		return wireguard_stats(self.ptr)
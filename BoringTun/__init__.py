@@ -1,8 +1,9 @@
-__all__ = ("KeyPair", "Key", "PublicKey", "SecretKey", "Tunnel", "Opcode", "Action")
+__all__ = ("KeyPair", "Key", "PublicKey", "SecretKey", "Tunnel", "Opcode", "Action", "BufferPool", "BACKEND_NAME")
 
 from warnings import warn
 
 warn("We have moved from M$ GitHub to https://codeberg.org/KOLANICH-libs/BoringTUN.py , read why on https://codeberg.org/KOLANICH/Fuck-GuanTEEnomo .")
 
+from .bufferPool import BufferPool
 from .KeyPair import Key, KeyPair, PublicKey, SecretKey
-from .Tunnel import Action, Opcode, Tunnel
+from .Tunnel import BACKEND_NAME, Action, Opcode, Tunnel
@@ -0,0 +1,255 @@
+"""Cryptokey routing: the `AllowedIPs` of the peers map IP prefixes to the peers. An outbound packet is routed to the peer owning the longest prefix matching its destination; an inbound (decrypted) one is accepted only if its source is owned by the peer it came from.
+The longest prefix match is done with a dict per prefix length in use instead of a Patricia trie: in Python walking a trie costs an interpreted step per node, while a probe of a dict is a single C call, and the real configs use few prefix lengths (i.e. /32 and /128 for the clients of a hub, plus a default route). So a lookup is a probe per distinct length, longest first, and inserting and removing prefixes are O(1)."""
+
+__all__ = ("AllowedIPs", "PrefixTable", "parseAllowedIPs", "toNetwork", "packetAddresses", "NO_PEER")
+
+import struct
+import typing
+from array import array
+from ipaddress import IPv4Address, IPv4Network, IPv6Address, IPv6Network, ip_address, ip_network
+
+IPV4_ADDRESS = struct.Struct("!I")
+IPV6_ADDRESS = struct.Struct("!QQ")
+IPV4_SRC_OFFSET = 12
+IPV4_DST_OFFSET = 16
+IPV4_MIN_HEADER_SIZE = 20
+IPV6_SRC_OFFSET = 8
+IPV6_DST_OFFSET = 24
+IPV6_HEADER_SIZE = 40
+
+NO_PEER = -1  # in the results of `AllowedIPs.routeMany`
+
+Network = typing.Union[IPv4Network, IPv6Network]
+Packet = typing.Union[bytes, bytearray, memoryview]
+
+
+def toNetwork(network: typing.Union[Network, str]) -> Network:
+	"""The host bits are cleared, as `wg` does."""
+	if isinstance(network, (IPv4Network, IPv6Network)):
+		return network
+	return ip_network(network, strict=False)
+
+
+def parseAllowedIPs(value: str) -> typing.Tuple[Network, ...]:
+	"""Parses the comma-separated prefixes of `AllowedIPs`."""
+	return tuple(toNetwork(el.strip()) for el in value.split(",") if el.strip())
+
+
+def packetAddresses(packet: Packet) -> typing.Optional[typing.Tuple[int, int, int]]:
+	"""Returns the IP version, the source and the destination (as ints) of an IP packet, `None` for the truncated and the non-IP ones."""
+	if not packet:
+		return None
+
+	version = packet[0] >> 4
+	if version == 4:
+		if len(packet) < IPV4_MIN_HEADER_SIZE:
+			return None
+		return 4, IPV4_ADDRESS.unpack_from(packet, IPV4_SRC_OFFSET)[0], IPV4_ADDRESS.unpack_from(packet, IPV4_DST_OFFSET)[0]
+
+	if version == 6:
+		if len(packet) < IPV6_HEADER_SIZE:
+			return None
+		srcHi, srcLo = IPV6_ADDRESS.unpack_from(packet, IPV6_SRC_OFFSET)
+		dstHi, dstLo = IPV6_ADDRESS.unpack_from(packet, IPV6_DST_OFFSET)
+		return 6, srcHi << 64 | srcLo, dstHi << 64 | dstLo
+
+	return None
+
+
+class PrefixTable:
+	"""Longest prefix match over the addresses of `bits` bits. `levels` are `(shift, dict)` pairs, longest prefixes first; a dict maps the prefixes of its length, shifted to the right, to the values."""
+
+	__slots__ = ("bits", "levels", "tables")
+
+	def __init__(self, bits: int) -> None:
+		self.bits = bits
+		self.tables = {}
+		self.levels = ()
+
+	def _updateLevels(self) -> None:
+		self.levels = tuple((self.bits - length, self.tables[length]) for length in sorted(self.tables, reverse=True))
+
+	def insert(self, prefix: int, length: int, value: typing.Any) -> typing.Any:
+		"""Returns the replaced value, if any."""
+		table = self.tables.get(length)
+		if table is None:
+			table = self.tables[length] = {}
+			self._updateLevels()
+
+		key = prefix >> (self.bits - length)
+		old = table.get(key)
+		table[key] = value
+		return old
+
+	def remove(self, prefix: int, length: int) -> typing.Any:
+		"""Returns the removed value, `None` if there was no such prefix."""
+		table = self.tables.get(length)
+		if table is None:
+			return None
+
+		old = table.pop(prefix >> (self.bits - length), None)
+		if not table:
+			del self.tables[length]
+			self._updateLevels()
+		return old
+
+	def get(self, prefix: int, length: int) -> typing.Any:
+		"""The exact match."""
+		table = self.tables.get(length)
+		if table is None:
+			return None
+		return table.get(prefix >> (self.bits - length))
+
+	def lookup(self, address: int) -> typing.Any:
+		for shift, table in self.levels:
+			res = table.get(address >> shift)
+			if res is not None:
+				return res
+		return None
+
+	def __len__(self) -> int:
+		return sum(len(table) for table in self.tables.values())
+
+	def __iter__(self) -> typing.Iterator[typing.Tuple[int, int, typing.Any]]:
+		"""Yields `(prefix, length, value)`."""
+		for length, table in self.tables.items():
+			shift = self.bits - length
+			for key, value in table.items():
+				yield key << shift, length, value
+
+
+class AllowedIPs:
+	"""The prefixes of IPv4 and IPv6 owned by the peers, identified by their indexes (i.e. the ones in a `WireGuardEndpoint`). A prefix belongs to one peer, inserting it for another one moves it, as in `wg`."""
+
+	__slots__ = ("v4", "v6", "byPeer")
+
+	def __init__(self) -> None:
+		self.v4 = PrefixTable(32)
+		self.v6 = PrefixTable(128)
+		self.byPeer = {}
+
+	@classmethod
+	def fromPeers(cls, peers: typing.Iterable["Peer"]) -> "AllowedIPs":
+		"""The indexes of the peers are their positions, as in `WireGuardEndpoint.fromConfig`."""
+		res = cls()
+		for idx, peer in enumerate(peers):
+			res.insertPeer(idx, peer.allowedIPs)
+		return res
+
+	def _table(self, version: int) -> PrefixTable:
+		return self.v4 if version == 4 else self.v6
+
+	def insert(self, network: typing.Union[Network, str], peer: int) -> None:
+		network = toNetwork(network)
+		key = (network.version, int(network.network_address), network.prefixlen)
+		old = self._table(network.version).insert(key[1], key[2], peer)
+		if old is not None and old != peer:
+			self._forget(old, key)
+		self.byPeer.setdefault(peer, set()).add(key)
+
+	def remove(self, network: typing.Union[Network, str]) -> typing.Optional[int]:
+		"""Returns the peer that owned the prefix."""
+		network = toNetwork(network)
+		key = (network.version, int(network.network_address), network.prefixlen)
+		old = self._table(network.version).remove(key[1], key[2])
+		if old is not None:
+			self._forget(old, key)
+		return old
+
+	def _forget(self, peer: int, key: typing.Tuple[int, int, int]) -> None:
+		keys = self.byPeer.get(peer)
+		if keys is not None:
+			keys.discard(key)
+			if not keys:
+				del self.byPeer[peer]
+
+	def insertPeer(self, peer: int, networks: typing.Iterable[typing.Union[Network, str]]) -> None:
+		for network in networks:
+			self.insert(network, peer)
+
+	def removePeer(self, peer: int) -> None:
+		"""Removes all the prefixes of the peer."""
+		for version, prefix, length in self.byPeer.pop(peer, ()):
+			self._table(version).remove(prefix, length)
+
+	def networksOf(self, peer: int) -> typing.List[Network]:
+		return [(IPv4Network if version == 4 else IPv6Network)((prefix, length)) for version, prefix, length in self.byPeer.get(peer, ())]
+
+	def lookup(self, address: typing.Union[IPv4Address, IPv6Address, str]) -> typing.Optional[int]:
+		"""The peer owning the longest prefix containing `address`."""
+		if isinstance(address, str):
+			address = ip_address(address)
+		return self._table(address.version).lookup(int(address))
+
+	def route(self, packet: Packet) -> typing.Optional[int]:
+		"""The peer an outbound IP packet is sent to, by its destination. Fits as the `route` of `tunDevice.TunDevice`."""
+		addrs = packetAddresses(packet)
+		if addrs is None:
+			return None
+		return (self.v4 if addrs[0] == 4 else self.v6).lookup(addrs[2])
+
+	def sourceOwner(self, packet: Packet) -> typing.Optional[int]:
+		addrs = packetAddresses(packet)
+		if addrs is None:
+			return None
+		return (self.v4 if addrs[0] == 4 else self.v6).lookup(addrs[1])
+
+	def allowsSource(self, packet: Packet, peer: int) -> bool:
+		"""Whether an inbound (decrypted) packet from `peer` has a source address allowed for it."""
+		return self.sourceOwner(packet) == peer
+
+	def routeMany(self, packets: typing.Union[typing.Sequence[Packet], bytes, bytearray, memoryview], offsets: typing.Optional[typing.Sequence[int]] = None) -> array:
+		"""Routes many packets given either as a sequence or as a contiguous buffer with `offsets` being their boundaries (as in `OpenTunnel.wrap_many`). Returns the peer indexes, `NO_PEER` for the unroutable packets."""
+		if offsets is not None:
+			packets = memoryview(packets)
+			count = len(offsets) - 1
+		else:
+			count = len(packets)
+
+		res = array("i", bytes(4 * count))
+		v4Levels = self.v4.levels
+		v6Levels = self.v6.levels
+		unpack4 = IPV4_ADDRESS.unpack_from
+		unpack6 = IPV6_ADDRESS.unpack_from
+		for i in range(count):
+			if offsets is None:
+				packet = packets[i]
+				o = 0
+				size = len(packet)
+			else:
+				packet = packets
+				o = offsets[i]
+				size = offsets[i + 1] - o
+
+			peer = None
+			if size:
+				version = packet[o] >> 4
+				if version == 4 and size >= IPV4_MIN_HEADER_SIZE:
+					address = unpack4(packet, o + IPV4_DST_OFFSET)[0]
+					for shift, table in v4Levels:
+						peer = table.get(address >> shift)
+						if peer is not None:
+							break
+				elif version == 6 and size >= IPV6_HEADER_SIZE:
+					hi, lo = unpack6(packet, o + IPV6_DST_OFFSET)
+					address = hi << 64 | lo
+					for shift, table in v6Levels:
+						peer = table.get(address >> shift)
+						if peer is not None:
+							break
+			res[i] = NO_PEER if peer is None else peer
+
+		return res
+
+	def __len__(self) -> int:
+		return len(self.v4) + len(self.v6)
+
+	def __iter__(self) -> typing.Iterator[typing.Tuple[Network, int]]:
+		"""Yields `(prefix, peer)`."""
+		for prefix, length, peer in self.v4:
+			yield IPv4Network((prefix, length)), peer
+		for prefix, length, peer in self.v6:
+			yield IPv6Network((prefix, length)), peer
+
+	def __repr__(self):
+		return self.__class__.__name__ + "<" + repr(len(self.v4)) + " IPv4 + " + repr(len(self.v6)) + " IPv6 prefixes of " + repr(len(self.byPeer)) + " peers>"
@@ -1,13 +1,21 @@
 import asyncio
 import typing
+from concurrent.futures import Executor
 from enum import Enum
 from threading import Thread
 
 import asyncio_dgram
 from icecream import ic
 
+from .capture import captures, startCapture, stopCapture
 from .config import Peer
-from .Tunnel import Opcode, Tunnel
+from .handshakeScheduler import HandshakeScheduler
+from .messageHeaders import MessageType
+from .metrics import instrument, instruments, uninstrument
+from .timerWheel import TimerWheel, getDefaultTimerWheel
+from .Tunnel import Action, Opcode, Tunnel
+from .tunnelStream import DEFAULT_FLUSH_DELAY, DEFAULT_MTU, TunnelStream
+from .udpBatch import DatagramBatch, createBatchedDatagramEndpoint
 
 
 class TunnelStateMachine:
@@ -34,23 +42,62 @@ class TunnelStateMachine:
 		sself.appProtocol.datagram_received(state.buf, None)
 
 
+DEFAULT_HIGH_WATER = 0x10000
+DEFAULT_HARD_LIMIT_FACTOR = 8
+
+
+def opSize(op: Action) -> int:
+	return len(op.buf) if op.buf is not None else 0
+
+
+def buildHandlersTable(stateMachineClass: typing.Type[TunnelStateMachine]) -> typing.Dict[Opcode, typing.Callable]:
+	"""Resolves the handlers of a state machine class once, so dispatching an op is a single dict lookup instead of `getattr` by the opcode name."""
+	return {opcode: getattr(stateMachineClass, opcode.name) for opcode in Opcode}
+
+
 class BoringTUNProtocol(asyncio.Transport, asyncio.DatagramProtocol):
-	__slots__ = ("transport", "tunnel", "openTunnel", "cmdQ", "keepAliveTask", "appProtocol", "_eventProcessorTask", "handshakeCounter", "initialized")
+	__slots__ = ("transport", "tunnel", "openTunnel", "cmdQ", "appProtocol", "_eventProcessorTask", "handshakeCounter", "initialized", "batchedIO", "handlers", "queuedBytes", "queuedToTunnel", "highWater", "lowWater", "hardLimit", "transportPaused", "appPaused", "_writable", "droppedPackets", "timerWheel", "tickEntry", "offload", "offloader", "loop", "metrics", "capture", "handshakeScheduler", "__weakref__")
 
 	STATE_MACHINE_CLASS = TunnelStateMachine
 
-	def __init__(self, tunnel: Tunnel, appProtocol: asyncio.Protocol = None):
+	def __init__(self, tunnel: Tunnel, appProtocol: asyncio.Protocol = None, batchedIO: bool = False, timerWheel: typing.Optional[TimerWheel] = None, offload: typing.Union[bool, Executor] = False, handshakeScheduler: typing.Optional[HandshakeScheduler] = None):
+		"""If `batchedIO` is set, the UDP socket is served by `udpBatch.BatchedDatagramTransport` (`recvmmsg`/`sendmmsg` on Linux) and the received datagrams are unwrapped in batches.
+		The tunnel is ticked by `timerWheel`, by default by the one shared by all the tunnels of the event loop.
+		If `offload` is set (to `True` or to an executor), the packets are encrypted and decrypted in a thread pool (see `offload.TunnelOffloader`) instead of in the event loop; it only pays off for big packets.
+		If `handshakeScheduler` is given (it should be shared by the connections started at once), the initial handshake is sent when its budget allows, jittered."""
 		super().__init__()
+		self.handshakeScheduler = handshakeScheduler
+		self.offload = offload
+		self.offloader = None
+		self.loop = None
+		self.metrics = None  # see `metrics.enableMetrics`
+		self.capture = None  # see `capture.startCapture`
+		self.timerWheel = timerWheel
+		self.tickEntry = None
+		self.batchedIO = batchedIO
 		self.transport = None
 		self.tunnel = tunnel
 		self.openTunnel = None
 		self.cmdQ = asyncio.Queue(maxsize=0)
-		self.keepAliveTask = None
 		self.appProtocol = appProtocol
 		self._eventProcessorTask = None
 		self.initialized = asyncio.Future()
+		self.handlers = buildHandlersTable(self.__class__.STATE_MACHINE_CLASS)
+
+		self.queuedBytes = 0
+		self.queuedToTunnel = 0  # the queued ops not writing to the network
+		self.highWater = self.lowWater = self.hardLimit = None
+		self.set_write_buffer_limits()
+		self.transportPaused = False  # the UDP transport asked us to stop writing
+		self.appPaused = False  # we asked the app protocol to stop writing
+		self._writable = asyncio.Event()
+		self._writable.set()
+		self.droppedPackets = 0
 
 	async def getTransport(self, wgServer: str, port: int):
+		if self.batchedIO:
+			return await createBatchedDatagramEndpoint(lambda: self, remote_addr=(str(wgServer), port))
+
 		loop = asyncio.get_event_loop()
 		return await loop.create_datagram_endpoint(lambda: self, remote_addr=(str(wgServer), port))  # , local_addr=('127.0.0.1', 9999)
 
@@ -65,35 +112,156 @@ class BoringTUNProtocol(asyncio.Transport, asyncio.DatagramProtocol):
 			try:
 				op = await self.cmdQ.get()
 				#print("next op:", op)
-				processor = getattr(self.__class__.STATE_MACHINE_CLASS, op.opcode.name)
-				processor(self, op)
-				self.cmdQ.task_done()
+				if self.transportPaused and op.opcode == Opcode.WRITE_TO_NETWORK:
+					await self._writable.wait()
+				try:
+					self._handle(op)
+				finally:
+					self._opDequeued(op)
+					self.cmdQ.task_done()
 			except Exception as ex:
 				import traceback
 
 				print(traceback.format_exc())
 
-	async def keepAliver(self):
-		while True:
-			self.cmdQ.put_nowait(wg.openTunnel.tick())
-			await asyncio.sleep(self.tunnel.peer.keepAliveTimeout, result=None)
+	def _handle(self, op: Action):
+		"""An exception of a handler (i.e. of the app protocol) must not break the processing of the next ops, whether they are handled right away or by `eventProcessor`."""
+		try:
+			self.handlers[op.opcode](self, op)
+		except Exception:  # pylint:disable=broad-except
+			import traceback
+
+			print(traceback.format_exc())
+
+	def dispatch(self, op: Action):
+		"""Handles an op right away. The queue is only used when the ops cannot be handled now (the event processor is stopped, or the UDP transport is paused for the ops writing to the network) or when there are already queued ops, to keep the order. A paused UDP transport doesn't hold back the packets to the tunnel: they only wait for the other queued packets to the tunnel."""
+		if self._eventProcessorTask is not None:
+			if op.opcode == Opcode.WRITE_TO_NETWORK:
+				if not self.transportPaused and self.cmdQ.empty():
+					self._handle(op)
+					return
+			elif not self.queuedToTunnel:
+				self._handle(op)
+				return
+		self._enqueue(op)
+
+	def _enqueue(self, op: Action):
+		self.cmdQ.put_nowait(op)
+		if op.opcode != Opcode.WRITE_TO_NETWORK:
+			self.queuedToTunnel += 1
+		self.queuedBytes += opSize(op)
+		if not self.appPaused and self.queuedBytes > self.highWater:
+			self.appPaused = True
+			if self.appProtocol is not None:
+				self.appProtocol.pause_writing()
+
+	def _opDequeued(self, op: Action):
+		if op.opcode != Opcode.WRITE_TO_NETWORK:
+			self.queuedToTunnel -= 1
+		self.queuedBytes -= opSize(op)
+		if self.appPaused and self.queuedBytes <= self.lowWater:
+			self.appPaused = False
+			if self.appProtocol is not None:
+				self.appProtocol.resume_writing()
 
 	def write(self, data):
-		msg = self.openTunnel.wrap(data)
-		self.cmdQ.put_nowait(msg)
+		queuedBytes = self.queuedBytes
+		if self.offloader is not None:
+			queuedBytes += self.offloader.pendingBytes
+
+		if queuedBytes + len(data) > self.hardLimit:
+			# the app ignores `pause_writing`, datagrams can be lost anyway, so drop instead of growing without bound
+			self.droppedPackets += 1
+			return
+
+		if self.offloader is not None:
+			self.offloader.wrap(bytes(data))
+		else:
+			self.dispatch(self.openTunnel.wrap(data))
+		if self.tickEntry is not None:
+			self.tickEntry.active = True
+
+	def write_many(self, packets: typing.Union[typing.Sequence[bytes], bytes, bytearray, memoryview], offsets: typing.Optional[typing.Sequence[int]] = None) -> None:
+		"""Writes many packets, wrapping them in a single batch. `packets` and `offsets` are the same as in `OpenTunnel.wrap_many`."""
+		if offsets is None:
+			count = len(packets)
+			size = sum(len(p) for p in packets)
+		else:
+			count = len(offsets) - 1
+			size = offsets[-1] - offsets[0]
+
+		queuedBytes = self.queuedBytes
+		if self.offloader is not None:
+			queuedBytes += self.offloader.pendingBytes
+
+		if queuedBytes + size > self.hardLimit:
+			self.droppedPackets += count
+			return
+
+		if self.offloader is not None:
+			if offsets is None:
+				self.offloader.wrap_many([bytes(p) for p in packets])
+			else:
+				self.offloader.wrap_many([bytes(packets[offsets[i] : offsets[i + 1]]) for i in range(count)])
+		else:
+			for opcode, out in self.openTunnel.wrap_many(packets, offsets):
+				self.dispatch(Action(opcode, out))
+		if self.tickEntry is not None:
+			self.tickEntry.active = True
+
+	def writelines(self, packets: typing.Iterable[bytes]) -> None:
+		"""Unlike in the stream transports, each element is a separate packet. They are wrapped in a single batch."""
+		self.write_many(list(packets))
+
+	def get_write_buffer_size(self) -> int:
+		res = self.queuedBytes
+		if self.offloader is not None:
+			res += self.offloader.pendingBytes
+		if self.transport is not None:
+			res += self.transport.get_write_buffer_size()
+		return res
+
+	def get_write_buffer_limits(self) -> typing.Tuple[int, int]:
+		return self.lowWater, self.highWater
+
+	def set_write_buffer_limits(self, high: typing.Optional[int] = None, low: typing.Optional[int] = None) -> None:
+		"""The same semantics as in `asyncio.WriteTransport`. Additionally, the packets written when the buffer exceeds `DEFAULT_HARD_LIMIT_FACTOR * high` bytes are dropped."""
+		if high is None:
+			if low is None:
+				high = DEFAULT_HIGH_WATER
+			else:
+				high = 4 * low
+		if low is None:
+			low = high // 4
+
+		if not high >= low >= 0:
+			raise ValueError("high (" + repr(high) + ") must be >= low (" + repr(low) + ") must be >= 0")
+
+		self.highWater = high
+		self.lowWater = low
+		self.hardLimit = DEFAULT_HARD_LIMIT_FACTOR * max(high, 1)
 
 	def is_writing(self):
-		return self._eventProcessorTask is not None
+		return self._eventProcessorTask is not None and not self.transportPaused
 
 	def pause_writing(self):
-		if self._eventProcessorTask is not None:
-			self._eventProcessorTask.cancel()
-			self._eventProcessorTask = None
+		"""Called by the UDP transport when its buffer is full. The ops writing to the network are queued until `resume_writing`, and the app protocol is paused when the queue exceeds the high-water mark."""
+		self.transportPaused = True
+		self._writable.clear()
 
 	def resume_writing(self):
-		if not self.is_writing():
+		self.transportPaused = False
+		self._writable.set()
+
+	def startEventProcessor(self):
+		if self._eventProcessorTask is None:
 			self._eventProcessorTask = asyncio.create_task(self.eventProcessor())
 
+	def stopEventProcessor(self):
+		if self._eventProcessorTask is not None:
+			self._eventProcessorTask.cancel()
+			self._eventProcessorTask = None
+
 	def error_received(self, exc):
 		ic(exc)
 
@@ -101,7 +269,11 @@ class BoringTUNProtocol(asyncio.Transport, asyncio.DatagramProtocol):
 		hs = self.openTunnel.force_handshake()
 		if hs.opcode != Opcode.WRITE_TO_NETWORK:
 			raise SystemError("First packet of the handshake is not Opcode.WRITE_TO_NETWORK")
-		self.cmdQ.put_nowait(hs)
+		self.dispatch(hs)
+
+	def _scheduledForceHandshake(self):
+		if self.openTunnel is not None:  # the connection may have been lost while the handshake was queued
+			self.forceHandshake()
 
 	def connection_made(self, transport):
 		self.transport = transport
@@ -109,12 +281,16 @@ class BoringTUNProtocol(asyncio.Transport, asyncio.DatagramProtocol):
 		if self.openTunnel is None:
 			self.openTunnel = self.tunnel.__enter__()
 
-		self.resume_writing()
+		self.loop = asyncio.get_running_loop()
+		if self.offload and self.offloader is None:
+			self.offloader = self.openTunnel.offloader(self._offloadedResultsReady, self.offload if isinstance(self.offload, Executor) else None)
+
+		self.startEventProcessor()
 
 		asyncio.create_task(self._waitReadyAndSendConnectionMade())
 
 	async def waitQueueClear(self):
-		self.stopKeepAlive()
+		self.stopTicking()
 		await self.cmdQ.join()
 
 	async def _waitReadyAndSendConnectionMade(self):
@@ -125,10 +301,23 @@ class BoringTUNProtocol(asyncio.Transport, asyncio.DatagramProtocol):
 
 	async def waitHandshake(self):
 		await self.waitQueueClear()
-		self.forceHandshake()
+		if self.handshakeScheduler is not None:
+			self.handshakeScheduler.submitForced(self._scheduledForceHandshake)
+		else:
+			self.forceHandshake()
 		await self.initialized
 
 	async def processPacket(self, data, responseAddrAndPort):
+		self.handlePacket(data, responseAddrAndPort)
+
+	def handlePacket(self, data, responseAddrAndPort):
+		if self.tickEntry is not None:
+			self.tickEntry.active = True
+
+		if self.offloader is not None:
+			self.offloader.unwrap(data)
+			return
+
 		nextOp = self.openTunnel.unwrap(data)
 		if nextOp.opcode != Opcode.WIREGUARD_ERROR:
 			peerName = self.transport.get_extra_info("peername")
@@ -136,14 +325,55 @@ class BoringTUNProtocol(asyncio.Transport, asyncio.DatagramProtocol):
 				#await self.__class__.getTransport(*responseAddrAndPort)
 				print("Mismatch", peerName, responseAddrAndPort)
 
-		if nextOp.opcode == Opcode.WRITE_TO_NETWORK and data[0] == 2:  # handshake response
+		if nextOp.opcode == Opcode.WRITE_TO_NETWORK and data[0] == MessageType.HANDSHAKE_RESPONSE:
 			if not self.initialized.done():
 				self.initialized.set_result(True)
 
-		await self.cmdQ.put(nextOp)
+		self.dispatch(nextOp)
 
 	def datagram_received(self, data, responseAddrAndPort):
-		asyncio.ensure_future(self.processPacket(data, responseAddrAndPort))
+		self.handlePacket(data, responseAddrAndPort)
+
+	def datagrams_received(self, batch: DatagramBatch):
+		"""Called by `BatchedDatagramTransport` with all the datagrams drained from the socket at once."""
+		if self.tickEntry is not None:
+			self.tickEntry.active = True
+
+		buf = batch.buffer
+		if self.offloader is not None:
+			# the buffer of the batch is reused by the next receive
+			self.offloader.unwrap_many([bytes(buf[offset : offset + size]) for offset, size in zip(batch.usedOffsets, batch.usedSizes)])
+			return
+
+		results = self.openTunnel.unwrap_many(buf, batch.usedOffsets, batch.usedSizes)
+		types = batch.headers().types
+		for msgType, (opcode, out) in zip(types, results):
+			self._dispatchUnwrapped(opcode, out, msgType == MessageType.HANDSHAKE_RESPONSE)
+
+	def _dispatchUnwrapped(self, opcode: Opcode, out: memoryview, isHandshakeResponse: bool) -> None:
+		if opcode == Opcode.WRITE_TO_NETWORK and isHandshakeResponse:
+			if not self.initialized.done():
+				self.initialized.set_result(True)
+
+		if opcode == Opcode.WRITE_TO_TUNNEL_IPV4 or opcode == Opcode.WRITE_TO_TUNNEL_IPV6:
+			out = bytes(out)
+		self.dispatch(Action(opcode, out))
+
+	def _offloadedResultsReady(self, datagrams, unwrapped, wrapped):
+		"""Called in a worker thread of the offloader."""
+		self.loop.call_soon_threadsafe(self._handleOffloadedResults, datagrams, unwrapped, wrapped)
+
+	def _handleOffloadedResults(self, datagrams, unwrapped, wrapped):
+		if self.offloader is None:  # the connection was lost meanwhile
+			return
+
+		if unwrapped is not None:
+			for datagram, (opcode, out) in zip(datagrams, unwrapped):
+				self._dispatchUnwrapped(opcode, out, datagram[0] == MessageType.HANDSHAKE_RESPONSE)
+
+		if wrapped is not None:
+			for opcode, out in wrapped:
+				self.dispatch(Action(opcode, out))
 
 	def resume_reading(self):
 		pass
@@ -155,48 +385,114 @@ class BoringTUNProtocol(asyncio.Transport, asyncio.DatagramProtocol):
 		True
 
 	def startTasks(self):
-		self.resume_writing()
-		self.startKeepAlive()
+		self.startEventProcessor()
+		self.startTicking()
 
 	def stopTasks(self):
-		self.pause_writing()
-		self.stopKeepAlive()
+		self.stopEventProcessor()
+		self.stopTicking()
 
-	def startKeepAlive(self):
-		if self.tunnel.peer.keepAliveTimeout is not None:
-			if self.keepAliveTask is None:
-				self.keepAliveTask = asyncio.create_task(self.keepAliver())
+	def startTicking(self):
+		"""The keepalives, rekeying and handshake retransmissions are all driven by `tick`, so it is called every `timerWheel.TICK_INTERVAL`, not every `keepAliveTimeout`, which is handled by BoringTun itself."""
+		if self.tickEntry is None:
+			if self.timerWheel is None:
+				self.timerWheel = getDefaultTimerWheel()
+			self.tickEntry = self.timerWheel.register(self.openTunnel, self.dispatch)
 
-	def stopKeepAlive(self):
-		if self.keepAliveTask is not None:
-			self.keepAliveTask.stop()
+	def stopTicking(self):
+		if self.tickEntry is not None:
+			self.timerWheel.unregister(self.tickEntry)
+			self.tickEntry = None
 
 	def connection_lost(self, exc):
 		self.stopTasks()
 
 		if self.openTunnel is not None:
-			self.openTunnel.__exit__(type(exc), exc, None)
+			if self.offloader is not None:
+				# the tunnel must outlive the batch in flight
+				self.offloader.close(self.openTunnel.close)
+				self.offloader = None
+				self.tunnel.openTunnel = None
+			else:
+				self.tunnel.__exit__(type(exc), exc, None)
 			self.openTunnel = None
 
 		if self.appProtocol is not None:
 			self.appProtocol.connection_lost(self)
 
 	@classmethod
-	async def createConnection(cls, protocol_factory, tunnel):
+	async def createConnection(cls, protocol_factory, tunnel, batchedIO: bool = False, offload: typing.Union[bool, Executor] = False, handshakeScheduler: typing.Optional[HandshakeScheduler] = None):
 		if protocol_factory is not None:
 			protocol = protocol_factory()
 		else:
 			protocol = None
 
-		boringTunTransportProtocol = cls(tunnel, protocol)
+		boringTunTransportProtocol = cls(tunnel, protocol, batchedIO=batchedIO, offload=offload, handshakeScheduler=handshakeScheduler)
 		transport, boringTunTransportProtocol_1 = await boringTunTransportProtocol.getTransportForTunnel(tunnel)
 		assert boringTunTransportProtocol is boringTunTransportProtocol_1
 		return boringTunTransportProtocol, protocol
 
 
-async def open_wireguard_connection(tunn: Tunnel, protocol_factory=None):
+@instruments(BoringTUNProtocol)
+class InstrumentedBoringTUNProtocol(BoringTUNProtocol):
+	"""Shares its metrics with its tunnel and adds the gauges of the queue."""
+
+	__slots__ = ()
+
+	def _metricsEnabled(self):
+		if self.openTunnel is not None:
+			instrument(self.openTunnel, self.metrics)
+
+	def _metricsDisabled(self):
+		if self.openTunnel is not None:
+			uninstrument(self.openTunnel)
+
+	def connection_made(self, transport):
+		super().connection_made(transport)
+		instrument(self.openTunnel, self.metrics)
+
+	def metricsGauges(self) -> typing.Dict[str, int]:
+		return {
+			"queue_depth": self.cmdQ.qsize(),
+			"queued_bytes": self.queuedBytes,
+			"write_buffer_bytes": self.get_write_buffer_size(),
+			"dropped_packets": self.droppedPackets,
+		}
+
+
+@captures(BoringTUNProtocol)
+class BoringTUNProtocolCaptureMixin:
+	"""Captures the tunnel, including the one opened on connecting."""
+
+	__slots__ = ()
+
+	def _captureStarted(self):
+		if self.openTunnel is not None:
+			startCapture(self.openTunnel, self.capture.writer, self.capture.stream)
+
+	def _captureStopped(self):
+		if self.openTunnel is not None:
+			stopCapture(self.openTunnel)
+
+	def connection_made(self, transport):
+		super().connection_made(transport)
+		startCapture(self.openTunnel, self.capture.writer, self.capture.stream)
+
+
+async def open_wireguard_connection(tunn: Tunnel, protocol_factory=None, batchedIO: bool = False, offload: typing.Union[bool, Executor] = False, handshakeScheduler: typing.Optional[HandshakeScheduler] = None):
 	reader = asyncio.streams.StreamReader()
 	protocol = asyncio.streams.StreamReaderProtocol(reader)
-	transport, child_protocol = await BoringTUNProtocol.createConnection(protocol_factory, tunn)
+	transport, child_protocol = await BoringTUNProtocol.createConnection(protocol_factory, tunn, batchedIO=batchedIO, offload=offload, handshakeScheduler=handshakeScheduler)
 	writer = asyncio.streams.StreamWriter(transport, child_protocol, reader, asyncio.get_event_loop())
 	return reader, writer
+
+
+async def open_wireguard_stream(tunn: Tunnel, mtu: int = DEFAULT_MTU, noDelay: bool = False, flushDelay: float = DEFAULT_FLUSH_DELAY, batchedIO: bool = False, offload: typing.Union[bool, Executor] = False, handshakeScheduler: typing.Optional[HandshakeScheduler] = None) -> typing.Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+	"""Opens a byte stream over the tunnel, see `tunnelStream.TunnelStream`. The writes are cut into frames fitting `mtu` and the small ones are coalesced unless `noDelay` is set. The data written before the handshake is done is sent after it."""
+	loop = asyncio.get_running_loop()
+	reader = asyncio.StreamReader(loop=loop)
+	protocol = asyncio.StreamReaderProtocol(reader, loop=loop)
+	stream = TunnelStream(protocol, mtu=mtu, noDelay=noDelay, flushDelay=flushDelay)
+	await BoringTUNProtocol.createConnection(lambda: stream, tunn, batchedIO=batchedIO, offload=offload, handshakeScheduler=handshakeScheduler)
+	writer = asyncio.StreamWriter(stream, protocol, reader, loop)
+	return reader, writer
@@ -0,0 +1,63 @@
+"""Selects the implementation of the per-packet functions used by `OpenTunnel` at import. Available backends:
+* `ext` - a compiled extension module `BoringTun._native`, linked against `libboringtun`, not built by this package;
+* `cffi` - `cffiBackend`, requires `cffi`;
+* `ctypes` - `tunnelMiddleLevel`, always available.
+The first one that can be imported is used, unless the `BORINGTUN_BACKEND` env var names one. A backend is a module with the functions named in `BACKEND_FUNCTIONS`, having the signatures of the ones in `tunnelMiddleLevel`; the tunnel pointers it returns are opaque to the rest of the package."""
+
+__all__ = ("BACKEND_NAME", "BACKENDS", "BACKEND_FUNCTIONS", "loadBackend", "new_tunnel", "tunnel_free", "wireguard_write_into", "wireguard_read_into", "wireguard_tick_into", "wireguard_force_handshake_into", "wireguard_write_many", "wireguard_read_many", "wireguard_stats")
+
+import os
+import typing
+from importlib import import_module
+from types import ModuleType
+
+BACKEND_ENV_VAR = "BORINGTUN_BACKEND"
+EXT_MODULE_NAME = __package__ + "._native"
+
+BACKEND_FUNCTIONS = ("new_tunnel", "tunnel_free", "wireguard_write_into", "wireguard_read_into", "wireguard_tick_into", "wireguard_force_handshake_into", "wireguard_write_many", "wireguard_read_many", "wireguard_stats")
+
+BACKENDS = {
+	"ext": EXT_MODULE_NAME,
+	"cffi": __package__ + ".cffiBackend",
+	"ctypes": __package__ + ".tunnelMiddleLevel",
+}
+
+
+def loadBackend(name: typing.Optional[str] = None) -> typing.Tuple[str, ModuleType]:
+	"""Imports the backend `name`, or the first importable one if it is `None`. Returns its name and module."""
+	if name is None:
+		names = tuple(BACKENDS)
+	elif name in BACKENDS:
+		names = (name,)
+	else:
+		raise ValueError("Unknown backend `" + name + "` in `" + BACKEND_ENV_VAR + "`, the available ones are: " + ", ".join(BACKENDS))
+
+	tried = []
+	for candidate in names:
+		try:
+			module = import_module(BACKENDS[candidate])
+		except ImportError as ex:
+			tried.append(candidate + ": " + str(ex))
+			continue
+
+		missing = [funcName for funcName in BACKEND_FUNCTIONS if not hasattr(module, funcName)]
+		if missing:
+			tried.append(candidate + ": lacks " + ", ".join(missing))
+			continue
+
+		return candidate, module
+
+	raise ImportError("No usable backend. Tried: " + "; ".join(tried))
+
+
+BACKEND_NAME, _backend = loadBackend(os.environ.get(BACKEND_ENV_VAR) or None)
+
+new_tunnel = _backend.new_tunnel
+tunnel_free = _backend.tunnel_free
+wireguard_write_into = _backend.wireguard_write_into
+wireguard_read_into = _backend.wireguard_read_into
+wireguard_tick_into = _backend.wireguard_tick_into
+wireguard_force_handshake_into = _backend.wireguard_force_handshake_into
+wireguard_write_many = _backend.wireguard_write_many
+wireguard_read_many = _backend.wireguard_read_many
+wireguard_stats = _backend.wireguard_stats
@@ -0,0 +1,487 @@
+"""Benchmarks of the bindings. Run `python -m BoringTun.bench --help`, the results are printed as JSON, so they can be compared between releases."""
+
+__all__ = ("nativeBenchmark", "nativeBenchmarks", "handshake", "tunnelsPair", "connectedTunnels", "closeTunnels", "ipv4Packet", "benchHandshakes", "benchThroughput", "benchTick", "benchOpenMany", "benchLoopback", "benchStream", "benchAllowedIPs", "benchBackends", "benchReplay", "runSuites", "SUITES")
+
+import asyncio
+import json
+import platform
+import struct
+import sys
+import time
+import typing
+from argparse import ArgumentParser
+from types import ModuleType
+
+from .config import Interface, Peer, WGConfig
+from .ctypes import MAX_WIREGUARD_PACKET_SIZE, benchmark as ct_benchmark, toPythonBytes, x25519_key_to_str_free
+from .KeyPair import KeyPair
+from .Tunnel import BACKEND_NAME, Opcode, OpenTunnel, Tunnel
+
+IPV4_HEADER = struct.Struct("!BBHHHBBH4s4s")
+LOCALHOST = bytes((127, 0, 0, 1))
+MAX_NATIVE_BENCHMARKS = 64
+
+DEFAULT_PACKET_SIZES = (64, 256, 512, 1024, 1420)
+
+
+def nativeBenchmark(name: int, idx: int) -> typing.Optional[str]:
+	"""Runs the benchmark `idx` built into the library. Returns `None` if there is no such benchmark."""
+	res = ct_benchmark(name, idx)
+	if not res:
+		return None
+	try:
+		return toPythonBytes(res).decode("utf-8")
+	finally:
+		x25519_key_to_str_free(res)
+
+
+def nativeBenchmarks(name: int = 0) -> typing.List[str]:
+	res = []
+	for idx in range(MAX_NATIVE_BENCHMARKS):
+		r = nativeBenchmark(name, idx)
+		if r is None:
+			break
+		res.append(r)
+	return res
+
+
+def ipv4Packet(size: int) -> bytes:
+	"""A UDP-over-IPv4 packet of `size` bytes, BoringTun checks the length in the header of the decrypted packets."""
+	size = max(size, IPV4_HEADER.size)
+	return IPV4_HEADER.pack(0x45, 0, size, 0, 0x4000, 64, 17, 0, LOCALHOST, LOCALHOST) + bytes(size - IPV4_HEADER.size)
+
+
+def handshake(initiator: OpenTunnel, responder: OpenTunnel) -> bool:
+	"""Does the full handshake between 2 tunnels in memory. Returns whether it has succeeded."""
+	msg = initiator.force_handshake()
+	for ot in (responder, initiator, responder):
+		if msg.opcode != Opcode.WRITE_TO_NETWORK:
+			return False
+		msg = ot.unwrap(msg.buf)
+	return msg.opcode == Opcode.WIREGUARD_DONE
+
+
+def tunnelsPair() -> typing.Tuple[Tunnel, Tunnel]:
+	p1 = KeyPair(sec=None, pub=None)
+	p2 = KeyPair(sec=None, pub=None)
+	return Tunnel(Interface(p1.sec), Peer(pub=p2.pub, ip=None, port=None)), Tunnel(Interface(p2.sec), Peer(pub=p1.pub, ip=None, port=None))
+
+
+def connectedTunnels() -> typing.Tuple[Tunnel, OpenTunnel, Tunnel, OpenTunnel]:
+	"""Opens 2 tunnels between fresh key pairs and does the handshake between them. Both must be closed by the caller."""
+	t1, t2 = tunnelsPair()
+	ot1 = t1.__enter__()
+	ot2 = t2.__enter__()
+	if not handshake(ot1, ot2):
+		t1.__exit__(None, None, None)
+		t2.__exit__(None, None, None)
+		raise RuntimeError("Handshake between the tunnels has failed")
+	return t1, ot1, t2, ot2
+
+
+def closeTunnels(*tunnels: Tunnel) -> None:
+	for t in tunnels:
+		t.__exit__(None, None, None)
+
+
+def benchHandshakes(count: int = 200) -> typing.Dict[str, typing.Union[int, float]]:
+	"""Each handshake is done by a fresh pair of tunnels, since BoringTun starts to answer with cookies when a single tunnel gets too many handshakes per second. So the rate includes `new_tunnel` of both sides."""
+	t1, t2 = tunnelsPair()
+	failures = 0
+	start = time.perf_counter()
+	for i in range(count):
+		with t1 as ot1, t2 as ot2:
+			failures += not handshake(ot1, ot2)
+	elapsed = time.perf_counter() - start
+	return {"handshakes": count, "failures": failures, "seconds": elapsed, "handshakesPerSecond": count / elapsed}
+
+
+def benchOpenMany(tunnelsCount: int = 1000) -> typing.Dict[str, typing.Union[int, float]]:
+	"""Brings up the tunnels to `tunnelsCount` peers of a single interface with `Tunnel.open_many`, in parallel and sequentially."""
+	from concurrent.futures import ThreadPoolExecutor
+
+	interface = Interface(KeyPair(sec=None, pub=None).sec)
+	cfg = WGConfig(interface, [Peer(pub=KeyPair(sec=None, pub=None).pub, ip=None, port=None) for i in range(tunnelsCount)])
+
+	res = {"tunnels": tunnelsCount}
+	with ThreadPoolExecutor(1) as sequential:
+		for kind, executor in (("parallel", None), ("sequential", sequential)):
+			opened = Tunnel.open_many(cfg, executor=executor)
+			opened.close()
+			res[kind] = {"encodingSeconds": opened.encodingTime, "openingSeconds": opened.openingTime, "tunnelsPerSecond": tunnelsCount / (opened.encodingTime + opened.openingTime)}
+	return res
+
+
+def _rates(packetsCount: int, packetSize: int, elapsed: float) -> typing.Dict[str, float]:
+	return {"seconds": elapsed, "packetsPerSecond": packetsCount / elapsed, "megabitsPerSecond": packetsCount * packetSize * 8 / elapsed / 1e6}
+
+
+def benchThroughput(packetSizes: typing.Iterable[int] = DEFAULT_PACKET_SIZES, packetsCount: int = 20000) -> typing.List[typing.Dict[str, typing.Any]]:
+	"""`wrap_into`/`unwrap_into` of `packetsCount` packets of each of `packetSizes` between 2 connected tunnels. The datagrams to unwrap are prepared beforehand, since BoringTun rejects replayed ones."""
+	t1, ot1, t2, ot2 = connectedTunnels()
+	res = []
+	try:
+		dst = bytearray(MAX_WIREGUARD_PACKET_SIZE)
+		for packetSize in packetSizes:
+			packet = ipv4Packet(packetSize)
+			packetSize = len(packet)
+
+			start = time.perf_counter()
+			for i in range(packetsCount):
+				ot1.wrap_into(packet, dst)
+			wrapTime = time.perf_counter() - start
+
+			datagrams = [ot1.wrap(packet).buf for i in range(packetsCount)]
+			errors = 0
+			start = time.perf_counter()
+			for d in datagrams:
+				errors += ot2.unwrap_into(d, dst)[0] != Opcode.WRITE_TO_TUNNEL_IPV4
+			unwrapTime = time.perf_counter() - start
+
+			res.append({"packetSize": packetSize, "packets": packetsCount, "unwrapErrors": errors, "wrap": _rates(packetsCount, packetSize, wrapTime), "unwrap": _rates(packetsCount, packetSize, unwrapTime)})
+	finally:
+		closeTunnels(t1, t2)
+	return res
+
+
+def benchTick(tunnelsCount: int = 100, rounds: int = 100) -> typing.Dict[str, typing.Union[int, float]]:
+	"""Ticks `tunnelsCount` connected tunnels `rounds` times, as a timer does every `timerWheel.TICK_INTERVAL`."""
+	pairs = [connectedTunnels() for i in range(tunnelsCount)]
+	try:
+		dst = bytearray(MAX_WIREGUARD_PACKET_SIZE)
+		openTunnels = [p[1] for p in pairs]
+		start = time.perf_counter()
+		for r in range(rounds):
+			for ot in openTunnels:
+				ot.tick_into(dst)
+		elapsed = time.perf_counter() - start
+	finally:
+		for t1, ot1, t2, ot2 in pairs:
+			closeTunnels(t1, t2)
+
+	return {"tunnels": tunnelsCount, "rounds": rounds, "seconds": elapsed, "nanosecondsPerTick": elapsed / (tunnelsCount * rounds) * 1e9, "millisecondsPerRound": elapsed / rounds * 1e3}
+
+
+class _EchoServerApp(asyncio.DatagramProtocol):
+	__slots__ = ("endpoint",)
+
+	def __init__(self) -> None:
+		self.endpoint = None
+
+	def connection_made(self, transport) -> None:
+		self.endpoint = transport
+
+	def datagram_received(self, data, addr) -> None:
+		self.endpoint.sendto(data, addr)
+
+
+class _EchoClientApp(asyncio.Protocol):
+	"""Keeps `window` packets in flight till `count` of them come back."""
+
+	__slots__ = ("packet", "count", "window", "sent", "received", "transport", "connected", "done")
+
+	def __init__(self, packet: bytes, count: int, window: int) -> None:
+		self.packet = packet
+		self.count = count
+		self.window = window
+		self.sent = 0
+		self.received = 0
+		self.transport = None
+		loop = asyncio.get_running_loop()
+		self.connected = loop.create_future()
+		self.done = loop.create_future()
+
+	def connection_made(self, transport) -> None:
+		self.transport = transport
+		self.connected.set_result(True)
+
+	def send(self) -> None:
+		while self.sent < self.count and self.sent - self.received < self.window:
+			self.transport.write(self.packet)
+			self.sent += 1
+
+	def datagram_received(self, data, addr) -> None:
+		self.received += 1
+		if self.received >= self.count:
+			if not self.done.done():
+				self.done.set_result(True)
+		else:
+			self.send()
+
+	def connection_lost(self, exc) -> None:
+		pass
+
+
+async def _loopback(packetSize: int, packetsCount: int, window: int, timeout: float) -> typing.Dict[str, typing.Any]:
+	from .asyncio import BoringTUNProtocol
+	from .endpoint import WireGuardEndpoint
+
+	t1, t2 = tunnelsPair()
+	server = WireGuardEndpoint(t2.interface, _EchoServerApp())
+	server.addPeer(t2.peer)
+	transport, _ = await server.listen(("127.0.0.1", 0))
+	t1.peer.ip = "127.0.0.1"
+	t1.peer.port = transport.get_extra_info("sockname")[1]
+
+	packet = ipv4Packet(packetSize)
+	app = _EchoClientApp(packet, packetsCount, window)
+	client, _ = await BoringTUNProtocol.createConnection(lambda: app, t1)
+	try:
+		await asyncio.wait_for(app.connected, timeout)
+		start = time.perf_counter()
+		app.send()
+		try:
+			await asyncio.wait_for(app.done, timeout)
+		except asyncio.TimeoutError:
+			pass  # some datagrams are lost, the rate is computed from the ones got back
+		elapsed = time.perf_counter() - start
+	finally:
+		client.transport.close()
+		server.close()
+
+	res = {"packetSize": len(packet), "packets": packetsCount, "window": window, "received": app.received}
+	res.update(_rates(app.received, len(packet), elapsed))
+	return res
+
+
+def benchLoopback(packetSizes: typing.Iterable[int] = DEFAULT_PACKET_SIZES, packetsCount: int = 5000, window: int = 64, timeout: float = 10) -> typing.List[typing.Dict[str, typing.Any]]:
+	"""End-to-end round trips through the asyncio stack over UDP on the loopback interface: `asyncio.BoringTUNProtocol` of a client sends the packets to `endpoint.WireGuardEndpoint`, which echoes them back. The throughput is of the echoed packets."""
+	return [asyncio.run(_loopback(packetSize, packetsCount, window, timeout)) for packetSize in packetSizes]
+
+
+async def _waitStreamConnected(stream) -> None:
+	while stream.tunnel is None:
+		await asyncio.sleep(0.001)
+
+
+async def _stream(chunkSize: int, totalBytes: int, noDelay: bool, window: int, timeout: float) -> typing.Dict[str, typing.Any]:
+	from .asyncio import open_wireguard_stream
+	from .endpoint import WireGuardEndpoint
+	from .tunnelStream import TunnelStream
+
+	t1, t2 = tunnelsPair()
+	loop = asyncio.get_running_loop()
+	sink = asyncio.StreamReader(loop=loop)
+	serverStream = TunnelStream(asyncio.StreamReaderProtocol(sink, loop=loop), peer=0)
+	server = WireGuardEndpoint(t2.interface, serverStream)
+	server.addPeer(t2.peer, 0)
+	transport, _ = await server.listen(("127.0.0.1", 0))
+	t1.peer.ip = "127.0.0.1"
+	t1.peer.port = transport.get_extra_info("sockname")[1]
+
+	received = 0
+
+	async def consume():
+		nonlocal received
+		while True:
+			data = await sink.read(0x100000)
+			if not data:
+				break
+			received += len(data)
+
+	chunk = bytes(chunkSize)
+	writes = totalBytes // chunkSize
+	reader, writer = await open_wireguard_stream(t1, noDelay=noDelay)
+	consumer = asyncio.create_task(consume())
+	try:
+		await asyncio.wait_for(_waitStreamConnected(writer.transport), timeout)
+		start = time.perf_counter()
+		stream = writer.transport
+		for i in range(writes):
+			writer.write(chunk)
+			# the receiver shares the event loop, the window keeps the datagrams within the buffer of its socket
+			while stream.framesSent - serverStream.framesReceived > window and not consumer.done():
+				await asyncio.sleep(0)
+		writer.write_eof()
+		try:
+			await asyncio.wait_for(consumer, timeout)
+		except (asyncio.TimeoutError, ConnectionError):
+			pass  # a frame is lost, the rate is computed from the data got before
+		elapsed = time.perf_counter() - start
+	finally:
+		consumer.cancel()
+		writer.close()
+		server.close()
+
+	framesReceived = max(serverStream.framesReceived, 1)
+	res = {"chunkSize": chunkSize, "noDelay": noDelay, "writes": writes, "frames": writer.transport.framesSent, "bytesPerFrame": received / framesReceived, "received": received}
+	res.update(_rates(framesReceived, received / framesReceived, elapsed))
+	return res
+
+
+def benchStream(chunkSizes: typing.Iterable[int] = DEFAULT_PACKET_SIZES, totalBytes: int = 1 << 22, window: int = 64, timeout: float = 10) -> typing.List[typing.Dict[str, typing.Any]]:
+	"""Bulk transfer through `asyncio.open_wireguard_stream` to a `tunnelStream.TunnelStream` of a `endpoint.WireGuardEndpoint` over UDP on the loopback interface, written in chunks of each size, with and without coalescing, with up to `window` frames in flight. `frames` shows the efficiency of the packets."""
+	return [asyncio.run(_stream(chunkSize, totalBytes, noDelay, window, timeout)) for chunkSize in chunkSizes for noDelay in (False, True)]
+
+
+def benchAllowedIPs(prefixesCount: int = 100000, packetsCount: int = 20000) -> typing.Dict[str, typing.Union[int, float]]:
+	"""Routing of packets by `allowedIPs.AllowedIPs` holding a /32 per peer, a /16 and a default route, like a hub. The destinations of the packets are random, so the half of them falls through to the shorter prefixes."""
+	import random
+	from ipaddress import IPv4Network
+
+	from .allowedIPs import AllowedIPs
+
+	base = 0x0A000000  # 10.0.0.0
+	table = AllowedIPs()
+	start = time.perf_counter()
+	for i in range(prefixesCount):
+		table.insert(IPv4Network((base + i, 32)), i)
+	insertElapsed = time.perf_counter() - start
+	table.insert("10.0.0.0/16", prefixesCount)
+	table.insert("0.0.0.0/0", prefixesCount + 1)
+
+	packets = []
+	for i in range(packetsCount):
+		packet = bytearray(ipv4Packet(64))
+		IPV4_HEADER.pack_into(packet, 0, 0x45, 0, len(packet), 0, 0x4000, 64, 17, 0, LOCALHOST, (base + random.randrange(2 * prefixesCount)).to_bytes(4, "big"))
+		packets.append(bytes(packet))
+
+	start = time.perf_counter()
+	for packet in packets:
+		table.route(packet)
+	routeElapsed = time.perf_counter() - start
+
+	start = time.perf_counter()
+	table.routeMany(packets)
+	routeManyElapsed = time.perf_counter() - start
+
+	return {"prefixes": len(table), "packets": packetsCount, "nanosecondsPerInsert": insertElapsed / prefixesCount * 1e9, "nanosecondsPerRoute": routeElapsed / packetsCount * 1e9, "nanosecondsPerRouteInBatch": routeManyElapsed / packetsCount * 1e9}
+
+
+def _backendHandshake(backend: ModuleType, initiator, responder) -> bool:
+	"""`handshake` done with the functions of a backend module directly."""
+	dst = bytearray(MAX_WIREGUARD_PACKET_SIZE)
+	opcode, size = backend.wireguard_force_handshake_into(initiator, dst)
+	for ptr in (responder, initiator, responder):
+		if opcode != Opcode.WRITE_TO_NETWORK:
+			return False
+		opcode, size = backend.wireguard_read_into(ptr, bytes(dst[:size]), dst)
+	return opcode == Opcode.WIREGUARD_DONE
+
+
+def benchBackends(packetSize: int = 64, packetsCount: int = 20000) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+	"""`wireguard_write_into` of small packets, for which the overhead of the binding is a large part of the cost, with each of the importable backends (see `backend`)."""
+	from .backend import BACKENDS, loadBackend
+
+	t1, t2 = tunnelsPair()
+	packet = ipv4Packet(packetSize)
+	dst = bytearray(MAX_WIREGUARD_PACKET_SIZE)
+	res = {}
+	for name in BACKENDS:
+		try:
+			name, backend = loadBackend(name)
+		except ImportError as ex:
+			res[name] = {"error": str(ex)}
+			continue
+
+		ptrs = [backend.new_tunnel(static_private=t.b64c.sec, server_static_public=t.b64c.pub, preshared_key=t.b64c.psk, keep_alive=0, index=0) for t in (t1, t2)]
+		try:
+			if not _backendHandshake(backend, *ptrs):
+				res[name] = {"error": "Handshake between the tunnels has failed"}
+				continue
+
+			start = time.perf_counter()
+			for i in range(packetsCount):
+				backend.wireguard_write_into(ptrs[0], packet, dst)
+			elapsed = time.perf_counter() - start
+		finally:
+			for ptr in ptrs:
+				if ptr is not None:
+					backend.tunnel_free(ptr)
+
+		r = res[name] = {"packetSize": len(packet), "packets": packetsCount, "nanosecondsPerCall": elapsed / packetsCount * 1e9}
+		r.update(_rates(packetsCount, len(packet), elapsed))
+	return res
+
+
+def _benchOffload(args) -> typing.List[typing.Dict[str, typing.Union[int, float]]]:
+	from .offload import benchmarkCrossover
+
+	return benchmarkCrossover(args.packetSizes)
+
+
+def benchReplay(path: str, speed: typing.Optional[float] = None) -> typing.Dict[str, typing.Any]:
+	"""Replays the plaintext of a capture of `capture.CaptureWriter`, see `capture.replay`."""
+	from .capture import CaptureReader, replay
+
+	with CaptureReader(path) as reader:
+		return replay(reader, speed)
+
+
+SUITES = {
+	"native": lambda args: nativeBenchmarks(),
+	"handshake": lambda args: benchHandshakes(args.handshakes),
+	"throughput": lambda args: benchThroughput(args.packetSizes, args.packets),
+	"tick": lambda args: benchTick(args.tunnels, args.rounds),
+	"open": lambda args: benchOpenMany(args.tunnels),
+	"loopback": lambda args: benchLoopback(args.packetSizes, args.loopbackPackets, args.window),
+	"offload": _benchOffload,
+	"backends": lambda args: benchBackends(min(args.packetSizes), args.packets),
+	"stream": lambda args: benchStream(args.packetSizes, args.streamBytes, args.window),
+	"allowedIPs": lambda args: benchAllowedIPs(packetsCount=args.packets),
+	"replay": lambda args: benchReplay(args.capture, args.replaySpeed),
+}
+NOT_BY_DEFAULT = ("offload", "replay")  # slow or needs a capture file
+
+
+def runSuites(args) -> typing.Dict[str, typing.Any]:
+	try:
+		from importlib.metadata import version
+
+		ourVersion = version("BoringTun")
+	except Exception:  # pylint:disable=broad-except
+		ourVersion = None
+
+	res = {
+		"version": ourVersion,
+		"python": platform.python_implementation() + " " + platform.python_version(),
+		"machine": platform.machine(),
+		"system": platform.system(),
+		"backend": BACKEND_NAME,
+		"time": time.time(),
+		"results": {},
+	}
+	for name in args.suites:
+		res["results"][name] = SUITES[name](args)
+	return res
+
+
+def _intsList(s: str) -> typing.List[int]:
+	return [int(el) for el in s.split(",") if el]
+
+
+def _suitesList(s: str) -> typing.List[str]:
+	res = [el for el in s.split(",") if el]
+	for el in res:
+		if el not in SUITES:
+			raise ValueError(el)
+	return res
+
+
+def main(argv: typing.Optional[typing.Sequence[str]] = None) -> None:
+	p = ArgumentParser(prog="python -m BoringTun.bench", description=__doc__)
+	p.add_argument("--suites", type=_suitesList, default=[el for el in SUITES if el not in NOT_BY_DEFAULT], help="Comma-separated, from: " + ", ".join(SUITES) + ". All but " + ", ".join("`" + el + "`" for el in NOT_BY_DEFAULT) + " by default.")
+	p.add_argument("--packet-sizes", dest="packetSizes", type=_intsList, default=list(DEFAULT_PACKET_SIZES))
+	p.add_argument("--packets", type=int, default=20000, help="Packets per size for `throughput`")
+	p.add_argument("--handshakes", type=int, default=200)
+	p.add_argument("--tunnels", type=int, default=100, help="Tunnels for `tick` and `open`")
+	p.add_argument("--rounds", type=int, default=100, help="Rounds of ticking all the tunnels")
+	p.add_argument("--loopback-packets", dest="loopbackPackets", type=int, default=5000)
+	p.add_argument("--window", type=int, default=64, help="Packets in flight for `loopback` and `stream`")
+	p.add_argument("--stream-bytes", dest="streamBytes", type=int, default=1 << 22, help="Bytes per chunk size for `stream`")
+	p.add_argument("--capture", default=None, help="A capture file of `capture.CaptureWriter` for `replay`")
+	p.add_argument("--replay-speed", dest="replaySpeed", type=float, default=None, help="Replays at the recorded timing accelerated by this factor, as fast as possible by default")
+	p.add_argument("-o", "--output", default=None, help="File to write the JSON to, stdout by default")
+	args = p.parse_args(argv)
+
+	res = runSuites(args)
+	if args.output is None:
+		json.dump(res, sys.stdout, indent="\t")
+		sys.stdout.write("\n")
+	else:
+		with open(args.output, "wt", encoding="utf-8") as f:
+			json.dump(res, f, indent="\t")
+
+
+if __name__ == "__main__":
+	main()
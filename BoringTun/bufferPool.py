@@ -0,0 +1,34 @@
+__all__ = ("BufferPool",)
+
+from collections import deque
+
+# pylint:disable=too-few-public-methods
+
+
+class BufferPool:
+	"""A bounded pool of scratch buffers of the same size.
+	Buffers released when the pool is full are just dropped and left for GC, so the memory retained by an idle pool is bounded by `maxSize * bufferSize`.
+	`acquire` and `release` are atomic (`deque` methods), so a pool can be shared between threads."""
+
+	__slots__ = ("bufferSize", "maxSize", "free")
+
+	def __init__(self, bufferSize: int, maxSize: int = 4) -> None:
+		self.bufferSize = bufferSize
+		self.maxSize = maxSize
+		self.free = deque()
+
+	def acquire(self) -> bytearray:
+		try:
+			return self.free.pop()
+		except IndexError:
+			return bytearray(self.bufferSize)
+
+	def release(self, buf: bytearray) -> None:
+		if len(self.free) < self.maxSize:
+			self.free.append(buf)
+
+	def __len__(self) -> int:
+		return len(self.free)
+
+	def __repr__(self):
+		return self.__class__.__name__ + "(" + repr(self.bufferSize) + ", maxSize=" + repr(self.maxSize) + ", free=" + repr(len(self.free)) + ")"
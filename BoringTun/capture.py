@@ -0,0 +1,367 @@
+"""Capture of the traffic of tunnels and its replay through a pair of tunnels in memory, for benchmarking with real traffic mixes offline.
+A capture file is a header followed by the records, each being a fixed-size header (the time in ns since the start of the capture, the size of the payload, the stream and the kind) and the payload padded to 8 bytes, so a file is read by `mmap` without copying the payloads.
+Capturing is enabled per object by swapping its class, like `metrics` does, so the objects not captured pay nothing. Enable the metrics of an object before capturing it."""
+
+__all__ = ("RecordKind", "Record", "CaptureWriter", "CaptureReader", "CaptureTap", "startCapture", "stopCapture", "captures", "replay")
+
+import mmap
+import struct
+import threading
+import time
+import typing
+from array import array
+from enum import IntEnum
+from pathlib import Path
+
+from .Tunnel import Action, BatchResult, Opcode, OpenTunnel
+
+FILE_MAGIC = b"BTUNCAP\x01"
+FILE_HEADER = struct.Struct("<8sQ")  # the magic and the wall clock time of the start in ns
+RECORD_HEADER = struct.Struct("<QIHBx")
+RECORD_ALIGNMENT = 8
+PADDING = bytes(RECORD_ALIGNMENT)
+
+LATENCY_PERCENTILES = (50, 90, 99, 99.9)
+
+
+class RecordKind(IntEnum):
+	PLAINTEXT_OUT = 1  # given to the tunnel to be encrypted
+	CIPHERTEXT_OUT = 2  # produced by the tunnel for the network
+	CIPHERTEXT_IN = 3  # given to the tunnel from the network
+	PLAINTEXT_IN = 4  # decrypted by the tunnel
+
+
+class Record(typing.NamedTuple):
+	timestamp: int  # ns since the start of the capture
+	kind: RecordKind
+	stream: int
+	payload: memoryview
+
+
+class CaptureWriter:
+	"""Appends the records to `file` (a path or a binary file). It is thread-safe, since the tunnels offloaded to the executors of `offload` are used from their threads."""
+
+	__slots__ = ("file", "ownsFile", "origin", "lock", "recordsCount", "payloadBytes")
+
+	def __init__(self, file: typing.Union[str, Path, typing.BinaryIO]) -> None:
+		if isinstance(file, (str, Path)):
+			file = open(file, "wb")  # pylint:disable=consider-using-with
+			self.ownsFile = True
+		else:
+			self.ownsFile = False
+
+		self.file = file
+		self.lock = threading.Lock()
+		self.recordsCount = 0
+		self.payloadBytes = 0
+		self.file.write(FILE_HEADER.pack(FILE_MAGIC, time.time_ns()))
+		self.origin = time.perf_counter_ns()
+
+	def write(self, kind: RecordKind, payload: typing.Union[bytes, bytearray, memoryview], stream: int = 0, timestamp: typing.Optional[int] = None) -> None:
+		"""`timestamp` is in ns since the start of the capture, now by default."""
+		if timestamp is None:
+			timestamp = time.perf_counter_ns() - self.origin
+		size = len(payload)
+		header = RECORD_HEADER.pack(timestamp, size, stream, kind)
+		padding = -size % RECORD_ALIGNMENT
+		with self.lock:
+			self.file.write(header)
+			self.file.write(payload)
+			if padding:
+				self.file.write(PADDING[:padding])
+			self.recordsCount += 1
+			self.payloadBytes += size
+
+	def tap(self, stream: int = 0) -> "CaptureTap":
+		return CaptureTap(self, stream)
+
+	def flush(self) -> None:
+		with self.lock:
+			self.file.flush()
+
+	def close(self) -> None:
+		with self.lock:
+			if self.ownsFile:
+				self.file.close()
+			else:
+				self.file.flush()
+
+	def __enter__(self) -> "CaptureWriter":
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback) -> None:
+		self.close()
+
+	def __repr__(self):
+		return self.__class__.__name__ + "<" + repr(self.recordsCount) + " records, " + repr(self.payloadBytes) + " bytes>"
+
+
+class CaptureTap:
+	"""A `CaptureWriter` bound to a stream (i.e. to a tunnel), it is what a captured object holds in its `capture` slot."""
+
+	__slots__ = ("writer", "stream")
+
+	def __init__(self, writer: CaptureWriter, stream: int = 0) -> None:
+		self.writer = writer
+		self.stream = stream
+
+	def record(self, kind: RecordKind, payload: typing.Union[bytes, bytearray, memoryview]) -> None:
+		self.writer.write(kind, payload, self.stream)
+
+	def recordResult(self, opcode: Opcode, payload: typing.Union[bytes, bytearray, memoryview]) -> None:
+		"""Records the output of a tunnel operation, if it is a packet."""
+		if opcode == Opcode.WRITE_TO_NETWORK:
+			self.writer.write(RecordKind.CIPHERTEXT_OUT, payload, self.stream)
+		elif opcode == Opcode.WRITE_TO_TUNNEL_IPV4 or opcode == Opcode.WRITE_TO_TUNNEL_IPV6:
+			self.writer.write(RecordKind.PLAINTEXT_IN, payload, self.stream)
+
+	def recordBatch(self, kind: RecordKind, packets: typing.Union[typing.Sequence[bytes], bytes, bytearray, memoryview], offsets: typing.Optional[typing.Sequence[int]], sizes: typing.Optional[typing.Sequence[int]]) -> None:
+		"""Records the inputs of a batched operation, given in any of the forms `OpenTunnel.wrap_many` accepts."""
+		if offsets is None:
+			for packet in packets:
+				self.record(kind, packet)
+			return
+
+		with memoryview(packets) as view:
+			if sizes is None:
+				for i in range(len(offsets) - 1):
+					self.record(kind, view[offsets[i] : offsets[i + 1]])
+			else:
+				for offset, size in zip(offsets, sizes):
+					self.record(kind, view[offset : offset + size])
+
+	def recordBatchResult(self, res: BatchResult) -> None:
+		for opcode, out in res:
+			if out is not None:
+				self.recordResult(opcode, out)
+
+	def __repr__(self):
+		return self.__class__.__name__ + "<" + repr(self.stream) + ", " + repr(self.writer) + ">"
+
+
+class CaptureReader:
+	"""Reads a capture file through `mmap`. The payloads of the records are views into the mapping, they must be dropped before `close`."""
+
+	__slots__ = ("file", "map", "view", "startTime")
+
+	def __init__(self, path: typing.Union[str, Path]) -> None:
+		self.file = open(path, "rb")  # pylint:disable=consider-using-with
+		try:
+			# copy-on-write, so the payloads are writable buffers which `ctypes` points to without copying, the file is never modified
+			self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_COPY)
+		except BaseException:
+			self.file.close()
+			raise
+
+		self.view = memoryview(self.map)
+		if len(self.view) < FILE_HEADER.size:
+			self.close()
+			raise ValueError("Not a capture file: too short", path)
+		magic, self.startTime = FILE_HEADER.unpack_from(self.view)
+		if magic != FILE_MAGIC:
+			self.close()
+			raise ValueError("Not a capture file: wrong magic", path, magic)
+
+	def __iter__(self) -> typing.Iterator[Record]:
+		view = self.view
+		end = len(view)
+		pos = FILE_HEADER.size
+		while pos + RECORD_HEADER.size <= end:
+			timestamp, size, stream, kind = RECORD_HEADER.unpack_from(view, pos)
+			start = pos + RECORD_HEADER.size
+			if start + size > end:
+				break  # truncated by a crash of the writer
+			yield Record(timestamp, RecordKind(kind), stream, view[start : start + size])
+			pos = start + size + (-size % RECORD_ALIGNMENT)
+
+	def close(self) -> None:
+		self.view.release()
+		self.map.close()
+		self.file.close()
+
+	def __enter__(self) -> "CaptureReader":
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback) -> None:
+		self.close()
+
+
+CAPTURE_MIXINS = {}
+CAPTURING_CLASSES = {}
+UNCAPTURED_CLASSES = {}
+
+
+def captures(baseClass: type) -> typing.Callable[[type], type]:
+	"""Registers the decorated mixin (with `__slots__ = ()`) as the capturing layer of `baseClass` and its subclasses (i.e. the instrumented ones of `metrics`). The base must have the `capture` slot. The mixin may define `_captureStarted` and `_captureStopped` hooks."""
+
+	def decorator(cls: type) -> type:
+		CAPTURE_MIXINS[baseClass] = cls
+		return cls
+
+	return decorator
+
+
+def _capturingClass(cls: type) -> type:
+	res = CAPTURING_CLASSES.get(cls)
+	if res is not None:
+		return res
+
+	for base in cls.__mro__:
+		mixin = CAPTURE_MIXINS.get(base)
+		if mixin is not None:
+			break
+	else:
+		raise TypeError("No capturing version of the class", cls)
+
+	res = CAPTURING_CLASSES[cls] = type("Capturing" + cls.__name__, (mixin, cls), {"__slots__": ()})
+	UNCAPTURED_CLASSES[res] = cls
+	return res
+
+
+def startCapture(obj, writer: CaptureWriter, stream: int = 0) -> CaptureTap:
+	"""Records the traffic of an `OpenTunnel` or an `asyncio.BoringTUNProtocol` (its tunnel, including the ones it opens later) into `writer` as `stream`."""
+	obj.capture = writer.tap(stream)
+	cls = type(obj)
+	if cls not in UNCAPTURED_CLASSES:
+		obj.__class__ = _capturingClass(cls)
+	hook = getattr(obj, "_captureStarted", None)
+	if hook is not None:
+		hook()
+	return obj.capture
+
+
+def stopCapture(obj) -> None:
+	cls = UNCAPTURED_CLASSES.get(type(obj))
+	if cls is None:
+		return
+
+	hook = getattr(obj, "_captureStopped", None)
+	if hook is not None:
+		hook()
+	obj.__class__ = cls
+	obj.capture = None
+
+
+@captures(OpenTunnel)
+class OpenTunnelCaptureMixin:
+	__slots__ = ()
+
+	def wrap(self, src: bytes) -> Action:
+		self.capture.record(RecordKind.PLAINTEXT_OUT, src)
+		res = super().wrap(src)
+		self.capture.recordResult(res.opcode, res.buf)
+		return res
+
+	def unwrap(self, src: bytes) -> Action:
+		if src:  # the empty ones only flush the queue of the tunnel
+			self.capture.record(RecordKind.CIPHERTEXT_IN, src)
+		res = super().unwrap(src)
+		self.capture.recordResult(res.opcode, res.buf)
+		return res
+
+	def wrap_into(self, src: bytes, dst: bytearray) -> typing.Tuple[Opcode, int]:
+		self.capture.record(RecordKind.PLAINTEXT_OUT, src)
+		opcode, size = super().wrap_into(src, dst)
+		self.capture.recordResult(opcode, memoryview(dst)[:size])
+		return opcode, size
+
+	def unwrap_into(self, src: bytes, dst: bytearray) -> typing.Tuple[Opcode, int]:
+		if src:
+			self.capture.record(RecordKind.CIPHERTEXT_IN, src)
+		opcode, size = super().unwrap_into(src, dst)
+		self.capture.recordResult(opcode, memoryview(dst)[:size])
+		return opcode, size
+
+	def wrap_many(self, packets, offsets=None, sizes=None) -> BatchResult:
+		self.capture.recordBatch(RecordKind.PLAINTEXT_OUT, packets, offsets, sizes)
+		res = super().wrap_many(packets, offsets, sizes)
+		self.capture.recordBatchResult(res)
+		return res
+
+	def unwrap_many(self, datagrams, offsets=None, sizes=None) -> BatchResult:
+		self.capture.recordBatch(RecordKind.CIPHERTEXT_IN, datagrams, offsets, sizes)
+		res = super().unwrap_many(datagrams, offsets, sizes)
+		self.capture.recordBatchResult(res)
+		return res
+
+	def tick(self) -> Action:
+		res = super().tick()
+		self.capture.recordResult(res.opcode, res.buf)
+		return res
+
+	def force_handshake(self) -> Action:
+		res = super().force_handshake()
+		self.capture.recordResult(res.opcode, res.buf)
+		return res
+
+
+def _percentiles(latencies: array) -> typing.Dict[str, int]:
+	values = sorted(latencies)
+	if not values:
+		return {}
+
+	res = {"p" + format(p, "g"): values[min(len(values) - 1, int(len(values) * p / 100))] for p in LATENCY_PERCENTILES}
+	res["max"] = values[-1]
+	return res
+
+
+def replay(records: typing.Iterable[Record], speed: typing.Optional[float] = None, streams: typing.Optional[typing.Container[int]] = None) -> typing.Dict[str, typing.Any]:
+	"""Drives the plaintext of a capture through pairs of connected tunnels in memory, a pair per stream: the outbound packets are wrapped by the first tunnel of a pair and unwrapped by the second one, the inbound ones the other way around. The ciphertext can't be replayed, since it is bound to the keys and the counters of the captured session.
+	The packets go as fast as possible or, if `speed` is given, at the recorded timing accelerated by it. The latency of a packet is the time of wrapping and unwrapping it, in ns."""
+	from .bench import closeTunnels, connectedTunnels
+
+	pairs = {}
+	latencies = array("Q")
+	packets = errors = payloadBytes = 0
+	clock = time.perf_counter_ns
+	try:
+		start = clock()
+		for record in records:
+			if record.kind == RecordKind.PLAINTEXT_OUT:
+				isOutbound = True
+			elif record.kind == RecordKind.PLAINTEXT_IN:
+				isOutbound = False
+			else:
+				continue
+			if streams is not None and record.stream not in streams:
+				continue
+
+			pair = pairs.get(record.stream)
+			if pair is None:
+				pair = pairs[record.stream] = connectedTunnels()
+			src, dst = (pair[1], pair[3]) if isOutbound else (pair[3], pair[1])
+
+			if speed is not None:
+				delay = start + int(record.timestamp / speed) - clock()
+				if delay > 0:
+					time.sleep(delay / 1e9)
+
+			packetStart = clock()
+			wrapped = src.wrap(record.payload)
+			if wrapped.opcode == Opcode.WRITE_TO_NETWORK:
+				unwrapped = dst.unwrap(wrapped.buf)
+				ok = unwrapped.opcode == Opcode.WRITE_TO_TUNNEL_IPV4 or unwrapped.opcode == Opcode.WRITE_TO_TUNNEL_IPV6
+				unwrapped.release()
+			else:
+				ok = False
+			wrapped.release()
+			latencies.append(clock() - packetStart)
+
+			packets += 1
+			payloadBytes += len(record.payload)
+			errors += not ok
+		elapsed = (clock() - start) / 1e9
+	finally:
+		for pair in pairs.values():
+			closeTunnels(pair[0], pair[2])
+
+	return {
+		"packets": packets,
+		"streams": len(pairs),
+		"errors": errors,
+		"bytes": payloadBytes,
+		"seconds": elapsed,
+		"packetsPerSecond": packets / elapsed if elapsed else None,
+		"megabitsPerSecond": payloadBytes * 8 / elapsed / 1e6 if elapsed else None,
+		"latencyNs": _percentiles(latencies),
+	}
@@ -0,0 +1,158 @@
+"""The functions of `tunnelMiddleLevel` implemented with `cffi` in ABI mode. The calls are cheaper than ones through `ctypes`: the arguments are not converted by Python-level `argtypes`, the buffers are passed with `ffi.from_buffer` without creating ctypes arrays and the results are returned by value without `Structure` instances.
+If the out-of-line module built by `python -m BoringTun.cffiBackend` is present, it is used, saving parsing of the declarations at import."""
+
+__all__ = ("CDEF", "ffi", "new_tunnel", "tunnel_free", "wireguard_write_into", "wireguard_read_into", "wireguard_tick_into", "wireguard_force_handshake_into", "wireguard_write_many", "wireguard_read_many", "wireguard_stats", "buildOutOfLineModule")
+
+import threading
+import typing
+from array import array
+from pathlib import Path
+
+from .ctypes import Opcode, getLib
+from .tunnelMiddleLevel import BatchResult, planBatch
+
+CDEF = """
+struct wireguard_result {
+	int op;
+	size_t size;
+};
+
+struct stats {
+	int64_t time_since_last_handshake;
+	size_t tx_bytes;
+	size_t rx_bytes;
+	float estimated_loss;
+	int32_t estimated_rtt;
+	uint8_t reserved[56];
+};
+
+void *new_tunnel(const char *static_private, const char *server_static_public, const char *preshared_key, uint16_t keep_alive, uint32_t index);
+void tunnel_free(void *tunnel);
+struct wireguard_result wireguard_write(const void *tunnel, const uint8_t *src, uint32_t src_size, uint8_t *dst, uint32_t dst_size);
+struct wireguard_result wireguard_read(const void *tunnel, const uint8_t *src, uint32_t src_size, uint8_t *dst, uint32_t dst_size);
+struct wireguard_result wireguard_tick(const void *tunnel, uint8_t *dst, uint32_t dst_size);
+struct wireguard_result wireguard_force_handshake(const void *tunnel, uint8_t *dst, uint32_t dst_size);
+struct stats wireguard_stats(const void *tunnel);
+"""
+
+OUT_OF_LINE_MODULE_NAME = "_boringtun_cffi"
+
+try:
+	from ._boringtun_cffi import ffi  # pylint:disable=import-error
+except ImportError:
+	from cffi import FFI
+
+	ffi = FFI()
+	ffi.cdef(CDEF)
+
+_libLock = threading.Lock()
+
+
+class _LazyLib:
+	"""Opens the library, found the same way as in `ctypes.getLib`, on the first access and replaces itself with it."""
+
+	__slots__ = ()
+
+	def __getattr__(self, name: str):
+		global lib  # pylint:disable=global-statement
+
+		with _libLock:
+			if lib is self:
+				lib = ffi.dlopen(getLib()._name)  # pylint:disable=protected-access
+		return getattr(lib, name)
+
+
+lib = _LazyLib()
+
+NULL = ffi.NULL
+from_buffer = ffi.from_buffer
+
+
+def new_tunnel(static_private: bytes, server_static_public: bytes, preshared_key: typing.Optional[bytes], keep_alive: int, index: int) -> typing.Any:
+	"""Returns `None` on failure, like the `ctypes` one."""
+	res = lib.new_tunnel(static_private, server_static_public, NULL if preshared_key is None else preshared_key, keep_alive, index)
+	if res == NULL:
+		return None
+	return res
+
+
+def tunnel_free(tunnel) -> None:
+	lib.tunnel_free(tunnel)
+
+
+def wireguard_write_into(tunnel, src: typing.Union[bytes, bytearray, memoryview], dst: typing.Union[bytearray, memoryview]) -> typing.Tuple[Opcode, int]:
+	srcBuf = from_buffer(src)
+	dstBuf = from_buffer(dst, require_writable=True)
+	res = lib.wireguard_write(tunnel, srcBuf, len(srcBuf), dstBuf, len(dstBuf))
+	return Opcode(res.op), res.size
+
+
+def wireguard_read_into(tunnel, src: typing.Union[bytes, bytearray, memoryview], dst: typing.Union[bytearray, memoryview]) -> typing.Tuple[Opcode, int]:
+	srcBuf = from_buffer(src)
+	dstBuf = from_buffer(dst, require_writable=True)
+	res = lib.wireguard_read(tunnel, srcBuf, len(srcBuf), dstBuf, len(dstBuf))
+	return Opcode(res.op), res.size
+
+
+def wireguard_tick_into(tunnel, dst: typing.Union[bytearray, memoryview]) -> typing.Tuple[Opcode, int]:
+	dstBuf = from_buffer(dst, require_writable=True)
+	res = lib.wireguard_tick(tunnel, dstBuf, len(dstBuf))
+	return Opcode(res.op), res.size
+
+
+def wireguard_force_handshake_into(tunnel, dst: typing.Union[bytearray, memoryview]) -> typing.Tuple[Opcode, int]:
+	dstBuf = from_buffer(dst, require_writable=True)
+	res = lib.wireguard_force_handshake(tunnel, dstBuf, len(dstBuf))
+	return Opcode(res.op), res.size
+
+
+def decorateBatchTransformer(symbolName: str) -> typing.Callable:
+	def batchTransformer(tunnel, packets: typing.Union[typing.Sequence[bytes], bytes, bytearray, memoryview], offsets: typing.Optional[typing.Sequence[int]] = None, sizes: typing.Optional[typing.Sequence[int]] = None) -> BatchResult:
+		"""See `tunnelMiddleLevel.decorateBatchTransformer`."""
+		count, srcSizes, slotSizes, outOffsets, arenaSize = planBatch(packets, offsets, sizes)
+		func = getattr(lib, symbolName)
+
+		arena = bytearray(arenaSize)
+		arenaRef = from_buffer(arena, require_writable=True)
+		arenaBuf = ffi.cast("uint8_t *", arenaRef)
+		# a cast pointer doesn't keep the buffer exported, the `*Ref`s do
+		srcRef = from_buffer(packets) if offsets is not None else None
+		srcBuf = ffi.cast("uint8_t *", srcRef) if srcRef is not None else None
+		opcodes = array("I", outOffsets)
+		sizes = array("I", outOffsets)
+
+		for i in range(count):
+			src = from_buffer(packets[i]) if srcBuf is None else srcBuf + offsets[i]
+			res = func(tunnel, src, srcSizes[i], arenaBuf + outOffsets[i], slotSizes[i])
+			opcodes[i] = res.op
+			sizes[i] = res.size
+
+		del arenaRef, srcRef
+		return BatchResult(arena, opcodes, sizes, outOffsets)
+
+	batchTransformer.__name__ = symbolName + "_many"
+
+	return batchTransformer
+
+
+wireguard_write_many = decorateBatchTransformer("wireguard_write")
+wireguard_read_many = decorateBatchTransformer("wireguard_read")
+
+
+def wireguard_stats(tunnel) -> typing.Any:
+	"""Returns a `struct stats` cdata, having the same fields as `ctypes.stats`."""
+	return lib.wireguard_stats(tunnel)
+
+
+def buildOutOfLineModule() -> None:
+	"""Generates the out-of-line ABI-mode module with the declarations already parsed, next to this file."""
+	from cffi import FFI
+
+	builder = FFI()
+	builder.cdef(CDEF)
+	builder.set_source(__package__ + "." + OUT_OF_LINE_MODULE_NAME, None)
+	builder.compile(tmpdir=str(Path(__file__).parent.parent))
+
+
+if __name__ == "__main__":
+	buildOutOfLineModule()
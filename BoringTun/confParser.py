@@ -0,0 +1,133 @@
+"""A streaming parser of WireGuard configs (in the format of `wg` and `wg-quick`). The file is read through `mmap` when possible, so big configs are not read into memory at once. The `[Peer]` sections are yielded as they are read, their public keys are validated and decoded in batches by `Key.decode_base64_many`."""
+
+__all__ = ("iterLines", "iterSections", "iterPeers", "parseConfig", "readConfig")
+
+import mmap
+import typing
+from contextlib import contextmanager
+from pathlib import Path
+
+from .config import Interface, Peer, PeerTable, WGConfig, parseCfgEntry
+from .KeyPair import KEY_SIZE, Key, PublicKey, check_base64_encoded_x25519_key
+
+DEFAULT_BATCH_SIZE = 1024
+
+CANONICAL_KEYS = {k.lower(): k for k in ("PrivateKey", "ListenPort", "FwMark", "Address", "DNS", "MTU", "Table", "PreUp", "PostUp", "PreDown", "PostDown", "SaveConfig", "PublicKey", "PresharedKey", "AllowedIPs", "Endpoint", "PersistentKeepalive")}
+MULTI_VALUED_KEYS = frozenset(("Address", "DNS", "AllowedIPs", "PreUp", "PostUp", "PreDown", "PostDown"))
+
+Section = typing.Tuple[int, str, typing.Dict[str, str]]
+
+
+@contextmanager
+def iterLines(path: typing.Union[Path, str]) -> typing.Iterator[typing.Iterator[bytes]]:
+	"""Opens the file and gives an iterator of its lines, read from `mmap` if possible."""
+	with open(path, "rb") as f:
+		try:
+			mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		except (ValueError, OSError):
+			# empty files and the ones not supporting mapping
+			yield iter(f)
+			return
+
+		with mm:
+			yield iter(mm.readline, b"")
+
+
+def iterSections(lines: typing.Iterable[bytes]) -> typing.Iterator[Section]:
+	"""Yields `(line number of the header, section name, entries)`. The keys are case-insensitive, so they are canonicalized; the repeated values of the keys like `AllowedIPs` are joined with commas, as `wg-quick` does."""
+	name = None
+	entries = None
+	start = 0
+	for lineNo, line in enumerate(lines, 1):
+		line = line.split(b"#", 1)[0].strip()
+		if not line:
+			continue
+
+		if line[:1] == b"[":
+			if line[-1:] != b"]":
+				raise ValueError("Malformed section header at line " + str(lineNo), line)
+			if name is not None:
+				yield start, name, entries
+			name = line[1:-1].strip().decode("utf-8")
+			entries = {}
+			start = lineNo
+			continue
+
+		key, sep, value = line.partition(b"=")
+		if not sep or name is None:
+			raise ValueError("Expected `Key = Value` within a section at line " + str(lineNo), line)
+
+		key = key.strip().decode("utf-8")
+		key = CANONICAL_KEYS.get(key.lower(), key)
+		value = value.strip().decode("utf-8")
+		if key in entries and key in MULTI_VALUED_KEYS:
+			entries[key] += ", " + value
+		else:
+			entries[key] = value
+
+	if name is not None:
+		yield start, name, entries
+
+
+def _decodeBatch(batch: typing.List[typing.Tuple[int, typing.Dict[str, str]]]) -> typing.Iterator[typing.Tuple[int, typing.Dict[str, str], bytes]]:
+	try:
+		keys = Key.decode_base64_many([entries["PublicKey"] for lineNo, entries in batch])
+	except (KeyError, ValueError):
+		# locating the culprit, it is rare, so it is done only on failure
+		for lineNo, entries in batch:
+			pub = entries.get("PublicKey")
+			if pub is None:
+				raise ValueError("No `PublicKey` in the `[Peer]` at line " + str(lineNo)) from None
+			if not check_base64_encoded_x25519_key(pub):
+				raise ValueError("Invalid `PublicKey` in the `[Peer]` at line " + str(lineNo), pub) from None
+		raise
+
+	for i, (lineNo, entries) in enumerate(batch):
+		yield lineNo, entries, bytes(keys[i * KEY_SIZE : (i + 1) * KEY_SIZE])
+
+
+def iterPeers(sections: typing.Iterable[typing.Tuple[int, typing.Dict[str, str]]], batchSize: int = DEFAULT_BATCH_SIZE) -> typing.Iterator[typing.Tuple[int, typing.Dict[str, str], bytes]]:
+	"""Takes `(line number, entries)` of `[Peer]` sections, yields `(line number, entries, decoded public key)`, validating the keys in batches of `batchSize`."""
+	batch = []
+	for el in sections:
+		batch.append(el)
+		if len(batch) >= batchSize:
+			yield from _decodeBatch(batch)
+			batch = []
+
+	if batch:
+		yield from _decodeBatch(batch)
+
+
+def parseConfig(lines: typing.Iterable[bytes], table: bool = False, batchSize: int = DEFAULT_BATCH_SIZE) -> WGConfig:
+	"""Parses the config from its lines. If `table` is set, the peers are put into a `PeerTable`, otherwise into a list of `Peer`s. The sections other than `[Interface]` and `[Peer]` are ignored."""
+	interfaces = []
+
+	def peerSections() -> typing.Iterator[typing.Tuple[int, typing.Dict[str, str]]]:
+		for lineNo, name, entries in iterSections(lines):
+			if name == "Interface":
+				interfaces.append(entries)
+			elif name == "Peer":
+				yield lineNo, entries
+
+	peers = PeerTable() if table else []
+	for lineNo, entries, pub in iterPeers(peerSections(), batchSize):
+		try:
+			fields = parseCfgEntry(entries, pub)
+			if table:
+				peers.append(*fields)
+			else:
+				pub, ip, port, psk, keepAliveTimeout, allowedIPs = fields
+				peers.append(Peer(pub=PublicKey.fromKeyBytes(pub), ip=ip, port=port, psk=psk, keepAliveTimeout=keepAliveTimeout, allowedIPs=allowedIPs))
+		except (KeyError, ValueError) as ex:
+			raise ValueError("Invalid `[Peer]` at line " + str(lineNo), *ex.args) from ex
+
+	if len(interfaces) != 1:
+		raise ValueError("Config must have exactly one `[Interface]` section", len(interfaces))
+
+	return WGConfig(Interface.fromCfgEntry(interfaces[0]), peers)
+
+
+def readConfig(path: typing.Union[Path, str], table: bool = False, batchSize: int = DEFAULT_BATCH_SIZE) -> WGConfig:
+	with iterLines(path) as lines:
+		return parseConfig(lines, table, batchSize)
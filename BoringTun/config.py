@@ -1,10 +1,13 @@
 import typing
-from ipaddress import ip_address
+from array import array
+from base64 import b64decode
+from ipaddress import IPv4Address, IPv6Address, ip_address
 from pathlib import Path
 
-from .KeyPair import PublicKey, SecretKey
+from .allowedIPs import Network, parseAllowedIPs, toNetwork
+from .KeyPair import KEY_SIZE, PublicKey, SecretKey, check_base64_encoded_x25519_key
 
-__all__ = ("Interface", "Peer", "WGConfig")
+__all__ = ("Interface", "Peer", "PeerTable", "PeerView", "WGConfig")
 
 
 class Interface:
@@ -21,28 +24,213 @@ class Interface:
 
 
 DEFAULT_KEEPALIVE_TIMEOUT = 10
+NO_KEEPALIVE = 0  # how `PeerTable` stores `keepAliveTimeout=None`, it is also what BoringTun takes for no keepalive
 
 
 class Peer:
-	__slots__ = ("pub", "psk", "ip", "port", "keepAliveTimeout")
+	__slots__ = ("pub", "psk", "ip", "port", "keepAliveTimeout", "allowedIPs")
 
-	def __init__(self, pub: PublicKey, ip: ip_address, port: int, psk: str = None, keepAliveTimeout: int = DEFAULT_KEEPALIVE_TIMEOUT):
+	def __init__(self, pub: PublicKey, ip: ip_address, port: int, psk: str = None, keepAliveTimeout: int = DEFAULT_KEEPALIVE_TIMEOUT, allowedIPs: typing.Iterable[typing.Union[Network, str]] = ()):
+		"""`allowedIPs` are the prefixes routed to the peer, see `allowedIPs.AllowedIPs`."""
 		self.pub = pub
 		self.psk = psk
 		self.ip = ip
 		self.port = port
 		self.keepAliveTimeout = keepAliveTimeout
+		self.allowedIPs = tuple(toNetwork(el) for el in allowedIPs)
 
 	@classmethod
 	def fromCfgEntry(cls, e) -> "Peer":
-		pub = PublicKey.fromBase64(e["PublicKey"])
-		ip, port = e["Endpoint"].split(":")
-		psk = e.get("PresharedKey", None)
-		#e['AllowedIPs']
+		pub, ip, port, psk, keepAliveTimeout, allowedIPs = parseCfgEntry(e)
+		return cls(pub=PublicKey.fromKeyBytes(pub), ip=ip, port=port, psk=psk, keepAliveTimeout=keepAliveTimeout, allowedIPs=allowedIPs)
+
+
+def parseCfgEntry(e, pub: typing.Optional[bytes] = None) -> typing.Tuple[bytes, typing.Optional[typing.Union[IPv4Address, IPv6Address]], typing.Optional[int], typing.Optional[str], int, typing.Tuple[Network, ...]]:
+	"""Returns the raw public key, the IP, the port, the pre-shared key, the keepalive timeout and the allowed IPs of a `[Peer]` entry. The endpoint is optional, i.e. the peers of a hub usually have none. `pub` is the already decoded public key, if it is given, `PublicKey` is not checked."""
+	if pub is None:
+		pubB64 = e["PublicKey"]
+		if not check_base64_encoded_x25519_key(pubB64):
+			raise ValueError("The key base64 provided is neither a valid public nor private key", pubB64)
+		pub = b64decode(pubB64)
+
+	endpoint = e.get("Endpoint")
+	if endpoint is not None:
+		ip, port = endpoint.rsplit(":", 1)
+		ip = ip_address(ip.strip("[]"))
 		port = int(port)
-		ip = ip_address(ip)
-		keepAliveTimeout = e.get("PersistentKeepalive", DEFAULT_KEEPALIVE_TIMEOUT)
-		return cls(pub=pub, ip=ip, port=port, psk=psk, keepAliveTimeout=keepAliveTimeout)
+	else:
+		ip = port = None
+
+	psk = e.get("PresharedKey", None)
+	allowedIPs = parseAllowedIPs(e.get("AllowedIPs", ""))
+	keepAliveTimeout = e.get("PersistentKeepalive", DEFAULT_KEEPALIVE_TIMEOUT)
+	if isinstance(keepAliveTimeout, str) and keepAliveTimeout.strip().lower() == "off":
+		keepAliveTimeout = None
+	else:
+		keepAliveTimeout = int(keepAliveTimeout) or None  # wg-quick takes both `off` and 0 as no keepalive
+	return pub, ip, port, psk, keepAliveTimeout, allowedIPs
+
+
+class PeerTable:
+	"""Columnar storage of many peers: the public keys are in one contiguous buffer of `32 * N` bytes, the endpoints and the keepalive timeouts are in packed arrays (IPv4 addresses are stored IPv4-mapped, port 0 means no endpoint, keepalive 0 means none), the rare pre-shared keys are in a dict. The peers are indexed by public key and by endpoint.
+	It is a sequence of `Peer`s, so it can be used as `WGConfig.peers`, but the `Peer` objects are built on access and are not kept."""
+
+	__slots__ = ("keys", "hosts", "ports", "keepAliveTimeouts", "psks", "allowedIPs", "byKey", "byEndpoint")
+
+	def __init__(self) -> None:
+		self.keys = bytearray()
+		self.hosts = bytearray()
+		self.ports = array("H")
+		self.keepAliveTimeouts = array("H")
+		self.psks = {}
+		self.allowedIPs = []
+		self.byKey = {}
+		self.byEndpoint = {}
+
+	@classmethod
+	def fromPeers(cls, peers: typing.Iterable[Peer]) -> "PeerTable":
+		res = cls()
+		for peer in peers:
+			res.appendPeer(peer)
+		return res
+
+	def append(self, pub: typing.Union[PublicKey, bytes], ip: typing.Optional[typing.Union[IPv4Address, IPv6Address, str]] = None, port: typing.Optional[int] = None, psk: typing.Optional[str] = None, keepAliveTimeout: int = DEFAULT_KEEPALIVE_TIMEOUT, allowedIPs: typing.Iterable[typing.Union[Network, str]] = ()) -> int:
+		"""Adds a peer, returns its index."""
+		pub = bytes(pub)
+		if len(pub) != KEY_SIZE:
+			raise ValueError("Public key must be " + str(KEY_SIZE) + " bytes", pub)
+		if pub in self.byKey:
+			raise KeyError("Peer with this public key already exists", pub)
+
+		idx = len(self.ports)
+		self.byKey[pub] = idx
+		self.keys += pub
+		self.hosts += bytes(16)
+		self.ports.append(0)
+		self.keepAliveTimeouts.append(NO_KEEPALIVE if keepAliveTimeout is None else keepAliveTimeout)
+		if psk is not None:
+			self.psks[idx] = psk
+		self.allowedIPs.append(tuple(toNetwork(el) for el in allowedIPs))
+		self.setEndpoint(idx, ip, port)
+		return idx
+
+	def appendPeer(self, peer: Peer) -> int:
+		return self.append(peer.pub, peer.ip, peer.port, peer.psk, peer.keepAliveTimeout, peer.allowedIPs)
+
+	def appendCfgEntry(self, e) -> int:
+		"""Adds a `[Peer]` entry without creating the objects of `Peer.fromCfgEntry`."""
+		return self.append(*parseCfgEntry(e))
+
+	def setEndpoint(self, idx: int, ip: typing.Optional[typing.Union[IPv4Address, IPv6Address, str]], port: typing.Optional[int]) -> None:
+		"""Sets the endpoint of the peer `idx`, i.e. after it has roamed, and updates the index."""
+		oldKey = self._endpointKey(idx)
+		if oldKey is not None and self.byEndpoint.get(oldKey) == idx:
+			del self.byEndpoint[oldKey]
+
+		if ip is None or not port:
+			self.hosts[idx * 16 : (idx + 1) * 16] = bytes(16)
+			self.ports[idx] = 0
+			return
+
+		ip = _toIPv6(ip)
+		self.hosts[idx * 16 : (idx + 1) * 16] = ip.packed
+		self.ports[idx] = port
+		self.byEndpoint[int(ip) << 16 | port] = idx
+
+	def _endpointKey(self, idx: int) -> typing.Optional[int]:
+		port = self.ports[idx]
+		if not port:
+			return None
+		return int.from_bytes(self.hosts[idx * 16 : (idx + 1) * 16], "big") << 16 | port
+
+	def publicKey(self, idx: int) -> bytes:
+		return bytes(self.keys[idx * KEY_SIZE : (idx + 1) * KEY_SIZE])
+
+	def keepAliveTimeout(self, idx: int) -> typing.Optional[int]:
+		res = self.keepAliveTimeouts[idx]
+		return None if res == NO_KEEPALIVE else res
+
+	def endpoint(self, idx: int) -> typing.Tuple[typing.Optional[typing.Union[IPv4Address, IPv6Address]], typing.Optional[int]]:
+		port = self.ports[idx]
+		if not port:
+			return None, None
+
+		ip = IPv6Address(bytes(self.hosts[idx * 16 : (idx + 1) * 16]))
+		return (ip.ipv4_mapped or ip), port
+
+	def indexOfKey(self, pub: typing.Union[PublicKey, bytes]) -> typing.Optional[int]:
+		return self.byKey.get(bytes(pub))
+
+	def indexOfEndpoint(self, ip: typing.Union[IPv4Address, IPv6Address, str], port: int) -> typing.Optional[int]:
+		"""`ip, port` are as in the addresses given by `asyncio`."""
+		return self.byEndpoint.get(int(_toIPv6(ip)) << 16 | port)
+
+	def __len__(self) -> int:
+		return len(self.ports)
+
+	def __getitem__(self, idx: int) -> Peer:
+		if idx < 0:
+			idx += len(self)
+		if not 0 <= idx < len(self):
+			raise IndexError(idx)
+
+		ip, port = self.endpoint(idx)
+		return Peer(pub=PublicKey.fromKeyBytes(self.publicKey(idx)), ip=ip, port=port, psk=self.psks.get(idx), keepAliveTimeout=self.keepAliveTimeout(idx), allowedIPs=self.allowedIPs[idx])
+
+	def __iter__(self) -> typing.Iterator[Peer]:
+		for idx in range(len(self)):
+			yield self[idx]
+
+	def view(self, idx: int) -> "PeerView":
+		return PeerView(self, idx)
+
+	def __repr__(self):
+		return self.__class__.__name__ + "<" + repr(len(self)) + " peers>"
+
+
+class PeerView:
+	"""A read-only `Peer` whose fields are read from a `PeerTable` on access, so it is cheap to create, i.e. for each tunnel of `Tunnel.open_many`."""
+
+	__slots__ = ("table", "idx")
+
+	def __init__(self, table: PeerTable, idx: int) -> None:
+		self.table = table
+		self.idx = idx
+
+	@property
+	def pub(self) -> PublicKey:
+		return PublicKey.fromKeyBytes(self.table.publicKey(self.idx))
+
+	@property
+	def ip(self) -> typing.Optional[typing.Union[IPv4Address, IPv6Address]]:
+		return self.table.endpoint(self.idx)[0]
+
+	@property
+	def port(self) -> typing.Optional[int]:
+		return self.table.endpoint(self.idx)[1]
+
+	@property
+	def psk(self) -> typing.Optional[str]:
+		return self.table.psks.get(self.idx)
+
+	@property
+	def keepAliveTimeout(self) -> typing.Optional[int]:
+		return self.table.keepAliveTimeout(self.idx)
+
+	@property
+	def allowedIPs(self) -> typing.Tuple[Network, ...]:
+		return self.table.allowedIPs[self.idx]
+
+	def __repr__(self):
+		return self.__class__.__name__ + "<" + repr(self.idx) + " of " + repr(self.table) + ">"
+
+
+def _toIPv6(ip: typing.Union[IPv4Address, IPv6Address, str]) -> IPv6Address:
+	if isinstance(ip, str):
+		ip = ip_address(ip.split("%", 1)[0])
+	if ip.version == 4:
+		return IPv6Address(b"\0" * 10 + b"\xff\xff" + ip.packed)
+	return ip
 
 
 class WGConfig:
@@ -56,10 +244,8 @@ class WGConfig:
 		self.peers = peers
 
 	@classmethod
-	def fromFile(cls, f: Path) -> "WGConfig":
-		import wg_conf
+	def fromFile(cls, f: typing.Union[Path, str], table: bool = False) -> "WGConfig":
+		"""Parses the config with `confParser`. If `table` is set, `peers` is a `PeerTable`, which is much more compact for configs with thousands of peers."""
+		from .confParser import readConfig
 
-		cfg = wg_conf.WireguardConfig(f)
-		sec = Interface.fromCfgEntry(cfg.interface)
-		peers = [Peer.fromCfgEntry(p) for p in cfg.peers.values()]
-		return cls(sec, peers)
+		return readConfig(f, table)
@@ -1,11 +1,16 @@
+import os
 import platform
+import sys
+import threading
 import typing
 from ctypes import CDLL, POINTER, Structure, c_char, c_char_p, c_float, c_int, c_int32, c_int64, c_uint8, c_uint16, c_uint32, c_ulong, c_void_p, cast
+from ctypes.util import find_library
 from enum import IntEnum
+from pathlib import Path
 
 # pylint:disable=too-few-public-methods
 
-__all__ = ("x25519_secret_key", "x25519_public_key", "x25519_key_to_base64", "x25519_key_to_hex", "x25519_key_to_str_free", "check_base64_encoded_x25519_key", "new_tunnel", "tunnel_free", "wireguard_write", "wireguard_read", "wireguard_tick", "wireguard_force_handshake", "wireguard_stats", "benchmark")
+__all__ = ("x25519_secret_key", "x25519_public_key", "x25519_key_to_base64", "x25519_key_to_hex", "x25519_key_to_str_free", "check_base64_encoded_x25519_key", "new_tunnel", "tunnel_free", "wireguard_write", "wireguard_read", "wireguard_write_raw", "wireguard_read_raw", "wireguard_tick", "wireguard_force_handshake", "wireguard_stats", "benchmark", "WireGuardError", "getLib")
 
 uintptr_t = c_ulong
 result_type = c_int
@@ -33,6 +38,28 @@ class Opcode(IntEnum):
 	WRITE_TO_TUNNEL_IPV6 = 6  # Write dst buffer to the interface as an ipv6 packet. Size indicates the number of bytes to write.
 
 
+class WireGuardError(IntEnum):
+	"""The codes in `size` of the results with `Opcode.WIREGUARD_ERROR`, in the order of `noise::errors::WireGuardError`"""
+
+	DestinationBufferTooSmall = 0
+	IncorrectPacketLength = 1
+	UnexpectedPacket = 2
+	WrongPacketType = 3
+	WrongIndex = 4
+	WrongKey = 5
+	InvalidTai64nTimestamp = 6
+	WrongTai64nTimestamp = 7
+	InvalidMac = 8
+	InvalidAeadTag = 9
+	InvalidCounter = 10
+	DuplicateCounter = 11
+	InvalidPacket = 12
+	NoCurrentSession = 13
+	LockFailed = 14
+	ConnectionExpired = 15
+	UnderLoad = 16
+
+
 TunnPtr = c_void_p  # opaque pointer
 
 
@@ -95,14 +122,70 @@ class stats(Structure):
 		return self.__class__.__name__ + "<" + ", ".join("=".join((k, repr(getattr(self, k)))) for k in self.__class__.__slots__) + ">"
 
 
+LIBRARY_PATH_ENV_VAR = "BORINGTUN_LIB"
+
 if platform.system() == "Windows":
-	lib = CDLL("./libboringtun.dll")
+	LIBRARY_FILE_NAMES = ("libboringtun.dll", "boringtun.dll")
+elif platform.system() == "Darwin":
+	LIBRARY_FILE_NAMES = ("libboringtun.dylib",)
 else:
-	lib = CDLL("./libboringtun.so")
-
-
-def assignTypesFromFunctionSignature(func, lib):  # pytlint:disable=redefined-outer-name
-	rawFunc = getattr(lib, func.__name__)
+	LIBRARY_FILE_NAMES = ("libboringtun.so",)
+
+_lib = None
+_libLock = threading.Lock()
+
+
+def libraryCandidates() -> typing.Iterator[str]:
+	"""The paths tried by `getLib`, in order: the env var `BORINGTUN_LIB`, the package dir, the current dir (where the lib was searched before) and the system lib dirs."""
+	envPath = os.environ.get(LIBRARY_PATH_ENV_VAR)
+	if envPath:
+		yield envPath
+		return
+
+	packageDir = Path(__file__).parent
+	for fileName in LIBRARY_FILE_NAMES:
+		yield str(packageDir / fileName)
+	for fileName in LIBRARY_FILE_NAMES:
+		yield "." + os.sep + fileName  # without the dir `dlopen` doesn't search the current one
+
+	systemPath = find_library("boringtun")
+	if systemPath is not None:
+		yield systemPath
+
+
+def getLib() -> CDLL:
+	"""Loads the library on the first call."""
+	global _lib  # pylint:disable=global-statement
+
+	if _lib is not None:
+		return _lib
+
+	with _libLock:
+		if _lib is None:
+			tried = []
+			for candidate in libraryCandidates():
+				try:
+					_lib = CDLL(candidate)
+					break
+				except OSError as ex:
+					tried.append(str(ex))
+			else:
+				raise OSError("Cannot load libboringtun, set the `" + LIBRARY_PATH_ENV_VAR + "` env var to its path. Tried: " + "; ".join(tried))
+	return _lib
+
+
+def __getattr__(name: str):
+	if name == "lib":
+		return getLib()
+	raise AttributeError(name)
+
+
+def assignTypesFromFunctionSignature(func, lib, symbolName: typing.Optional[str] = None):  # pytlint:disable=redefined-outer-name
+	if symbolName is None:
+		rawFunc = getattr(lib, func.__name__)
+	else:
+		# `CDLL.__getitem__` creates a new function pointer object, so the argtypes of the default binding are kept intact
+		rawFunc = lib[symbolName]
 	rawFunc.argtypes = [func.__annotations__[argName] for argName in func.__code__.co_varnames[: func.__code__.co_argcount]]
 	rawFunc.restype = func.__annotations__["return"]
 	return rawFunc
@@ -111,12 +194,36 @@ def assignTypesFromFunctionSignature(func, lib):  # pytlint:disable=redefined-ou
 atffs = assignTypesFromFunctionSignature
 
 
+class LazyBinding:
+	"""A placeholder for a function of the lib, binding it (and loading the lib) on the first call. The placeholder is assigned to the global `"_" + func.__name__` of the module of `func`, and replaces itself there with the bound function, so the following calls don't go through it."""
+
+	__slots__ = ("func", "symbolName")
+
+	def __init__(self, func: typing.Callable, symbolName: typing.Optional[str] = None) -> None:
+		self.func = func
+		self.symbolName = symbolName
+
+	def bind(self):
+		rawFunc = assignTypesFromFunctionSignature(self.func, getLib(), self.symbolName)
+		vars(sys.modules[self.func.__module__])["_" + self.func.__name__] = rawFunc
+		return rawFunc
+
+	def __call__(self, *args):
+		return self.bind()(*args)
+
+	def __repr__(self):
+		return self.__class__.__name__ + "(" + self.func.__name__ + ")"
+
+
+bindLazily = LazyBinding
+
+
 def x25519_secret_key() -> X25519SecretKey:
 	"""Generates a new x25519 secret key."""
 	return _x25519_secret_key()
 
 
-_x25519_secret_key = atffs(x25519_secret_key, lib)
+_x25519_secret_key = bindLazily(x25519_secret_key)
 
 
 def x25519_public_key(private_key: X25519SecretKey) -> X25519PublicKey:
@@ -124,7 +231,7 @@ def x25519_public_key(private_key: X25519SecretKey) -> X25519PublicKey:
 	return _x25519_public_key(private_key)
 
 
-_x25519_public_key = atffs(x25519_public_key, lib)
+_x25519_public_key = bindLazily(x25519_public_key)
 
 
 def x25519_key_to_base64(key: x25519_key) -> LP_c_char:
@@ -135,7 +242,7 @@ def x25519_key_to_base64(key: x25519_key) -> LP_c_char:
 	return _x25519_key_to_base64(key)
 
 
-_x25519_key_to_base64 = atffs(x25519_key_to_base64, lib)
+_x25519_key_to_base64 = bindLazily(x25519_key_to_base64)
 
 
 def x25519_key_to_hex(key: x25519_key) -> LP_c_char:
@@ -145,7 +252,7 @@ def x25519_key_to_hex(key: x25519_key) -> LP_c_char:
 	return _x25519_key_to_hex(key)
 
 
-_x25519_key_to_hex = atffs(x25519_key_to_hex, lib)
+_x25519_key_to_hex = bindLazily(x25519_key_to_hex)
 
 
 def x25519_key_to_str_free(stringified_key: LP_c_char) -> None:
@@ -153,7 +260,7 @@ def x25519_key_to_str_free(stringified_key: LP_c_char) -> None:
 	return _x25519_key_to_str_free(stringified_key)
 
 
-_x25519_key_to_str_free = atffs(x25519_key_to_str_free, lib)
+_x25519_key_to_str_free = bindLazily(x25519_key_to_str_free)
 
 
 def check_base64_encoded_x25519_key(key: c_char_p) -> c_int32:
@@ -163,7 +270,7 @@ def check_base64_encoded_x25519_key(key: c_char_p) -> c_int32:
 	return _check_base64_encoded_x25519_key(key)
 
 
-_check_base64_encoded_x25519_key = atffs(check_base64_encoded_x25519_key, lib)
+_check_base64_encoded_x25519_key = bindLazily(check_base64_encoded_x25519_key)
 
 
 def new_tunnel(static_private: c_char_p, server_static_public: c_char_p, preshared_key: c_char_p, keep_alive: c_uint16, index: c_uint32) -> TunnPtr:
@@ -173,7 +280,7 @@ def new_tunnel(static_private: c_char_p, server_static_public: c_char_p, preshar
 	return _new_tunnel(static_private, server_static_public, preshared_key, keep_alive, index)
 
 
-_new_tunnel = atffs(new_tunnel, lib)
+_new_tunnel = bindLazily(new_tunnel)
 
 
 def tunnel_free(tunnel: TunnPtr) -> None:
@@ -181,7 +288,7 @@ def tunnel_free(tunnel: TunnPtr) -> None:
 	return _tunnel_free(tunnel)
 
 
-_tunnel_free = atffs(tunnel_free, lib)
+_tunnel_free = bindLazily(tunnel_free)
 
 
 def wireguard_write(tunnel: TunnPtr, src: LP_c_ubyte, src_size: c_uint32, dst: LP_c_ubyte, dst_size: c_uint32) -> wireguard_result:
@@ -191,7 +298,7 @@ def wireguard_write(tunnel: TunnPtr, src: LP_c_ubyte, src_size: c_uint32, dst: L
 	return _wireguard_write(tunnel, src, src_size, dst, dst_size)
 
 
-_wireguard_write = atffs(wireguard_write, lib)
+_wireguard_write = bindLazily(wireguard_write)
 
 
 def wireguard_read(tunnel: TunnPtr, src: LP_c_ubyte, src_size: c_uint32, dst: LP_c_ubyte, dst_size: c_uint32) -> wireguard_result:
@@ -201,7 +308,23 @@ def wireguard_read(tunnel: TunnPtr, src: LP_c_ubyte, src_size: c_uint32, dst: LP
 	return _wireguard_read(tunnel, src, src_size, dst, dst_size)
 
 
-_wireguard_read = atffs(wireguard_read, lib)
+_wireguard_read = bindLazily(wireguard_read)
+
+
+def wireguard_write_raw(tunnel: TunnPtr, src: c_void_p, src_size: c_uint32, dst: c_void_p, dst_size: c_uint32) -> wireguard_result:
+	"""The same as `wireguard_write`, but takes plain addresses (or `bytes`) instead of pointer objects. Used by batched code to avoid constructing a pointer object per packet."""
+	return _wireguard_write_raw(tunnel, src, src_size, dst, dst_size)
+
+
+_wireguard_write_raw = bindLazily(wireguard_write_raw, "wireguard_write")
+
+
+def wireguard_read_raw(tunnel: TunnPtr, src: c_void_p, src_size: c_uint32, dst: c_void_p, dst_size: c_uint32) -> wireguard_result:
+	"""The same as `wireguard_read`, but takes plain addresses (or `bytes`) instead of pointer objects."""
+	return _wireguard_read_raw(tunnel, src, src_size, dst, dst_size)
+
+
+_wireguard_read_raw = bindLazily(wireguard_read_raw, "wireguard_read")
 
 
 def wireguard_tick(tunnel: TunnPtr, dst: LP_c_ubyte, dst_size: c_uint32) -> wireguard_result:
@@ -211,7 +334,7 @@ def wireguard_tick(tunnel: TunnPtr, dst: LP_c_ubyte, dst_size: c_uint32) -> wire
 	return _wireguard_tick(tunnel, dst, dst_size)
 
 
-_wireguard_tick = atffs(wireguard_tick, lib)
+_wireguard_tick = bindLazily(wireguard_tick)
 
 
 def wireguard_force_handshake(tunnel: TunnPtr, dst: LP_c_ubyte, dst_size: c_uint32) -> wireguard_result:
@@ -220,7 +343,7 @@ def wireguard_force_handshake(tunnel: TunnPtr, dst: LP_c_ubyte, dst_size: c_uint
 	return _wireguard_force_handshake(tunnel, dst, dst_size)
 
 
-_wireguard_force_handshake = atffs(wireguard_force_handshake, lib)
+_wireguard_force_handshake = bindLazily(wireguard_force_handshake)
 
 
 def wireguard_stats(tunnel: TunnPtr) -> stats:
@@ -232,13 +355,14 @@ def wireguard_stats(tunnel: TunnPtr) -> stats:
 	return _wireguard_stats(tunnel)
 
 
-_wireguard_stats = atffs(wireguard_stats, lib)
+_wireguard_stats = bindLazily(wireguard_stats)
 
 
 def benchmark(name: c_int32, idx: c_uint32) -> LP_c_char:
-	"""Performs an internal benchmark, and returns its result as a C-string."""
+	"""Performs an internal benchmark, and returns its result as a C-string, or NULL if there is no benchmark with index `idx`.
+	The memory has to be freed by calling `x25519_key_to_str_free`"""
 
-	return benchmark(name, idx)
+	return _benchmark(name, idx)
 
 
-_benchmark = atffs(benchmark, lib)
+_benchmark = bindLazily(benchmark)
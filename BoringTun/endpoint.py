@@ -0,0 +1,489 @@
+"""A WireGuard endpoint serving many peers through a single UDP socket."""
+
+__all__ = ("WireGuardEndpoint", "EndpointPeer", "ReloadResult", "UnknownPeerError", "MessageType", "receiverIndexOf", "tunnelIndexOf", "checkMac1")
+
+import asyncio
+import hashlib
+import hmac
+import typing
+from array import array
+from functools import partial
+
+from .allowedIPs import AllowedIPs
+from .config import Interface, Peer, WGConfig
+from .handshakeScheduler import HandshakeScheduler
+from .messageHeaders import RECEIVER_INDEX_OFFSETS, MessageType
+from .timerWheel import TickEntry, TimerWheel, getDefaultTimerWheel
+from .KeyPair import Key
+from .Tunnel import Action, Opcode, OpenTunnel, Tunnel
+from .udpBatch import DatagramBatch, createBatchedDatagramEndpoint
+
+# pylint:disable=too-many-instance-attributes
+
+
+HANDSHAKE_INITIATION_SIZE = 148
+MAC1_OFFSET = 116
+MAC_SIZE = 16
+MAX_TUNNEL_INDEX = (1 << 24) - 1
+
+
+class UnknownPeerError(KeyError):
+	"""A packet was sent to an index having no peer, i.e. to a removed one. Given to `error_received` of the app protocol, the packet is dropped."""
+
+
+def receiverIndexOf(datagram: typing.Union[bytes, bytearray, memoryview]) -> typing.Optional[int]:
+	try:
+		offset = RECEIVER_INDEX_OFFSETS[datagram[0]]
+	except (KeyError, IndexError):
+		return None
+
+	if len(datagram) < offset + 4:
+		return None
+
+	return int.from_bytes(datagram[offset : offset + 4], "little")
+
+
+def tunnelIndexOf(datagram: typing.Union[bytes, bytearray, memoryview]) -> typing.Optional[int]:
+	"""BoringTun puts the `index` passed to `new_tunnel` into the upper 24 bits of the session indices it generates, so the tunnel a message is addressed to is known from the receiver index without any crypto."""
+	res = receiverIndexOf(datagram)
+	if res is not None:
+		res >>= 8
+	return res
+
+
+LABEL_MAC1 = b"mac1----"
+
+
+def mac1Key(ourPublic: bytes) -> bytes:
+	return hashlib.blake2s(LABEL_MAC1 + ourPublic).digest()
+
+
+def checkMac1(msg: typing.Union[bytes, bytearray, memoryview], key: bytes) -> bool:
+	"""Checks the MAC1 of a handshake initiation. It is keyed with our public key, so the datagrams not meant for us can be rejected with a single BLAKE2s call before doing any X25519."""
+	if len(msg) != HANDSHAKE_INITIATION_SIZE:
+		return False
+
+	expected = hashlib.blake2s(msg[:MAC1_OFFSET], digest_size=MAC_SIZE, key=key).digest()
+	return hmac.compare_digest(expected, msg[MAC1_OFFSET : MAC1_OFFSET + MAC_SIZE])
+
+
+CONSTRUCTION = b"Noise_IKpsk2_25519_ChaChaPoly_BLAKE2s"
+IDENTIFIER = b"WireGuard v1 zx2c4 Jason@zx2c4.com"
+
+
+def _hmac(key: bytes, data: bytes) -> bytes:
+	return hmac.new(key, data, hashlib.blake2s).digest()
+
+
+class InitiatorIdentifier:
+	"""Decrypts the static public key of the initiator of a handshake, so the peer is found by a dict lookup instead of trying the handshake against every tunnel.
+	Requires `cryptography` for X25519 and ChaCha20-Poly1305. This is only a routing hint, the handshake itself is still fully verified by BoringTun."""
+
+	__slots__ = ("sec", "chainingKey0", "hash0", "X25519PublicKey", "ChaCha20Poly1305", "InvalidTag")
+
+	def __init__(self, interface: Interface) -> None:
+		from cryptography.exceptions import InvalidTag
+		from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+		from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+
+		self.X25519PublicKey = X25519PublicKey
+		self.ChaCha20Poly1305 = ChaCha20Poly1305
+		self.InvalidTag = InvalidTag
+
+		self.sec = X25519PrivateKey.from_private_bytes(bytes(interface.sec))
+		ourPublic = bytes(interface.sec.getPublic())
+		self.chainingKey0 = hashlib.blake2s(CONSTRUCTION).digest()
+		self.hash0 = hashlib.blake2s(hashlib.blake2s(self.chainingKey0 + IDENTIFIER).digest() + ourPublic).digest()
+
+	def __call__(self, msg: typing.Union[bytes, bytearray, memoryview]) -> typing.Optional[bytes]:
+		msg = bytes(msg)
+		ephemeral = msg[8:40]
+		encryptedStatic = msg[40:88]
+
+		h = hashlib.blake2s(self.hash0 + ephemeral).digest()
+		c = _hmac(_hmac(self.chainingKey0, ephemeral), b"\x01")
+
+		try:
+			shared = self.sec.exchange(self.X25519PublicKey.from_public_bytes(ephemeral))
+		except ValueError:
+			return None
+
+		temp = _hmac(c, shared)
+		c = _hmac(temp, b"\x01")
+		key = _hmac(temp, c + b"\x02")
+
+		try:
+			return self.ChaCha20Poly1305(key).decrypt(bytes(12), encryptedStatic, h)
+		except self.InvalidTag:
+			return None
+
+
+class EndpointPeer:
+	"""The state of a peer of a `WireGuardEndpoint`. `addr` is updated every time an authenticated datagram comes from the peer, so roaming peers are followed."""
+
+	__slots__ = ("idx", "tunnel", "openTunnel", "addr", "tickEntry")
+
+	def __init__(self, idx: int, tunnel: Tunnel, openTunnel: OpenTunnel, addr: typing.Optional[typing.Tuple[str, int]]) -> None:
+		self.idx = idx
+		self.tunnel = tunnel
+		self.openTunnel = openTunnel
+		self.addr = addr
+		self.tickEntry = None  # type: typing.Optional[TickEntry]
+
+	def __repr__(self):
+		return self.__class__.__name__ + "(" + repr(self.idx) + ", " + repr(self.addr) + ")"
+
+
+class ReloadResult:
+	"""The indexes of the peers affected by `WireGuardEndpoint.reload`. `recreated` are the ones whose tunnels were replaced (because of a change of the pre-shared key or the keepalive, they need a new handshake), `updated` are the ones whose endpoints were changed in place."""
+
+	__slots__ = ("added", "removed", "recreated", "updated", "kept")
+
+	def __init__(self) -> None:
+		self.added = []
+		self.removed = []
+		self.recreated = []
+		self.updated = []
+		self.kept = []
+
+	def __repr__(self):
+		return self.__class__.__name__ + "(" + ", ".join(k + "=" + repr(len(getattr(self, k))) for k in self.__class__.__slots__) + ")"
+
+
+def _pskOf(peer: Peer) -> typing.Optional[bytes]:
+	"""The pre-shared key in the form given to `new_tunnel`, see `Tunnel.Base64TunnelDataCache`."""
+	psk = peer.psk
+	if isinstance(psk, Key):
+		return psk.base64Ascii()
+	if isinstance(psk, str):
+		return psk.encode("ascii")
+	return psk
+
+
+def _addrOf(peer: Peer) -> typing.Optional[typing.Tuple[str, int]]:
+	return (str(peer.ip), peer.port) if peer.ip is not None and peer.port is not None else None
+
+
+class WireGuardEndpoint(asyncio.DatagramTransport, asyncio.DatagramProtocol):
+	"""Serves many peers through one UDP socket. Incoming datagrams are routed to the tunnels by the receiver index in the header in O(1); handshake initiations (having no receiver index) are prechecked by MAC1 and then routed by the decrypted initiator key if `cryptography` is available, otherwise the peer that last used the same source address is tried first and then all the rest.
+	For the app protocol this object is a datagram transport where the address is the peer index: `sendto(ipPacket, peerIdx)` sends a packet to a peer and the decrypted packets are delivered as `datagram_received(ipPacket, peerIdx)`.
+	`allowedIPs` is built from the `AllowedIPs` of the peers: `sendto(ipPacket)` without a peer routes the packet by its destination, and the decrypted packets whose sources are not allowed for their peers are dropped. The peers having no `AllowedIPs` are not filtered.
+	If `handshakeScheduler` is given, the handshake initiations passing the MAC1 check and the forced handshakes go through it."""
+
+	__slots__ = ("interface", "peers", "peersByKey", "peersByAddr", "allowedIPs", "transport", "appProtocol", "batchedIO", "mac1Key", "identifyInitiator", "timerWheel", "handlers", "handshakeScheduler")
+
+	def __init__(self, interface: Interface, appProtocol: typing.Optional[asyncio.DatagramProtocol] = None, batchedIO: bool = False, timerWheel: typing.Optional[TimerWheel] = None, handshakeScheduler: typing.Optional[HandshakeScheduler] = None) -> None:
+		super().__init__()
+		self.timerWheel = timerWheel
+		self.handshakeScheduler = handshakeScheduler
+		self.interface = interface
+		self.peers = {}
+		self.peersByKey = {}
+		self.peersByAddr = {}
+		self.allowedIPs = AllowedIPs()
+		self.transport = None
+		self.appProtocol = appProtocol
+		self.batchedIO = batchedIO
+		self.mac1Key = mac1Key(bytes(interface.sec.getPublic()))
+
+		try:
+			self.identifyInitiator = InitiatorIdentifier(interface)
+		except ImportError:
+			self.identifyInitiator = None
+
+		self.handlers = {
+			Opcode.WIREGUARD_DONE: self.__class__._ignore,
+			Opcode.WIREGUARD_ERROR: self.__class__._ignore,
+			Opcode.WRITE_TO_NETWORK: self.__class__._writeToNetwork,
+			Opcode.WRITE_TO_TUNNEL_IPV4: self.__class__._writeToTunnel,
+			Opcode.WRITE_TO_TUNNEL_IPV6: self.__class__._writeToTunnel,
+		}
+
+	@classmethod
+	def fromConfig(cls, cfg: WGConfig, appProtocol: typing.Optional[asyncio.DatagramProtocol] = None, batchedIO: bool = False, timerWheel: typing.Optional[TimerWheel] = None, handshakeScheduler: typing.Optional[HandshakeScheduler] = None) -> "WireGuardEndpoint":
+		self = cls(cfg.interface, appProtocol, batchedIO=batchedIO, timerWheel=timerWheel, handshakeScheduler=handshakeScheduler)
+		for idx, peer in enumerate(cfg.peers):
+			self.addPeer(peer, idx)
+		return self
+
+	def addPeer(self, peer: Peer, idx: typing.Optional[int] = None) -> EndpointPeer:
+		if idx is None:
+			idx = max(self.peers, default=-1) + 1
+
+		if not 0 <= idx <= MAX_TUNNEL_INDEX:
+			raise ValueError("Tunnel index must fit into 24 bits", idx)
+		if idx in self.peers:
+			raise KeyError("Tunnel index is already used", idx)
+
+		tunnel = Tunnel(self.interface, peer, idx=idx)
+		addr = _addrOf(peer)
+		ep = EndpointPeer(idx, tunnel, tunnel.__enter__(), addr)
+		# the results are given to the app protocol without copying, if it doesn't keep them, see `tunDevice.TunDevice`
+		ep.openTunnel.pooledActions = getattr(self.appProtocol, "ACCEPTS_BORROWED_PACKETS", False)
+		self.peers[idx] = ep
+		self.peersByKey[bytes(peer.pub)] = ep
+		self.allowedIPs.insertPeer(idx, peer.allowedIPs)
+		if addr is not None:
+			self.peersByAddr[addr] = ep
+		if self.transport is not None:
+			self._startTicking(ep)
+		return ep
+
+	def removePeer(self, idx: int) -> None:
+		ep = self.peers.pop(idx)
+		self.peersByKey.pop(bytes(ep.tunnel.peer.pub), None)
+		self.allowedIPs.removePeer(idx)
+		if ep.addr is not None and self.peersByAddr.get(ep.addr) is ep:
+			del self.peersByAddr[ep.addr]
+		if ep.tickEntry is not None:
+			self.timerWheel.unregister(ep.tickEntry)
+			ep.tickEntry = None
+		ep.tunnel.__exit__(None, None, None)
+
+	def reload(self, cfg: WGConfig) -> ReloadResult:
+		"""Brings the peers in line with `cfg` without disturbing the ones not changed in it. The peers are matched by public key: the tunnels of the matched ones are kept with their sessions, unless the pre-shared key or the keepalive has changed; their endpoints and allowed IPs are updated in place if they have changed in the config (the ones learnt from the traffic of roaming peers are kept otherwise). The indexes of the kept peers don't change, the added peers get new ones.
+		If the key of the interface has changed, all the tunnels are recreated."""
+		res = ReloadResult()
+		recreateAll = bytes(cfg.interface.sec) != bytes(self.interface.sec)
+		if recreateAll:
+			self.interface = cfg.interface
+			self.mac1Key = mac1Key(bytes(cfg.interface.sec.getPublic()))
+			if self.identifyInitiator is not None:
+				self.identifyInitiator = InitiatorIdentifier(cfg.interface)
+
+		stale = dict(self.peersByKey)
+		nextIdx = max(self.peers, default=-1) + 1
+		for peer in cfg.peers:
+			ep = stale.pop(bytes(peer.pub), None)
+			if ep is None:
+				self.addPeer(peer, nextIdx)
+				res.added.append(nextIdx)
+				nextIdx += 1
+				continue
+
+			old = ep.tunnel.peer
+			if recreateAll or _pskOf(peer) != _pskOf(old) or peer.keepAliveTimeout != old.keepAliveTimeout:
+				self.removePeer(ep.idx)
+				self.addPeer(peer, ep.idx)
+				res.recreated.append(ep.idx)
+				continue
+
+			ep.tunnel.peer = peer
+			updated = False
+			if peer.allowedIPs != old.allowedIPs:
+				self.allowedIPs.removePeer(ep.idx)
+				self.allowedIPs.insertPeer(ep.idx, peer.allowedIPs)
+				updated = True
+			addr = _addrOf(peer)
+			if addr != _addrOf(old):
+				if addr is not None:
+					self._authenticated(ep, addr)
+				updated = True
+			(res.updated if updated else res.kept).append(ep.idx)
+
+		for ep in stale.values():
+			self.removePeer(ep.idx)
+			res.removed.append(ep.idx)
+
+		return res
+
+	def _startTicking(self, ep: EndpointPeer) -> None:
+		if self.timerWheel is None:
+			self.timerWheel = getDefaultTimerWheel()
+		ep.tickEntry = self.timerWheel.register(ep.openTunnel, partial(self._sendAndRelease, ep))
+
+	async def listen(self, local_addr: typing.Tuple[str, int]):
+		if self.batchedIO:
+			return await createBatchedDatagramEndpoint(lambda: self, local_addr=local_addr)
+
+		loop = asyncio.get_event_loop()
+		return await loop.create_datagram_endpoint(lambda: self, local_addr=(str(local_addr[0]), local_addr[1]))
+
+	def route(self, datagram: typing.Union[bytes, bytearray, memoryview], addr: typing.Tuple[str, int]) -> typing.Iterable[EndpointPeer]:
+		"""Returns the candidate peers for a datagram, in the order they should be tried."""
+		msgType = datagram[0] if datagram else None
+		if msgType == MessageType.HANDSHAKE_INITIATION:
+			if not checkMac1(datagram, self.mac1Key):
+				return ()
+
+			if self.identifyInitiator is not None:
+				ep = self.peersByKey.get(self.identifyInitiator(datagram))
+				return (ep,) if ep is not None else ()
+
+			ep = self.peersByAddr.get(addr)
+			if ep is None:
+				return self.peers.values()
+			return (ep,) + tuple(el for el in self.peers.values() if el is not ep)
+
+		ep = self.peers.get(tunnelIndexOf(datagram))
+		return (ep,) if ep is not None else ()
+
+	def datagram_received(self, data, addr):
+		if self.handshakeScheduler is not None and data and data[0] == MessageType.HANDSHAKE_INITIATION and checkMac1(data, self.mac1Key):
+			self.handshakeScheduler.submitIncoming(data, addr, partial(self._processDatagram, addr=addr))
+			return
+
+		self._processDatagram(data, addr)
+
+	def _processDatagram(self, data, addr):
+		for ep in self.route(data, addr):
+			res = ep.openTunnel.unwrap(data)
+			if res.opcode != Opcode.WIREGUARD_ERROR:
+				self._authenticated(ep, addr)
+				self._handle(ep, res)
+				return
+			res.release()
+
+	def datagrams_received(self, batch: DatagramBatch):
+		"""The headers of the whole batch are parsed at once and the data messages are grouped by their tunnels, each group is unwrapped by a single `unwrap_many`. The handshake messages go first, so the data of a session established within the batch can be decrypted; the malformed datagrams are dropped."""
+		headers = batch.headers()
+		receivers = headers.receivers
+		groups = {}
+		for i, msgType in enumerate(headers.types):
+			if msgType == MessageType.DATA:
+				group = groups.get(receivers[i] >> 8)
+				if group is None:
+					group = groups[receivers[i] >> 8] = []
+				group.append(i)
+			elif msgType:
+				self.datagram_received(batch[i], batch.address(i))
+
+		for tunnelIdx, positions in groups.items():
+			ep = self.peers.get(tunnelIdx)
+			if ep is not None:
+				self._unwrapBatch(ep, batch, positions)
+
+	def _unwrapBatch(self, ep: EndpointPeer, batch: DatagramBatch, positions: typing.List[int]) -> None:
+		"""Unwraps the data messages of the batch at `positions`, all addressed to `ep`."""
+		offsets = batch.offsets
+		sizes = batch.sizes
+		results = ep.openTunnel.unwrap_many(batch.buffer, array("I", [offsets[i] for i in positions]), array("I", [sizes[i] for i in positions]))
+		borrowed = ep.openTunnel.pooledActions
+		first = last = None
+		for i, (opcode, out) in zip(positions, results):
+			if opcode == Opcode.WIREGUARD_ERROR:
+				continue
+			if first is None:
+				first = i
+				self._authenticated(ep, batch.address(i))
+			last = i
+			if not borrowed and (opcode == Opcode.WRITE_TO_TUNNEL_IPV4 or opcode == Opcode.WRITE_TO_TUNNEL_IPV6):
+				out = bytes(out)
+			self._handle(ep, Action(opcode, out))
+
+		if last != first:
+			# the peer may have roamed within the batch
+			self._authenticated(ep, batch.address(last))
+
+	def _authenticated(self, ep: EndpointPeer, addr: typing.Tuple[str, int]) -> None:
+		if ep.addr != addr:
+			if ep.addr is not None and self.peersByAddr.get(ep.addr) is ep:
+				del self.peersByAddr[ep.addr]
+			ep.addr = addr
+			self.peersByAddr[addr] = ep
+
+	def _handle(self, ep: EndpointPeer, res: Action) -> None:
+		if ep.tickEntry is not None:
+			ep.tickEntry.active = True
+		self.handlers[res.opcode](self, ep, res)
+		res.release()
+		if res.opcode == Opcode.WRITE_TO_NETWORK:
+			# BoringTun may have packets queued while the handshake was in progress, they are flushed by reading an empty datagram
+			while True:
+				res = ep.openTunnel.unwrap(b"")
+				if res.opcode != Opcode.WRITE_TO_NETWORK:
+					res.release()
+					break
+				self._sendAndRelease(ep, res)
+
+	def _ignore(self, ep: EndpointPeer, res: Action) -> None:
+		pass
+
+	def _writeToNetwork(self, ep: EndpointPeer, res: Action) -> None:
+		if ep.addr is not None:
+			self.transport.sendto(res.buf, ep.addr)
+
+	def _sendAndRelease(self, ep: EndpointPeer, res: Action) -> None:
+		try:
+			self._writeToNetwork(ep, res)
+		finally:
+			res.release()
+
+	def _writeToTunnel(self, ep: EndpointPeer, res: Action) -> None:
+		if ep.tunnel.peer.allowedIPs and not self.allowedIPs.allowsSource(res.buf, ep.idx):
+			return
+		if self.appProtocol is not None:
+			self.appProtocol.datagram_received(res.buf, ep.idx)
+
+	def sendto(self, data, addr=None):
+		"""Sends an IP packet to the peer with the index `addr`, or to the one chosen by `allowedIPs` if it is `None`. The packets routed to no peer are dropped. The ones sent to an index of no peer are dropped too, with `UnknownPeerError` given to `error_received`."""
+		if addr is None:
+			addr = self.allowedIPs.route(data)
+			if addr is None:
+				return
+		ep = self.peers.get(addr)
+		if ep is None:
+			self.error_received(UnknownPeerError(addr))
+			return
+		if ep.tickEntry is not None:
+			ep.tickEntry.active = True
+		res = ep.openTunnel.wrap(data)
+		if res.opcode == Opcode.WRITE_TO_NETWORK:
+			self._writeToNetwork(ep, res)
+		res.release()
+
+	def forceHandshake(self, idx: int) -> None:
+		if self.handshakeScheduler is not None:
+			self.handshakeScheduler.submitForced(partial(self._forceHandshake, idx))
+		else:
+			self._forceHandshake(idx)
+
+	def _forceHandshake(self, idx: int) -> None:
+		ep = self.peers.get(idx)
+		if ep is None:
+			return  # removed while the handshake was queued
+
+		res = ep.openTunnel.force_handshake()
+		if res.opcode == Opcode.WRITE_TO_NETWORK:
+			self._writeToNetwork(ep, res)
+		res.release()
+
+	def connection_made(self, transport):
+		self.transport = transport
+		for ep in self.peers.values():
+			self._startTicking(ep)
+		if self.appProtocol is not None:
+			self.appProtocol.connection_made(self)
+
+	def connection_lost(self, exc):
+		for ep in self.peers.values():
+			if ep.tickEntry is not None:
+				self.timerWheel.unregister(ep.tickEntry)
+				ep.tickEntry = None
+
+		if self.appProtocol is not None:
+			self.appProtocol.connection_lost(exc)
+
+	def error_received(self, exc):
+		if self.appProtocol is not None:
+			self.appProtocol.error_received(exc)
+
+	def get_extra_info(self, name, default=None):
+		if self.transport is None:
+			return default
+		return self.transport.get_extra_info(name, default)
+
+	def get_write_buffer_size(self) -> int:
+		return self.transport.get_write_buffer_size() if self.transport is not None else 0
+
+	def is_closing(self) -> bool:
+		return self.transport is None or self.transport.is_closing()
+
+	def close(self) -> None:
+		for idx in tuple(self.peers):
+			self.removePeer(idx)
+		if self.transport is not None:
+			self.transport.close()
+
+	def abort(self) -> None:
+		self.close()
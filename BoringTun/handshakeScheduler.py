@@ -0,0 +1,174 @@
+"""Admission control of handshakes, the expensive operation (X25519) of WireGuard. Each source host gets a token bucket and all the handshakes share a global budget per second; the handshakes over the budget wait in a bounded queue, so thousands of peers reconnecting at once don't starve the data traffic.
+BoringTun doesn't send cookie replies through its C API (it returns `WireGuardError.UnderLoad` instead, since it gets no source address), so the queue prefers the initiations carrying a MAC2: their senders have already got a cookie from us, so their addresses are not spoofed."""
+
+__all__ = ("TokenBucket", "HandshakeScheduler", "hasMac2")
+
+import asyncio
+import random
+import time
+import typing
+from collections import deque
+
+HANDSHAKE_INITIATION_SIZE = 148
+MAC2_OFFSET = 132
+NO_MAC2 = bytes(16)
+
+DEFAULT_HANDSHAKES_PER_SECOND = 1000
+DEFAULT_PER_SOURCE_RATE = 5
+DEFAULT_PER_SOURCE_BURST = 10
+DEFAULT_QUEUE_LIMIT = 4096
+DEFAULT_JITTER = 1.0
+DEFAULT_MAX_SOURCES = 1 << 16
+
+Process = typing.Callable[[bytes], None]
+
+
+def hasMac2(datagram: typing.Union[bytes, bytearray, memoryview]) -> bool:
+	"""Whether a handshake initiation has a non-zero MAC2, i.e. its sender has a cookie."""
+	return len(datagram) == HANDSHAKE_INITIATION_SIZE and datagram[MAC2_OFFSET:] != NO_MAC2
+
+
+class TokenBucket:
+	__slots__ = ("rate", "burst", "tokens", "updated")
+
+	def __init__(self, rate: float, burst: float, now: float) -> None:
+		self.rate = rate
+		self.burst = burst
+		self.tokens = burst
+		self.updated = now
+
+	def refill(self, now: float) -> float:
+		self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+		return self.tokens
+
+	def take(self, now: float) -> bool:
+		if self.refill(now) < 1:
+			return False
+		self.tokens -= 1
+		return True
+
+	def timeToToken(self, now: float) -> float:
+		return max(0.0, (1 - self.refill(now)) / self.rate)
+
+	def __repr__(self):
+		return self.__class__.__name__ + "<" + format(self.tokens, ".2f") + "/" + repr(self.burst) + ", " + repr(self.rate) + "/s>"
+
+
+class HandshakeScheduler:
+	"""Can be shared by many endpoints and protocols of an event loop.
+	The incoming handshake initiations exceeding the budget of their source are dropped, the ones exceeding the global budget are queued: the ones with MAC2 first, then the forced ones, then the rest. When the queue is full, the newest initiation without MAC2 is dropped to make room for one with MAC2. The forced (outgoing) handshakes exceeding the budget are delayed by a random jitter of up to `jitter` seconds, so the tunnels started at once don't retry in lockstep."""
+
+	__slots__ = ("budget", "perSourceRate", "perSourceBurst", "sources", "maxSources", "queueLimit", "jitter", "cookied", "forced", "fresh", "dropped", "clock", "loop", "_drainHandle")
+
+	def __init__(self, handshakesPerSecond: float = DEFAULT_HANDSHAKES_PER_SECOND, perSourceRate: float = DEFAULT_PER_SOURCE_RATE, perSourceBurst: float = DEFAULT_PER_SOURCE_BURST, queueLimit: int = DEFAULT_QUEUE_LIMIT, jitter: float = DEFAULT_JITTER, maxSources: int = DEFAULT_MAX_SOURCES, clock: typing.Callable[[], float] = time.monotonic) -> None:
+		self.clock = clock
+		self.budget = TokenBucket(handshakesPerSecond, handshakesPerSecond, clock())
+		self.perSourceRate = perSourceRate
+		self.perSourceBurst = perSourceBurst
+		self.sources = {}
+		self.maxSources = maxSources
+		self.queueLimit = queueLimit
+		self.jitter = jitter
+		self.cookied = deque()
+		self.forced = deque()
+		self.fresh = deque()
+		self.dropped = 0
+		self.loop = None
+		self._drainHandle = None
+
+	def __len__(self) -> int:
+		"""The count of the queued handshakes."""
+		return len(self.cookied) + len(self.forced) + len(self.fresh)
+
+	def pending(self) -> typing.Dict[str, int]:
+		return {"cookied": len(self.cookied), "forced": len(self.forced), "fresh": len(self.fresh)}
+
+	def _sourceBucket(self, addr, now: float) -> TokenBucket:
+		host = addr[0]  # not the whole `(host, port)`, a flooder can pick any source port
+		res = self.sources.get(host)
+		if res is None:
+			if len(self.sources) >= self.maxSources:
+				# forgetting the sources whose buckets are full anyway
+				self.sources = {k: v for k, v in self.sources.items() if v.refill(now) < v.burst}
+				if len(self.sources) >= self.maxSources:
+					self.sources.clear()
+			res = self.sources[host] = TokenBucket(self.perSourceRate, self.perSourceBurst, now)
+		return res
+
+	def submitIncoming(self, datagram: typing.Union[bytes, bytearray, memoryview], addr, process: Process) -> bool:
+		"""Calls `process(datagram)` for a handshake initiation from `addr` now or when the budget allows. Returns `False` if it was dropped. The queued datagrams are copied."""
+		now = self.clock()
+		if not self._sourceBucket(addr, now).take(now):
+			self.dropped += 1
+			return False
+
+		if not self and self.budget.take(now):
+			process(datagram)
+			return True
+
+		if hasMac2(datagram):
+			queue = self.cookied
+		else:
+			queue = self.fresh
+
+		if len(self) >= self.queueLimit:
+			if queue is self.cookied and self.fresh:
+				self.fresh.pop()
+				self.dropped += 1
+			else:
+				self.dropped += 1
+				return False
+
+		queue.append((process, bytes(datagram)))
+		self._scheduleDrain(now)
+		return True
+
+	def submitForced(self, process: typing.Callable[[], None]) -> None:
+		"""Calls `process` (sending a forced handshake) now if the budget allows, otherwise after a jittered delay."""
+		now = self.clock()
+		if not self and self.budget.take(now):
+			process()
+			return
+
+		self._getLoop().call_later(random.uniform(0, self.jitter), self._enqueueForced, process)
+
+	def _enqueueForced(self, process: typing.Callable[[], None]) -> None:
+		self.forced.append((process, None))
+		self._scheduleDrain(self.clock())
+
+	def _getLoop(self) -> asyncio.AbstractEventLoop:
+		if self.loop is None:
+			self.loop = asyncio.get_running_loop()
+		return self.loop
+
+	def _scheduleDrain(self, now: float) -> None:
+		if self._drainHandle is None:
+			self._drainHandle = self._getLoop().call_later(self.budget.timeToToken(now), self.drain)
+
+	def drain(self) -> None:
+		"""Processes the queued handshakes the budget allows now."""
+		self._drainHandle = None
+		now = self.clock()
+		while self:
+			if not self.budget.take(now):
+				self._scheduleDrain(now)
+				return
+
+			for queue in (self.cookied, self.forced, self.fresh):
+				if queue:
+					process, datagram = queue.popleft()
+					break
+
+			try:
+				if datagram is None:
+					process()
+				else:
+					process(datagram)
+			except Exception:  # pylint:disable=broad-except
+				import traceback
+
+				print(traceback.format_exc())
+
+	def __repr__(self):
+		return self.__class__.__name__ + "<" + repr(self.budget) + ", queued: " + repr(self.pending()) + ", dropped: " + repr(self.dropped) + ">"
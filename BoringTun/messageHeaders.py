@@ -0,0 +1,207 @@
+"""Parsing of the headers of many WireGuard messages at once, i.e. of a batch received by `udpBatch`, for dispatching and demultiplexing them without indexing every datagram in Python.
+With `numpy` all the fields are gathered with a few array operations. Without it, if the datagrams are in slots of equal size (as in a `udpBatch.DatagramBatch`), the first 16 bytes of all the slots are gathered by a single `struct.iter_unpack` and reinterpreted by `memoryview.cast`; only the datagrams that are not data messages are parsed one by one then. Otherwise every header is unpacked by `struct`."""
+
+__all__ = ("MessageType", "MessageHeaders", "parseHeaders", "MIN_MESSAGE_SIZES")
+
+import re
+import struct
+import sys
+import typing
+from array import array
+from enum import IntEnum
+from operator import itemgetter
+
+
+class MessageType(IntEnum):
+	HANDSHAKE_INITIATION = 1
+	HANDSHAKE_RESPONSE = 2
+	COOKIE_REPLY = 3
+	DATA = 4
+
+
+INVALID_MESSAGE_TYPE = 0
+
+MIN_MESSAGE_SIZES = {
+	MessageType.HANDSHAKE_INITIATION: 148,
+	MessageType.HANDSHAKE_RESPONSE: 92,
+	MessageType.COOKIE_REPLY: 64,
+	MessageType.DATA: 32,  # the header and the tag of a keepalive
+}
+
+HEADER_SPAN = 16  # the type, the reserved bytes, the receiver index and the counter of a data message
+RECEIVER_INDEX = struct.Struct("<I")
+DATA_HEADER = struct.Struct("<IQ")
+RECEIVER_INDEX_OFFSETS = {
+	MessageType.HANDSHAKE_RESPONSE: 8,
+	MessageType.COOKIE_REPLY: 4,
+	MessageType.DATA: 4,
+}
+
+NOT_DATA = re.compile(b"[^" + re.escape(bytes((MessageType.DATA,))) + b"]")
+
+Buffer = typing.Union[bytes, bytearray, memoryview]
+
+
+class MessageHeaders:
+	"""The fields of the headers of a batch of messages, in parallel arrays. `types` are 0 for the messages that are too short for their types or of unknown types, `receivers` are 0 for the ones having no receiver index (the handshake initiations), `counters` are nonzero only for the data messages. BoringTun puts the index of the tunnel into the upper 24 bits of the receiver indexes, see `endpoint.tunnelIndexOf`."""
+
+	__slots__ = ("types", "receivers", "counters", "sizes")
+
+	def __init__(self, sizes: array) -> None:
+		count = len(sizes)
+		self.types = array("B", bytes(count))
+		self.receivers = array("I", bytes(4 * count))
+		self.counters = array("Q", bytes(8 * count))
+		self.sizes = sizes
+
+	def __len__(self) -> int:
+		return len(self.types)
+
+	def positions(self, msgType: int) -> typing.List[int]:
+		"""The indexes of the messages of the type."""
+		types = self.types.tobytes()
+		needle = bytes((msgType,))
+		res = []
+		i = types.find(needle)
+		while i != -1:
+			res.append(i)
+			i = types.find(needle, i + 1)
+		return res
+
+	def asNumpy(self) -> typing.Tuple["numpy.ndarray", "numpy.ndarray", "numpy.ndarray", "numpy.ndarray"]:
+		"""Returns `(types, receivers, counters, sizes)` as `numpy` arrays sharing memory with this object. Requires `numpy`."""
+		import numpy as np
+
+		return np.frombuffer(self.types, dtype=np.uint8), np.frombuffer(self.receivers, dtype=np.uint32), np.frombuffer(self.counters, dtype=np.uint64), np.frombuffer(self.sizes, dtype=np.uint32)
+
+	def __repr__(self):
+		return self.__class__.__name__ + "<" + repr(len(self)) + " messages>"
+
+
+def _uint32Array(values: typing.Sequence[int]) -> array:
+	if isinstance(values, (array, memoryview)):
+		view = memoryview(values)
+		if view.format == "I" and view.contiguous:
+			return array("I", view.tobytes())
+	return array("I", values)
+
+
+def _parseOne(buffer: Buffer, offset: int, size: int) -> typing.Tuple[int, int, int]:
+	"""Returns the type, the receiver index and the counter of a message."""
+	msgType = buffer[offset] if size else INVALID_MESSAGE_TYPE
+	minSize = MIN_MESSAGE_SIZES.get(msgType)
+	if minSize is None or size < minSize:
+		return INVALID_MESSAGE_TYPE, 0, 0
+
+	if msgType == MessageType.DATA:
+		receiver, counter = DATA_HEADER.unpack_from(buffer, offset + 4)
+		return msgType, receiver, counter
+
+	receiverOffset = RECEIVER_INDEX_OFFSETS.get(msgType)
+	if receiverOffset is None:
+		return msgType, 0, 0
+	return msgType, RECEIVER_INDEX.unpack_from(buffer, offset + receiverOffset)[0], 0
+
+
+def _parseLoop(res: MessageHeaders, buffer: Buffer, starts: typing.Sequence[int], indexes: typing.Iterable[int]) -> None:
+	types = res.types
+	receivers = res.receivers
+	counters = res.counters
+	sizes = res.sizes
+	for i in indexes:
+		types[i], receivers[i], counters[i] = _parseOne(buffer, starts[i], sizes[i])
+
+
+def _parseNumpy(res: MessageHeaders, buffer: Buffer, starts: typing.Sequence[int], np) -> None:
+	count = len(res)
+	buf = np.frombuffer(buffer, dtype=np.uint8)
+	_types, _receivers, _counters, sizes = res.asNumpy()
+	starts = np.asarray(starts[:count], dtype=np.intp)
+
+	idx = starts[:, None] + np.arange(HEADER_SPAN)
+	np.minimum(idx, len(buf) - 1, out=idx)  # the bytes past the short datagrams are masked out below
+	hdr = buf[idx]
+	types = hdr[:, 0]
+
+	minSizes = np.full(256, 0xFFFFFFFF, dtype=np.uint32)
+	for msgType, minSize in MIN_MESSAGE_SIZES.items():
+		minSizes[msgType] = minSize
+	types = np.where(sizes >= minSizes[types], types, INVALID_MESSAGE_TYPE)
+
+	words = hdr.view("<u4")
+	receiverAt4 = (types == MessageType.DATA) | (types == MessageType.COOKIE_REPLY)
+	_types[:] = types
+	_receivers[:] = np.where(receiverAt4, words[:, 1], np.where(types == MessageType.HANDSHAKE_RESPONSE, words[:, 2], 0))
+	_counters[:] = np.where(types == MessageType.DATA, np.ascontiguousarray(hdr[:, 8:16]).view("<u8")[:, 0], 0)
+
+
+def _stride(starts: typing.Sequence[int], count: int, bufferSize: int) -> typing.Optional[int]:
+	"""The distance between the datagrams, if it is constant and all their slots are within the buffer."""
+	if count < 2:
+		return None
+	first = starts[0]
+	stride = starts[1] - first
+	if stride < HEADER_SPAN or first + count * stride > bufferSize:
+		return None
+
+	expected = memoryview(array("I", range(first, first + count * stride, stride)))
+	try:
+		same = expected == memoryview(starts)[:count]
+	except TypeError:
+		same = expected.tolist() == list(starts[:count])
+	return stride if same else None
+
+
+def _parseStrided(res: MessageHeaders, buffer: Buffer, starts: typing.Sequence[int], stride: int) -> None:
+	count = len(res)
+	first = starts[0]
+	slotFormat = str(HEADER_SPAN) + "s" + str(stride - HEADER_SPAN) + "x"  # the compiled formats are cached by `struct`
+	with memoryview(buffer) as src:
+		hdr = memoryview(b"".join(map(itemgetter(0), struct.iter_unpack(slotFormat, src[first : first + count * stride]))))
+
+	res.types[:] = array("B", hdr[0::HEADER_SPAN].tobytes())
+	res.receivers[:] = array("I", hdr.cast("I")[1::4].tobytes())
+	res.counters[:] = array("Q", hdr.cast("Q")[1::2].tobytes())
+	if sys.byteorder != "little":
+		res.receivers.byteswap()
+		res.counters.byteswap()
+
+	# the fields were taken as if all the messages were data messages, the rest are parsed one by one
+	if min(res.sizes) < MIN_MESSAGE_SIZES[MessageType.DATA]:
+		exceptions = range(count)
+	else:
+		exceptions = [m.start() for m in NOT_DATA.finditer(res.types.tobytes())]
+	_parseLoop(res, buffer, starts, exceptions)
+
+
+def parseHeaders(buffer: Buffer, offsets: typing.Sequence[int], sizes: typing.Optional[typing.Sequence[int]] = None, useNumpy: typing.Optional[bool] = None) -> MessageHeaders:
+	"""Parses the headers of the messages in `buffer`. `offsets` are either the boundaries of the messages (so they are 1 more than the messages), or, if `sizes` are given, their starts; i.e. `(batch.buffer, batch.usedOffsets, batch.usedSizes)` of a `udpBatch.DatagramBatch`, as for `OpenTunnel.unwrap_many`.
+	`numpy` is used if it is available, unless `useNumpy` is `False`."""
+	if sizes is None:
+		sizes = array("I", [offsets[i + 1] - offsets[i] for i in range(len(offsets) - 1)])
+	else:
+		sizes = _uint32Array(sizes)
+	res = MessageHeaders(sizes)
+	count = len(sizes)
+
+	if not count or not len(buffer):
+		return res
+
+	np = None
+	if useNumpy is not False:
+		try:
+			import numpy as np
+		except ImportError:
+			if useNumpy:
+				raise
+
+	if np is not None:
+		_parseNumpy(res, buffer, offsets, np)
+		return res
+
+	stride = _stride(offsets, count, len(buffer))
+	if stride is not None:
+		_parseStrided(res, buffer, offsets, stride)
+	else:
+		_parseLoop(res, buffer, offsets, range(count))
+	return res
@@ -0,0 +1,276 @@
+"""Opt-in counters of tunnels and protocols. Instrumentation is enabled per object by swapping its class to an instrumented subclass, so the objects without it run exactly the same code as before and pay nothing."""
+
+__all__ = ("Histogram", "TunnelMetrics", "MetricsRegistry", "REGISTRY", "enableMetrics", "disableMetrics", "instruments", "instrument", "uninstrument", "InstrumentedOpenTunnel")
+
+import itertools
+import typing
+import weakref
+from bisect import bisect_left
+from time import perf_counter_ns
+
+from .ctypes import WireGuardError
+from .Tunnel import Action, BatchResult, Opcode, OpenTunnel
+
+LATENCY_BOUNDS_NS = tuple(1000 << i for i in range(21))  # 1 µs .. ~1 s
+BATCH_SIZE_BOUNDS = tuple(1 << i for i in range(11))  # 1 .. 1024
+OPCODES_COUNT = max(Opcode) + 1
+
+INSTRUMENTED_CLASSES = {}
+UNINSTRUMENTED_CLASSES = {}
+
+
+def instruments(baseClass: type) -> typing.Callable[[type], type]:
+	"""Registers the decorated class as the instrumented version of `baseClass`. It must have `__slots__ = ()` and the base must have the `metrics` slot."""
+
+	def decorator(cls: type) -> type:
+		INSTRUMENTED_CLASSES[baseClass] = cls
+		UNINSTRUMENTED_CLASSES[cls] = baseClass
+		return cls
+
+	return decorator
+
+
+def instrument(obj, metrics: "TunnelMetrics") -> None:
+	"""Swaps the class of `obj` to the instrumented one, without registering it. The instrumented class may define `_metricsEnabled` and `_metricsDisabled` hooks, i.e. to instrument the objects it owns."""
+	cls = type(obj)
+	if cls in UNINSTRUMENTED_CLASSES:
+		return
+
+	instrumentedCls = INSTRUMENTED_CLASSES.get(cls)
+	if instrumentedCls is None:
+		raise TypeError("No instrumented version of the class", cls)
+
+	obj.metrics = metrics
+	obj.__class__ = instrumentedCls
+	hook = getattr(obj, "_metricsEnabled", None)
+	if hook is not None:
+		hook()
+
+
+def uninstrument(obj) -> None:
+	cls = UNINSTRUMENTED_CLASSES.get(type(obj))
+	if cls is None:
+		return
+
+	hook = getattr(obj, "_metricsDisabled", None)
+	if hook is not None:
+		hook()
+	obj.__class__ = cls
+	obj.metrics = None
+
+
+class Histogram:
+	"""Counts of observations `<=` each of the `bounds`, the last bucket is for the ones above all the bounds."""
+
+	__slots__ = ("bounds", "counts", "sum", "count")
+
+	def __init__(self, bounds: typing.Sequence[int]) -> None:
+		self.bounds = bounds
+		self.counts = [0] * (len(bounds) + 1)
+		self.sum = 0
+		self.count = 0
+
+	def observe(self, value: int) -> None:
+		self.counts[bisect_left(self.bounds, value)] += 1
+		self.sum += value
+		self.count += 1
+
+	def cumulative(self) -> typing.Iterator[typing.Tuple[typing.Optional[int], int]]:
+		"""`(upper bound, count of observations <= it)`, the bound of the last bucket is `None` (infinity)."""
+		return zip(itertools.chain(self.bounds, (None,)), itertools.accumulate(self.counts))
+
+	def asDict(self) -> typing.Dict[str, typing.Any]:
+		return {"buckets": [[bound, count] for bound, count in self.cumulative()], "sum": self.sum, "count": self.count}
+
+
+class TunnelMetrics:
+	"""`results` are the counts of results by opcode, `errors` are the counts of the error codes of `Opcode.WIREGUARD_ERROR`, `latencies` are in nanoseconds, per operation."""
+
+	__slots__ = ("name", "results", "errors", "latencies", "batchSizes")
+
+	def __init__(self, name: str) -> None:
+		self.name = name
+		self.results = [0] * OPCODES_COUNT
+		self.errors = {}
+		self.latencies = {}
+		self.batchSizes = {}
+
+	def _latency(self, op: str) -> Histogram:
+		res = self.latencies.get(op)
+		if res is None:
+			res = self.latencies[op] = Histogram(LATENCY_BOUNDS_NS)
+		return res
+
+	def countResult(self, opcode: int, size: int) -> None:
+		self.results[opcode] += 1
+		if opcode == Opcode.WIREGUARD_ERROR:
+			self.errors[size] = self.errors.get(size, 0) + 1
+
+	def observe(self, op: str, elapsed: int, opcode: int, size: int) -> None:
+		self._latency(op).observe(elapsed)
+		self.countResult(opcode, size)
+
+	def observeAction(self, op: str, elapsed: int, res: Action) -> None:
+		# for errors `buf` is sliced by the error code
+		self.observe(op, elapsed, res.opcode, len(res.buf) if res.buf is not None else 0)
+
+	def observeBatch(self, op: str, elapsed: int, res: BatchResult) -> None:
+		self._latency(op).observe(elapsed)
+		sizes = self.batchSizes.get(op)
+		if sizes is None:
+			sizes = self.batchSizes[op] = Histogram(BATCH_SIZE_BOUNDS)
+		sizes.observe(len(res))
+		for opcode, size in zip(res.opcodes, res.sizes):
+			self.countResult(opcode, size)
+
+	def snapshot(self) -> typing.Dict[str, typing.Any]:
+		return {
+			"results": {Opcode(i).name: count for i, count in enumerate(self.results) if count},
+			"errors": {errorName(code): count for code, count in self.errors.items()},
+			"latencies": {op: h.asDict() for op, h in self.latencies.items()},
+			"batchSizes": {op: h.asDict() for op, h in self.batchSizes.items()},
+		}
+
+
+def errorName(code: int) -> str:
+	try:
+		return WireGuardError(code).name
+	except ValueError:
+		return str(code)
+
+
+class MetricsRegistry:
+	"""Keeps the instrumented objects (weakly) for exporting their metrics at once. An object may provide `metricsGauges() -> Dict[str, number]` with the values sampled at snapshot time."""
+
+	__slots__ = ("objects", "counter")
+
+	def __init__(self) -> None:
+		self.objects = weakref.WeakKeyDictionary()
+		self.counter = itertools.count()
+
+	def enable(self, obj, name: typing.Optional[str] = None) -> TunnelMetrics:
+		"""Swaps the class of `obj` to the instrumented one and registers it."""
+		cls = type(obj)
+		if cls in UNINSTRUMENTED_CLASSES:
+			return obj.metrics
+
+		if name is None:
+			name = cls.__name__ + str(next(self.counter))
+		metrics = TunnelMetrics(name)
+
+		instrument(obj, metrics)
+		self.objects[obj] = metrics
+		return metrics
+
+	def disable(self, obj) -> None:
+		uninstrument(obj)
+		self.objects.pop(obj, None)
+
+	def snapshot(self) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+		res = {}
+		for obj, metrics in list(self.objects.items()):
+			s = res[metrics.name] = metrics.snapshot()
+			gauges = getattr(obj, "metricsGauges", None)
+			if gauges is not None:
+				s["gauges"] = gauges()
+		return res
+
+	def toPrometheus(self, prefix: str = "boringtun") -> str:
+		"""Renders the snapshot in the Prometheus text exposition format."""
+		families = {}
+
+		def add(family: str, kind: str, sampleName: str, labels: typing.Dict[str, str], value: typing.Union[int, float]) -> None:
+			samples = families.get(family)
+			if samples is None:
+				samples = families[family] = ["# TYPE " + prefix + "_" + family + " " + kind]
+			samples.append(prefix + "_" + sampleName + "{" + ",".join(k + '="' + _escapeLabel(str(v)) + '"' for k, v in labels.items()) + "} " + repr(value))
+
+		def addHistogram(family: str, labels: typing.Dict[str, str], h: typing.Dict[str, typing.Any], divisor: float = 1) -> None:
+			for bound, count in h["buckets"]:
+				add(family, "histogram", family + "_bucket", dict(labels, le="+Inf" if bound is None else repr(bound / divisor)), count)
+			add(family, "histogram", family + "_sum", labels, h["sum"] / divisor)
+			add(family, "histogram", family + "_count", labels, h["count"])
+
+		for tunnelName, s in self.snapshot().items():
+			tunnel = {"tunnel": tunnelName}
+			for opcodeName, count in s["results"].items():
+				add("results_total", "counter", "results_total", dict(tunnel, opcode=opcodeName), count)
+			for error, count in s["errors"].items():
+				add("errors_total", "counter", "errors_total", dict(tunnel, error=error), count)
+			for op, h in s["latencies"].items():
+				addHistogram("latency_seconds", dict(tunnel, op=op), h, 1e9)
+			for op, h in s["batchSizes"].items():
+				addHistogram("batch_size", dict(tunnel, op=op), h)
+			for gauge, value in s.get("gauges", {}).items():
+				add(gauge, "gauge", gauge, tunnel, value)
+
+		return "\n".join(itertools.chain.from_iterable(families.values())) + "\n"
+
+
+def _escapeLabel(v: str) -> str:
+	return v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+REGISTRY = MetricsRegistry()
+
+
+def enableMetrics(obj, name: typing.Optional[str] = None, registry: MetricsRegistry = REGISTRY) -> TunnelMetrics:
+	"""Enables counting for an `OpenTunnel` or an `asyncio.BoringTUNProtocol` (which also instruments its tunnel)."""
+	return registry.enable(obj, name)
+
+
+def disableMetrics(obj, registry: MetricsRegistry = REGISTRY) -> None:
+	registry.disable(obj)
+
+
+@instruments(OpenTunnel)
+class InstrumentedOpenTunnel(OpenTunnel):
+	__slots__ = ()
+
+	def wrap(self, src: bytes) -> Action:
+		start = perf_counter_ns()
+		res = super().wrap(src)
+		self.metrics.observeAction("wrap", perf_counter_ns() - start, res)
+		return res
+
+	def unwrap(self, src: bytes) -> Action:
+		start = perf_counter_ns()
+		res = super().unwrap(src)
+		self.metrics.observeAction("unwrap", perf_counter_ns() - start, res)
+		return res
+
+	def wrap_into(self, src: bytes, dst: bytearray) -> typing.Tuple[Opcode, int]:
+		start = perf_counter_ns()
+		opcode, size = super().wrap_into(src, dst)
+		self.metrics.observe("wrap", perf_counter_ns() - start, opcode, size)
+		return opcode, size
+
+	def unwrap_into(self, src: bytes, dst: bytearray) -> typing.Tuple[Opcode, int]:
+		start = perf_counter_ns()
+		opcode, size = super().unwrap_into(src, dst)
+		self.metrics.observe("unwrap", perf_counter_ns() - start, opcode, size)
+		return opcode, size
+
+	def wrap_many(self, packets, offsets=None, sizes=None) -> BatchResult:
+		start = perf_counter_ns()
+		res = super().wrap_many(packets, offsets, sizes)
+		self.metrics.observeBatch("wrap_many", perf_counter_ns() - start, res)
+		return res
+
+	def unwrap_many(self, datagrams, offsets=None, sizes=None) -> BatchResult:
+		start = perf_counter_ns()
+		res = super().unwrap_many(datagrams, offsets, sizes)
+		self.metrics.observeBatch("unwrap_many", perf_counter_ns() - start, res)
+		return res
+
+	def tick(self) -> Action:
+		start = perf_counter_ns()
+		res = super().tick()
+		self.metrics.observeAction("tick", perf_counter_ns() - start, res)
+		return res
+
+	def force_handshake(self) -> Action:
+		start = perf_counter_ns()
+		res = super().force_handshake()
+		self.metrics.observeAction("force_handshake", perf_counter_ns() - start, res)
+		return res
@@ -0,0 +1,170 @@
+"""Running the crypto of tunnels on a thread pool. `ctypes` releases the GIL for the duration of a call into `CDLL`, so `wireguard_write`/`wireguard_read` of big packets run in parallel with the event loop and with each other.
+For small packets the overhead of passing the work to a thread exceeds the gain, `benchmarkCrossover` measures where the crossover is on the machine."""
+
+__all__ = ("TunnelOffloader", "getDefaultExecutor", "benchmarkCrossover")
+
+import os
+import threading
+import time
+import typing
+from concurrent.futures import Executor, ThreadPoolExecutor
+
+from .tunnelMiddleLevel import BatchResult
+
+_defaultExecutor = None
+_defaultExecutorLock = threading.Lock()
+
+
+def getDefaultExecutor() -> ThreadPoolExecutor:
+	"""Returns the pool shared by all the offloaded tunnels of the process, creating it if needed."""
+	global _defaultExecutor  # pylint:disable=global-statement
+
+	with _defaultExecutorLock:
+		if _defaultExecutor is None:
+			_defaultExecutor = ThreadPoolExecutor(os.cpu_count(), thread_name_prefix="BoringTUN")
+		return _defaultExecutor
+
+
+ResultsCallback = typing.Callable[[typing.List[bytes], typing.Optional[BatchResult], typing.Optional[BatchResult]], None]
+
+
+class TunnelOffloader:
+	"""Processes the packets of a single tunnel on `executor`. At most one batch of the tunnel is in flight, so the order of the packets is kept, while different tunnels are processed in parallel. The packets submitted while a batch is in flight are coalesced into the next batch.
+	`onResults(datagrams, unwrapped, wrapped)` is called in a worker thread with the unwrapped datagrams and the results for them and for the wrapped packets, either result is `None` if there was nothing to process in that direction."""
+
+	__slots__ = ("openTunnel", "executor", "onResults", "lock", "wraps", "unwraps", "pendingBytes", "busy", "onClosed")
+
+	def __init__(self, openTunnel: "OpenTunnel", onResults: ResultsCallback, executor: typing.Optional[Executor] = None) -> None:
+		if executor is None:
+			executor = getDefaultExecutor()
+
+		self.openTunnel = openTunnel
+		self.executor = executor
+		self.onResults = onResults
+		self.lock = threading.Lock()
+		self.wraps = []
+		self.unwraps = []
+		self.pendingBytes = 0
+		self.busy = False
+		self.onClosed = None
+
+	def wrap(self, packet: bytes) -> None:
+		"""The packet must not be modified till it is processed."""
+		self._submit(self.wraps, (packet,))
+
+	def unwrap(self, datagram: bytes) -> None:
+		self._submit(self.unwraps, (datagram,))
+
+	def wrap_many(self, packets: typing.Sequence[bytes]) -> None:
+		self._submit(self.wraps, packets)
+
+	def unwrap_many(self, datagrams: typing.Sequence[bytes]) -> None:
+		self._submit(self.unwraps, datagrams)
+
+	def _submit(self, queue: typing.List[bytes], items: typing.Sequence[bytes]) -> None:
+		with self.lock:
+			if self.onClosed is not None:
+				return
+			queue.extend(items)
+			self.pendingBytes += sum(len(el) for el in items)
+			if self.busy:
+				return
+			self.busy = True
+			job = self._take()
+
+		self.executor.submit(self._run, *job)
+
+	def _take(self) -> typing.Tuple[typing.List[bytes], typing.List[bytes]]:
+		res = self.unwraps, self.wraps
+		self.unwraps = []
+		self.wraps = []
+		self.pendingBytes = 0
+		return res
+
+	def _run(self, unwraps: typing.List[bytes], wraps: typing.List[bytes]) -> None:
+		try:
+			unwrapped = self.openTunnel.unwrap_many(unwraps) if unwraps else None
+			wrapped = self.openTunnel.wrap_many(wraps) if wraps else None
+			self.onResults(unwraps, unwrapped, wrapped)
+		except Exception:  # pylint:disable=broad-except
+			import traceback
+
+			print(traceback.format_exc())
+
+		with self.lock:
+			if self.onClosed is not None or not self.unwraps and not self.wraps:
+				self.busy = False
+				onClosed = self.onClosed
+				job = None
+			else:
+				job = self._take()
+
+		if job is None:
+			if onClosed is not None:
+				onClosed()
+			return
+
+		# resubmitted instead of looping, so a busy tunnel doesn't occupy a worker while other tunnels wait
+		self.executor.submit(self._run, *job)
+
+	def close(self, onClosed: typing.Callable[[], None]) -> None:
+		"""Drops the pending packets and calls `onClosed` when the batch in flight is done, right away if there is none. The tunnel must not be freed before that."""
+		with self.lock:
+			self._take()
+			self.onClosed = onClosed
+			busy = self.busy
+
+		if not busy:
+			onClosed()
+
+	def __len__(self) -> int:
+		"""The count of packets waiting for the next batch."""
+		return len(self.wraps) + len(self.unwraps)
+
+
+def benchmarkCrossover(packetSizes: typing.Iterable[int] = (64, 256, 1420), batchSizes: typing.Iterable[int] = (1, 16, 128), tunnelsCount: int = 4, packetsPerTunnel: int = 4096, executor: typing.Optional[Executor] = None) -> typing.List[typing.Dict[str, typing.Union[int, float]]]:
+	"""Encrypts `packetsPerTunnel` packets in each of `tunnelsCount` tunnels, in batches of each of `batchSizes`, inline and offloaded to `executor` (where the batches submitted while a tunnel is busy are coalesced). Returns the throughputs in packets per second; offloading is worth enabling for the sizes where `speedup` is above 1."""
+	from .bench import closeTunnels, connectedTunnels
+
+	if executor is None:
+		executor = getDefaultExecutor()
+
+	pairs = [connectedTunnels() for i in range(tunnelsCount)]
+	res = []
+	try:
+		for packetSize in packetSizes:
+			packet = bytes(packetSize)
+			for batchSize in batchSizes:
+				batchesCount = max(1, packetsPerTunnel // batchSize)
+				total = batchesCount * batchSize * tunnelsCount
+
+				start = time.perf_counter()
+				for i in range(batchesCount):
+					for t1, ot, t2, ot2 in pairs:
+						ot.wrap_many([packet] * batchSize)
+				inline = total / (time.perf_counter() - start)
+
+				remaining = [total]
+				done = threading.Event()
+				counterLock = threading.Lock()
+
+				def onResults(datagrams, unwrapped, wrapped):
+					with counterLock:
+						remaining[0] -= len(wrapped)
+						if not remaining[0]:
+							done.set()
+
+				offloaders = [TunnelOffloader(ot, onResults, executor) for t1, ot, t2, ot2 in pairs]
+				start = time.perf_counter()
+				for i in range(batchesCount):
+					for o in offloaders:
+						o.wrap_many([packet] * batchSize)
+				done.wait()
+				offloaded = total / (time.perf_counter() - start)
+
+				res.append({"packetSize": packetSize, "batchSize": batchSize, "inline": inline, "offloaded": offloaded, "speedup": offloaded / inline})
+	finally:
+		for t1, ot, t2, ot2 in pairs:
+			closeTunnels(t1, t2)
+
+	return res
@@ -0,0 +1,547 @@
+"""Spreading tunnels across worker processes. Each tunnel lives in exactly one worker (chosen by its index), so the per-tunnel order of packets is kept, while different tunnels are processed in parallel on different cores.
+Packets and results are passed through single-producer single-consumer rings in `multiprocessing.shared_memory`, a pipe is only used as a doorbell, once per batch.
+Python has no memory fences, so the rings are lock-free only on x86, where the stores are seen by other cores in program order (TSO). On the weakly ordered CPUs (ARM, POWER, RISC-V) a record could be seen published before its payload is, so there every ring is guarded by a `multiprocessing.Lock`, whose semaphore operations are full barriers."""
+
+__all__ = ("ShmRing", "ShardedEngine", "ShardedWireGuardEndpoint", "Command")
+
+import asyncio
+import multiprocessing
+import platform
+import struct
+import time
+import typing
+from enum import IntEnum
+from multiprocessing.shared_memory import SharedMemory
+
+from .config import NO_KEEPALIVE, Interface, Peer
+from .endpoint import EndpointPeer, UnknownPeerError, WireGuardEndpoint
+from .handshakeScheduler import HandshakeScheduler
+from .timerWheel import TICK_INTERVAL
+from .Tunnel import Base64TunnelDataCache, Opcode, OpenTunnel, Tunnel
+from .tunnelMiddleLevel import MAX_WIREGUARD_PACKET_SIZE
+from .udpBatch import DatagramBatch
+
+# pylint:disable=too-many-instance-attributes
+
+RING_HEADER_SIZE = 128  # `head` and `tail` are kept in different cache lines
+RECORD_HEADER = struct.Struct("<II")  # size, tag
+RECORD_ALIGNMENT = 8
+WRAP_MARKER = 0xFFFFFFFF
+DEFAULT_RING_SIZE = 1 << 22
+IS_STRONGLY_ORDERED = platform.machine().lower() in {"x86_64", "amd64", "i386", "i486", "i586", "i686", "x86"}
+
+
+class ShmRing:
+	"""A single-producer single-consumer ring of variable-size records `(tag: u32, payload)` in shared memory.
+	`head` is only written by the consumer and `tail` only by the producer, both are monotonic 64-bit counters; aligned 8-byte stores of them are atomic on all the platforms CPython runs on. A record is published by storing `tail` after its payload, which is enough only on x86 (TSO); elsewhere pass the same `lock` (i.e. a `multiprocessing.Lock`) to both ends, see `IS_STRONGLY_ORDERED`."""
+
+	__slots__ = ("shm", "capacity", "counters", "data", "owner", "lock")
+
+	def __init__(self, name: typing.Optional[str] = None, capacity: int = DEFAULT_RING_SIZE, lock=None) -> None:
+		self.lock = lock
+		if name is None:
+			if capacity & (capacity - 1):
+				raise ValueError("Capacity must be a power of 2", capacity)
+			self.shm = SharedMemory(create=True, size=RING_HEADER_SIZE + capacity)
+			self.owner = True
+		else:
+			self.shm = SharedMemory(name=name)
+			self.owner = False
+
+		self.capacity = self.shm.size - RING_HEADER_SIZE
+		self.capacity = 1 << (self.capacity.bit_length() - 1)  # the OS may round the size up to pages
+		self.counters = self.shm.buf[:RING_HEADER_SIZE].cast("Q")
+		self.data = self.shm.buf[RING_HEADER_SIZE : RING_HEADER_SIZE + self.capacity]
+		if self.owner:
+			self.counters[0] = 0  # head
+			self.counters[8] = 0  # tail
+
+	@property
+	def name(self) -> str:
+		return self.shm.name
+
+	@property
+	def maxPayloadSize(self) -> int:
+		"""A record of at most a half of the capacity fits into the drained ring wherever it wraps, a bigger one may never fit."""
+		return self.capacity // 2 - RECORD_HEADER.size
+
+	def __len__(self) -> int:
+		"""The count of bytes occupied."""
+		return self.counters[8] - self.counters[0]
+
+	def push(self, tag: int, payload: typing.Union[bytes, bytearray, memoryview] = b"", prefix: bytes = b"") -> bool:
+		"""Appends a record, its payload is `prefix + payload` without concatenating them. Returns `False` if there is no space for it now. Raises `ValueError` if the payload is bigger than `maxPayloadSize`, so the callers retrying till it fits cannot spin forever."""
+		if self.lock is None:
+			return self._push(tag, payload, prefix)
+		with self.lock:
+			return self._push(tag, payload, prefix)
+
+	def peek(self) -> typing.Optional[typing.Tuple[int, memoryview]]:
+		"""Returns the oldest record without removing it. The payload is a view into the ring valid until `pop`."""
+		if self.lock is None:
+			return self._peek()
+		with self.lock:
+			return self._peek()
+
+	def pop(self) -> None:
+		"""Removes the record returned by `peek`."""
+		if self.lock is None:
+			self._pop()
+		else:
+			with self.lock:
+				self._pop()
+
+	def _push(self, tag: int, payload: typing.Union[bytes, bytearray, memoryview], prefix: bytes) -> bool:
+		size = len(prefix) + len(payload)
+		if size > self.maxPayloadSize:
+			raise ValueError("The payload is too big for the ring", size, self.maxPayloadSize)
+		recordSize = (RECORD_HEADER.size + size + RECORD_ALIGNMENT - 1) & ~(RECORD_ALIGNMENT - 1)
+		head = self.counters[0]
+		tail = self.counters[8]
+		pos = tail & (self.capacity - 1)
+		tillEnd = self.capacity - pos
+
+		needed = recordSize
+		if recordSize > tillEnd:
+			needed += tillEnd  # the rest of the buffer is skipped
+
+		if self.capacity - (tail - head) < needed:
+			return False
+
+		if recordSize > tillEnd:
+			RECORD_HEADER.pack_into(self.data, pos, WRAP_MARKER, 0)
+			tail += tillEnd
+			pos = 0
+
+		RECORD_HEADER.pack_into(self.data, pos, size, tag)
+		start = pos + RECORD_HEADER.size
+		if prefix:
+			self.data[start : start + len(prefix)] = prefix
+			start += len(prefix)
+		self.data[start : pos + RECORD_HEADER.size + size] = payload
+		self.counters[8] = tail + recordSize
+		return True
+
+	def _peek(self) -> typing.Optional[typing.Tuple[int, memoryview]]:
+		head = self.counters[0]
+		if head == self.counters[8]:
+			return None
+
+		pos = head & (self.capacity - 1)
+		size, tag = RECORD_HEADER.unpack_from(self.data, pos)
+		if size == WRAP_MARKER:
+			head += self.capacity - pos
+			self.counters[0] = head
+			pos = 0
+			size, tag = RECORD_HEADER.unpack_from(self.data, pos)
+
+		start = pos + RECORD_HEADER.size
+		return tag, self.data[start : start + size]
+
+	def _pop(self) -> None:
+		head = self.counters[0]
+		pos = head & (self.capacity - 1)
+		size = RECORD_HEADER.unpack_from(self.data, pos)[0]
+		self.counters[0] = head + ((RECORD_HEADER.size + size + RECORD_ALIGNMENT - 1) & ~(RECORD_ALIGNMENT - 1))
+
+	def close(self) -> None:
+		self.counters.release()
+		self.data.release()
+		self.shm.close()
+		if self.owner:
+			self.shm.unlink()
+
+
+class Command(IntEnum):
+	ADD = 1
+	REMOVE = 2
+	WRAP = 3
+	UNWRAP = 4
+	FORCE_HANDSHAKE = 5
+	STOP = 0xFF
+
+
+TAG_INDEX_MASK = (1 << 24) - 1
+TUNNEL_SPEC_HEADER = struct.Struct("<HB")  # keepalive, has PSK
+ERROR_CODE = struct.Struct("<I")
+UNWRAP_REQUEST_HEADER = struct.Struct("<I")  # a sequence number, echoed in the status
+UNWRAP_STATUS = struct.Struct("<IB")  # the sequence number, whether the datagram is authentic
+UNWRAPPED = 0xFE  # the kind of the responses carrying `UNWRAP_STATUS`
+
+
+def makeTag(kind: int, idx: int) -> int:
+	"""Tags of the requests contain a `Command` and of the responses an `Opcode` or `UNWRAPPED`, in the upper 8 bits, and the tunnel index in the lower 24 ones."""
+	return kind << 24 | idx
+
+
+def encodeTunnelSpec(b64c: Base64TunnelDataCache, keepAlive: typing.Optional[int]) -> bytes:
+	return TUNNEL_SPEC_HEADER.pack(NO_KEEPALIVE if keepAlive is None else keepAlive, b64c.psk is not None) + b64c.sec + b64c.pub + (b64c.psk if b64c.psk is not None else b"")
+
+
+class _WorkerTunnelData:
+	"""Mimics `Base64TunnelDataCache` from the already encoded data."""
+
+	__slots__ = ("sec", "pub", "psk")
+
+	def __init__(self, spec: bytes) -> None:
+		keepAlive, hasPsk = TUNNEL_SPEC_HEADER.unpack_from(spec)
+		keys = spec[TUNNEL_SPEC_HEADER.size :]
+		keyLen = len(keys) // (3 if hasPsk else 2)
+		self.sec = keys[:keyLen]
+		self.pub = keys[keyLen : 2 * keyLen]
+		self.psk = keys[2 * keyLen :] if hasPsk else None
+
+
+def _shardWorker(requestsName: str, responsesName: str, requestsBell, responsesBell, tickInterval: float, requestsLock=None, responsesLock=None) -> None:
+	requests = ShmRing(requestsName, lock=requestsLock)
+	responses = ShmRing(responsesName, lock=responsesLock)
+	tunnels = {}
+	dst = bytearray(MAX_WIREGUARD_PACKET_SIZE)
+	dstView = memoryview(dst)
+
+	def respond(kind: int, idx: int, payload) -> None:
+		while not responses.push(makeTag(kind, idx), payload):
+			# the front end is lagging, wake it and wait for the space
+			responsesBell.send_bytes(b"\x01")
+			time.sleep(0.0005)
+
+	def emit(idx: int, opcode: Opcode, size: int) -> None:
+		if opcode == Opcode.WIREGUARD_ERROR:
+			respond(opcode, idx, ERROR_CODE.pack(size))
+		elif opcode != Opcode.WIREGUARD_DONE:
+			respond(opcode, idx, dstView[:size])
+
+	def flushQueued(idx: int, t: OpenTunnel) -> None:
+		while True:
+			opcode, size = t.unwrap_into(b"", dst)
+			if opcode != Opcode.WRITE_TO_NETWORK:
+				break
+			emit(idx, opcode, size)
+
+	nextTick = time.monotonic() + tickInterval
+	running = True
+	while running:
+		timeout = max(0, nextTick - time.monotonic())
+		if requestsBell.poll(timeout):
+			while requestsBell.poll():
+				requestsBell.recv_bytes()
+
+		produced = False
+		while True:
+			rec = requests.peek()
+			if rec is None:
+				break
+			tag, payload = rec
+			del rec
+			kind = tag >> 24
+			idx = tag & TAG_INDEX_MASK
+			t = tunnels.get(idx)
+
+			if kind == Command.WRAP:
+				if t is not None:
+					emit(idx, *t.wrap_into(payload, dst))
+			elif kind == Command.UNWRAP:
+				seq = UNWRAP_REQUEST_HEADER.unpack_from(payload)[0]
+				opcode = Opcode.WIREGUARD_ERROR
+				if t is not None:
+					opcode, size = t.unwrap_into(payload[UNWRAP_REQUEST_HEADER.size :], dst)
+				# the status goes before the results, so they are sent to the source address if it is authentic
+				respond(UNWRAPPED, idx, UNWRAP_STATUS.pack(seq, opcode != Opcode.WIREGUARD_ERROR))
+				if t is not None:
+					emit(idx, opcode, size)
+					if opcode == Opcode.WRITE_TO_NETWORK:
+						flushQueued(idx, t)
+			elif kind == Command.FORCE_HANDSHAKE:
+				if t is not None:
+					emit(idx, *t.force_handshake_into(dst))
+			elif kind == Command.ADD:
+				spec = bytes(payload)
+				tunnels[idx] = OpenTunnel(_WorkerTunnelData(spec), keepAlive=TUNNEL_SPEC_HEADER.unpack_from(spec)[0], idx=idx)
+			elif kind == Command.REMOVE:
+				if t is not None:
+					tunnels.pop(idx).close()
+			elif kind == Command.STOP:
+				running = False
+
+			del payload
+			requests.pop()
+			produced = True
+
+		if time.monotonic() >= nextTick:
+			for idx, t in tunnels.items():
+				opcode, size = t.tick_into(dst)
+				if opcode == Opcode.WRITE_TO_NETWORK:
+					emit(idx, opcode, size)
+					produced = True
+			nextTick = time.monotonic() + tickInterval
+
+		if produced:
+			responsesBell.send_bytes(b"\x01")
+
+	for t in tunnels.values():
+		t.close()
+	del dstView
+	requests.close()
+	responses.close()
+
+
+class _Shard:
+	__slots__ = ("process", "requests", "responses", "requestsBell", "responsesBell", "dirty")
+
+	def __init__(self, ctx, ringSize: int, tickInterval: float) -> None:
+		requestsLock = responsesLock = None
+		if not IS_STRONGLY_ORDERED:
+			requestsLock = ctx.Lock()
+			responsesLock = ctx.Lock()
+		self.requests = ShmRing(capacity=ringSize, lock=requestsLock)
+		self.responses = ShmRing(capacity=ringSize, lock=responsesLock)
+		requestsBellReader, self.requestsBell = ctx.Pipe(duplex=False)
+		self.responsesBell, responsesBellWriter = ctx.Pipe(duplex=False)
+		self.dirty = False
+		self.process = ctx.Process(target=_shardWorker, args=(self.requests.name, self.responses.name, requestsBellReader, responsesBellWriter, tickInterval, requestsLock, responsesLock), daemon=True)
+		self.process.start()
+		requestsBellReader.close()
+		responsesBellWriter.close()
+
+
+class ShardedEngine:
+	"""Runs tunnels in `workersCount` processes; the tunnel with index `idx` lives in the worker `idx % workersCount`, which also ticks it.
+	Requests are queued with `submit`, the workers are woken by `flush` (once per batch). The results are drained by `poll`, or automatically with `attach` when running in an event loop, and given to `onResult(idx, opcode, payload)`; the payload is a view valid only during the call, and for `Opcode.WIREGUARD_ERROR` it is the error code.
+	Every unwrapping is also reported to `onUnwrapped(idx, seq, authentic)` before its results, with the `seq` given to `unwrap`; `authentic` is `False` if the datagram was rejected or the tunnel is gone."""
+
+	__slots__ = ("workersCount", "shards", "onResult", "onUnwrapped", "loop", "droppedRequests")
+
+	def __init__(self, workersCount: typing.Optional[int] = None, onResult: typing.Optional[typing.Callable[[int, Opcode, memoryview], None]] = None, ringSize: int = DEFAULT_RING_SIZE, tickInterval: float = TICK_INTERVAL, mpContext: str = "spawn", onUnwrapped: typing.Optional[typing.Callable[[int, int, bool], None]] = None) -> None:
+		if workersCount is None:
+			workersCount = multiprocessing.cpu_count()
+		if ringSize // 2 - RECORD_HEADER.size < MAX_WIREGUARD_PACKET_SIZE:
+			raise ValueError("The rings must fit the biggest WireGuard packets", ringSize)
+
+		ctx = multiprocessing.get_context(mpContext)
+		self.workersCount = workersCount
+		self.onResult = onResult
+		self.onUnwrapped = onUnwrapped
+		self.loop = None
+		self.droppedRequests = 0
+		self.shards = [_Shard(ctx, ringSize, tickInterval) for i in range(workersCount)]
+
+	def shardOf(self, idx: int) -> int:
+		return idx % self.workersCount
+
+	def submit(self, kind: Command, idx: int, payload: typing.Union[bytes, bytearray, memoryview] = b"", prefix: bytes = b"") -> bool:
+		"""Returns `False` if the request was dropped since the worker is overloaded."""
+		shard = self.shards[idx % self.workersCount]
+		if not shard.requests.push(makeTag(kind, idx), payload, prefix):
+			self.droppedRequests += 1
+			return False
+
+		if not shard.dirty:
+			shard.dirty = True
+			if self.loop is not None:
+				self.loop.call_soon(self.flush)
+		return True
+
+	def addTunnel(self, tunnel: Tunnel) -> None:
+		while not self.submit(Command.ADD, tunnel.idx, encodeTunnelSpec(tunnel.b64c, tunnel.peer.keepAliveTimeout)):
+			self._waitForSpace(self.shards[self.shardOf(tunnel.idx)])
+
+	def _waitForSpace(self, shard: _Shard) -> None:
+		"""The worker may itself wait for space in its full responses ring, so they are drained while waiting for it to consume the requests."""
+		shard.requestsBell.send_bytes(b"\x01")
+		self.poll()
+		time.sleep(0.001)
+
+	def removeTunnel(self, idx: int) -> None:
+		self.submit(Command.REMOVE, idx)
+
+	def wrap(self, idx: int, packet: typing.Union[bytes, bytearray, memoryview]) -> bool:
+		return self.submit(Command.WRAP, idx, packet)
+
+	def unwrap(self, idx: int, datagram: typing.Union[bytes, bytearray, memoryview], seq: int = 0) -> bool:
+		return self.submit(Command.UNWRAP, idx, datagram, UNWRAP_REQUEST_HEADER.pack(seq))
+
+	def forceHandshake(self, idx: int) -> bool:
+		return self.submit(Command.FORCE_HANDSHAKE, idx)
+
+	def flush(self) -> None:
+		for shard in self.shards:
+			if shard.dirty:
+				shard.dirty = False
+				shard.requestsBell.send_bytes(b"\x01")
+
+	def poll(self) -> int:
+		"""Drains the results of all the workers. Returns their count."""
+		count = 0
+		onResult = self.onResult
+		onUnwrapped = self.onUnwrapped
+		for shard in self.shards:
+			try:
+				while shard.responsesBell.poll():
+					shard.responsesBell.recv_bytes()
+			except EOFError:
+				pass  # the worker has exited, its last results are still in the ring
+
+			ring = shard.responses
+			while True:
+				rec = ring.peek()
+				if rec is None:
+					break
+				tag, payload = rec
+				del rec
+				kind = tag >> 24
+				try:
+					if kind == UNWRAPPED:
+						if onUnwrapped is not None:
+							seq, authentic = UNWRAP_STATUS.unpack(payload)
+							onUnwrapped(tag & TAG_INDEX_MASK, seq, bool(authentic))
+					elif onResult is not None:
+						onResult(tag & TAG_INDEX_MASK, Opcode(kind), payload)
+				finally:
+					del payload
+					ring.pop()
+				count += 1
+		return count
+
+	def attach(self, loop: typing.Optional[asyncio.AbstractEventLoop] = None) -> None:
+		"""Makes the results be processed by the event loop as soon as they are ready and the requests be flushed at the end of the current iteration."""
+		if loop is None:
+			loop = asyncio.get_running_loop()
+		self.loop = loop
+		for shard in self.shards:
+			loop.add_reader(shard.responsesBell.fileno(), self.poll)
+
+	def detach(self) -> None:
+		if self.loop is not None:
+			for shard in self.shards:
+				self.loop.remove_reader(shard.responsesBell.fileno())
+			self.loop = None
+
+	def close(self, timeout: float = 5) -> None:
+		self.detach()
+		deadline = time.monotonic() + timeout
+		for shard in self.shards:
+			while not shard.requests.push(makeTag(Command.STOP, 0)) and shard.process.is_alive() and time.monotonic() < deadline:
+				self._waitForSpace(shard)
+			shard.requestsBell.send_bytes(b"\x01")
+
+		for shard in self.shards:
+			while shard.process.is_alive() and time.monotonic() < deadline:
+				self.poll()  # the worker processes the requests before `STOP`, their results must fit
+				shard.process.join(0.01)
+			if shard.process.is_alive():
+				shard.process.terminate()
+
+		for shard in self.shards:
+			shard.requests.close()
+			shard.responses.close()
+			shard.requestsBell.close()
+			shard.responsesBell.close()
+
+
+class ShardedWireGuardEndpoint(WireGuardEndpoint):
+	"""A `WireGuardEndpoint` whose crypto runs in the worker processes of a `ShardedEngine`: the event loop only receives, routes and sends datagrams.
+	Handshake initiations not routable by the decrypted initiator key or by the source address are given to the first peer only, since the result of trying a peer is only known asynchronously."""
+
+	__slots__ = ("engine", "pendingSources", "nextSeq")
+
+	def __init__(self, interface: Interface, appProtocol: typing.Optional[asyncio.DatagramProtocol] = None, batchedIO: bool = False, workersCount: typing.Optional[int] = None, handshakeScheduler: typing.Optional[HandshakeScheduler] = None, **engineKwargs) -> None:
+		super().__init__(interface, appProtocol, batchedIO=batchedIO, handshakeScheduler=handshakeScheduler)
+		self.pendingSources = {}  # the sequence numbers of the unwrappings in flight to the source addresses of their datagrams
+		self.nextSeq = 0
+		self.engine = ShardedEngine(workersCount, self._onResult, onUnwrapped=self._onUnwrapped, **engineKwargs)
+
+	def addPeer(self, peer: Peer, idx: typing.Optional[int] = None) -> EndpointPeer:
+		if idx is None:
+			idx = max(self.peers, default=-1) + 1
+		if idx in self.peers:
+			raise KeyError("Tunnel index is already used", idx)
+
+		tunnel = Tunnel(self.interface, peer, idx=idx)
+		addr = (str(peer.ip), peer.port) if peer.ip is not None and peer.port is not None else None
+		ep = EndpointPeer(idx, tunnel, None, addr)
+		self.peers[idx] = ep
+		self.peersByKey[bytes(peer.pub)] = ep
+		self.allowedIPs.insertPeer(idx, peer.allowedIPs)
+		if addr is not None:
+			self.peersByAddr[addr] = ep
+		self.engine.addTunnel(tunnel)
+		return ep
+
+	def removePeer(self, idx: int) -> None:
+		ep = self.peers.pop(idx)
+		self.peersByKey.pop(bytes(ep.tunnel.peer.pub), None)
+		self.allowedIPs.removePeer(idx)
+		if ep.addr is not None and self.peersByAddr.get(ep.addr) is ep:
+			del self.peersByAddr[ep.addr]
+		self.engine.removeTunnel(idx)
+
+	def _processDatagram(self, data, addr):
+		for ep in self.route(data, addr):
+			self._unwrap(ep, data, addr)
+			return
+
+	def _unwrapBatch(self, ep: EndpointPeer, batch: DatagramBatch, positions: typing.List[int]) -> None:
+		for i in positions:
+			self._unwrap(ep, batch[i], batch.address(i))
+
+	def _unwrap(self, ep: EndpointPeer, datagram, addr: typing.Tuple[str, int]) -> None:
+		"""The source address becomes the one of the peer only after the worker has authenticated the datagram, see `_onUnwrapped`."""
+		seq = self.nextSeq
+		self.nextSeq = (seq + 1) & 0xFFFFFFFF
+		if self.engine.unwrap(ep.idx, datagram, seq):
+			self.pendingSources[seq] = addr
+
+	def _onUnwrapped(self, idx: int, seq: int, authentic: bool) -> None:
+		addr = self.pendingSources.pop(seq, None)
+		if authentic and addr is not None:
+			ep = self.peers.get(idx)
+			if ep is not None:
+				self._authenticated(ep, addr)
+
+	def _onResult(self, idx: int, opcode: Opcode, payload: memoryview) -> None:
+		ep = self.peers.get(idx)
+		if ep is None:
+			return
+
+		if opcode == Opcode.WRITE_TO_NETWORK:
+			if ep.addr is not None:
+				self.transport.sendto(bytes(payload), ep.addr)
+		elif opcode == Opcode.WRITE_TO_TUNNEL_IPV4 or opcode == Opcode.WRITE_TO_TUNNEL_IPV6:
+			if ep.tunnel.peer.allowedIPs and not self.allowedIPs.allowsSource(payload, idx):
+				return
+			if self.appProtocol is not None:
+				self.appProtocol.datagram_received(bytes(payload), idx)
+
+	def sendto(self, data, addr=None):
+		if addr is None:
+			addr = self.allowedIPs.route(data)
+			if addr is None:
+				return
+		if addr not in self.peers:
+			self.error_received(UnknownPeerError(addr))
+			return
+		self.engine.wrap(addr, data)
+
+	def _forceHandshake(self, idx: int) -> None:
+		if idx in self.peers:
+			self.engine.forceHandshake(idx)
+
+	def connection_made(self, transport):
+		self.transport = transport
+		self.engine.attach()
+		if self.appProtocol is not None:
+			self.appProtocol.connection_made(self)
+
+	def connection_lost(self, exc):
+		self.engine.detach()
+		if self.appProtocol is not None:
+			self.appProtocol.connection_lost(exc)
+
+	def close(self) -> None:
+		self.peers.clear()
+		self.peersByKey.clear()
+		self.peersByAddr.clear()
+		self.pendingSources.clear()
+		self.engine.close()
+		if self.transport is not None:
+			self.transport.close()
@@ -0,0 +1,173 @@
+"""A single timer task calling `tick` of many tunnels."""
+
+__all__ = ("TimerWheel", "TickEntry", "getDefaultTimerWheel", "TICK_INTERVAL")
+
+import asyncio
+import typing
+import weakref
+
+from .Tunnel import Action, Opcode, OpenTunnel
+
+TICK_INTERVAL = 0.1  # recommended by BoringTun for `wireguard_tick`
+DEFAULT_MAX_IDLE_INTERVAL = 1.0  # WireGuard timers have a resolution of seconds, so idle tunnels don't need to be ticked more often
+DEFAULT_SLOTS_COUNT = 64
+
+
+class TickEntry:
+	"""A tunnel registered in a `TimerWheel`. `sink` gets the `Action`s to be sent to the network, `active` is set by `TimerWheel.touch` when the tunnel has traffic."""
+
+	__slots__ = ("openTunnel", "sink", "slot", "intervalSlots", "active", "cancelled")
+
+	def __init__(self, openTunnel: OpenTunnel, sink: typing.Callable[[Action], None]) -> None:
+		self.openTunnel = openTunnel
+		self.sink = sink
+		self.slot = None
+		self.intervalSlots = 1
+		self.active = True
+		self.cancelled = False
+
+	def __repr__(self):
+		return self.__class__.__name__ + "<slot=" + repr(self.slot) + ", interval=" + repr(self.intervalSlots) + ">"
+
+
+class TimerWheel:
+	"""A hashed timing wheel with slots of `resolution` seconds. Every registered tunnel is ticked at the `resolution` cadence while it has traffic, the interval of idle tunnels doubles up to `maxIdleInterval`.
+	The task sleeps until the next non-empty slot, so the count of wakeups doesn't depend on the count of tunnels, and it doesn't wake up at all when nothing is registered."""
+
+	__slots__ = ("resolution", "maxIdleSlots", "slots", "cursor", "cursorTime", "count", "task", "_wakeup", "__weakref__")
+
+	def __init__(self, resolution: float = TICK_INTERVAL, maxIdleInterval: float = DEFAULT_MAX_IDLE_INTERVAL, slotsCount: int = DEFAULT_SLOTS_COUNT) -> None:
+		maxIdleSlots = max(1, round(maxIdleInterval / resolution))
+		if maxIdleSlots >= slotsCount:
+			raise ValueError("The wheel must have more slots than the max idle interval spans", maxIdleSlots, slotsCount)
+
+		self.resolution = resolution
+		self.maxIdleSlots = maxIdleSlots
+		self.slots = [set() for i in range(slotsCount)]
+		self.cursor = 0
+		self.cursorTime = None
+		self.count = 0
+		self.task = None
+		self._wakeup = None
+
+	def register(self, openTunnel: OpenTunnel, sink: typing.Callable[[Action], None]) -> TickEntry:
+		"""The tunnel is ticked at the nearest slot, then periodically till `unregister`."""
+		entry = TickEntry(openTunnel, sink)
+		self._schedule(entry, 0)
+		self.count += 1
+		if self._wakeup is not None:
+			self._wakeup.set()
+		return entry
+
+	def unregister(self, entry: TickEntry) -> None:
+		if entry.cancelled:
+			return
+
+		entry.cancelled = True
+		self.count -= 1
+		if entry.slot is not None:
+			self.slots[entry.slot].discard(entry)
+			entry.slot = None
+
+	@staticmethod
+	def touch(entry: TickEntry) -> None:
+		"""Marks the tunnel as having traffic, so it is ticked at the full cadence again."""
+		entry.active = True
+
+	def _schedule(self, entry: TickEntry, slotsAhead: int) -> None:
+		entry.slot = (self.cursor + slotsAhead) % len(self.slots)
+		self.slots[entry.slot].add(entry)
+
+	def _slotsToNextNonEmpty(self) -> typing.Optional[int]:
+		slotsCount = len(self.slots)
+		for i in range(slotsCount):
+			if self.slots[(self.cursor + i) % slotsCount]:
+				return i
+		return None
+
+	def processSlot(self) -> None:
+		"""Ticks all the tunnels in the slot under the cursor and moves the cursor to the next slot."""
+		slot = self.slots[self.cursor]
+		entries = tuple(slot)
+		slot.clear()
+
+		for entry in entries:
+			entry.slot = None
+			res = None
+			try:
+				res = entry.openTunnel.tick()
+				if res.opcode == Opcode.WRITE_TO_NETWORK:
+					entry.active = True
+					toSend, res = res, None  # the sink releases it
+					entry.sink(toSend)
+			except Exception:  # pylint:disable=broad-except
+				import traceback
+
+				print(traceback.format_exc())
+			if res is not None:
+				res.release()  # the buffer of a pooled tunnel goes back to the pool
+
+			if entry.cancelled:
+				continue
+
+			if entry.active:
+				entry.intervalSlots = 1
+				entry.active = False
+			else:
+				entry.intervalSlots = min(2 * entry.intervalSlots, self.maxIdleSlots)
+
+			self._schedule(entry, entry.intervalSlots)
+
+		self.cursor = (self.cursor + 1) % len(self.slots)
+
+	async def run(self) -> None:
+		loop = asyncio.get_running_loop()
+		self._wakeup = asyncio.Event()
+		self.cursorTime = loop.time()
+
+		while True:
+			skip = self._slotsToNextNonEmpty()
+			if skip is None:
+				self._wakeup.clear()
+				await self._wakeup.wait()
+				self.cursorTime = max(self.cursorTime, loop.time())
+				continue
+
+			target = self.cursorTime + skip * self.resolution
+			delay = target - loop.time()
+			if delay > 0:
+				self._wakeup.clear()
+				try:
+					await asyncio.wait_for(self._wakeup.wait(), delay)
+					continue  # something was registered, maybe into an earlier slot
+				except asyncio.TimeoutError:
+					pass
+
+			self.cursor = (self.cursor + skip) % len(self.slots)
+			self.processSlot()
+			self.cursorTime = target + self.resolution
+
+	def start(self) -> None:
+		if self.task is None:
+			self.task = asyncio.create_task(self.run())
+
+	def stop(self) -> None:
+		if self.task is not None:
+			self.task.cancel()
+			self.task = None
+
+	def __len__(self) -> int:
+		return self.count
+
+
+_defaultTimerWheels = weakref.WeakKeyDictionary()
+
+
+def getDefaultTimerWheel() -> TimerWheel:
+	"""Returns the wheel shared by all the tunnels of the running event loop, starting it if needed."""
+	loop = asyncio.get_running_loop()
+	wheel = _defaultTimerWheels.get(loop)
+	if wheel is None:
+		wheel = _defaultTimerWheels[loop] = TimerWheel()
+	wheel.start()
+	return wheel
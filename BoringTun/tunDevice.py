@@ -0,0 +1,163 @@
+"""Linux TUN devices as the app side of the tunnels, making a complete userspace WireGuard data plane. A `TunDevice` is an app protocol of a `WireGuardEndpoint` or of an `asyncio.BoringTUNProtocol`: the IP packets read from the device are passed to the transport as `memoryview`s of pooled buffers, the decrypted ones are written to the device right from the buffers they are given in.
+A TUN fd gives one packet per read, so a batch is up to `batchSize` `readv` calls per readiness notification. Any fd preserving the boundaries of the packets (i.e. of a datagram socket pair) can stand in for a device."""
+
+__all__ = ("TunDevice", "openTun", "openTunQueues", "IFF_TUN", "IFF_NO_PI", "IFF_MULTI_QUEUE")
+
+import asyncio
+import os
+import struct
+import typing
+
+from .bufferPool import BufferPool
+
+TUN_PATH = "/dev/net/tun"
+TUNSETIFF = 0x400454CA
+IFF_TUN = 0x0001
+IFF_NO_PI = 0x1000
+IFF_MULTI_QUEUE = 0x0100
+IFNAMSIZ = 16
+IFREQ_SIZE = 40
+IFREQ_HEAD = struct.Struct(str(IFNAMSIZ) + "sH")
+
+DEFAULT_BATCH_SIZE = 32
+DEFAULT_BUFFER_SIZE = 0x10000  # the max IP packet fits
+
+Route = typing.Callable[[memoryview], typing.Optional[int]]
+
+
+def openTun(name: str = "", multiQueue: bool = False) -> typing.Tuple[int, str]:
+	"""Creates (or attaches to) the TUN device `name` (the kernel chooses the name if it is empty), returns the non-blocking fd and the name. Requires `CAP_NET_ADMIN`."""
+	import fcntl
+
+	fd = os.open(TUN_PATH, os.O_RDWR | os.O_NONBLOCK | os.O_CLOEXEC)
+	try:
+		flags = IFF_TUN | IFF_NO_PI | (IFF_MULTI_QUEUE if multiQueue else 0)
+		ifr = fcntl.ioctl(fd, TUNSETIFF, IFREQ_HEAD.pack(name.encode("ascii"), flags).ljust(IFREQ_SIZE, b"\0"))
+	except BaseException:
+		os.close(fd)
+		raise
+
+	return fd, ifr[:IFNAMSIZ].rstrip(b"\0").decode("ascii")
+
+
+def openTunQueues(name: str = "", count: typing.Optional[int] = None) -> typing.Tuple[typing.List[int], str]:
+	"""Opens `count` (by default one per CPU) queues of a multi-queue TUN device, the kernel spreads the flows across them, so each one can be served by its own `TunDevice` in its own thread or process."""
+	if count is None:
+		count = os.cpu_count() or 1
+
+	fds = []
+	try:
+		for i in range(count):
+			fd, name = openTun(name, multiQueue=True)
+			fds.append(fd)
+	except BaseException:
+		for fd in fds:
+			os.close(fd)
+		raise
+
+	return fds, name
+
+
+class TunDevice(asyncio.DatagramProtocol):
+	"""Moves IP packets between a TUN fd and its transport. `route(packet)` chooses the index of the peer of a `WireGuardEndpoint` for a packet read from the device (`None` drops it), by default everything goes to the peer 0 (`allowedIPs.AllowedIPs.route` routes by the destinations); for a `BoringTUNProtocol` it is not used.
+	The transport must consume the packets synchronously: the buffer of a packet is reused right after `sendto`/`write` returns."""
+
+	ACCEPTS_BORROWED_PACKETS = True  # `datagram_received` doesn't keep the packets, so `WireGuardEndpoint` gives them without copying
+
+	__slots__ = ("fd", "ownsFd", "route", "batchSize", "pool", "transport", "loop", "send", "received", "written", "dropped")
+
+	def __init__(self, fd: int, route: typing.Optional[Route] = None, batchSize: int = DEFAULT_BATCH_SIZE, bufferSize: int = DEFAULT_BUFFER_SIZE, ownsFd: bool = True) -> None:
+		super().__init__()
+		os.set_blocking(fd, False)
+		self.fd = fd
+		self.ownsFd = ownsFd
+		self.route = route
+		self.batchSize = batchSize
+		self.pool = BufferPool(bufferSize, batchSize)
+		self.transport = None
+		self.loop = None
+		self.send = None
+		self.received = 0
+		self.written = 0
+		self.dropped = 0
+
+	@classmethod
+	def open(cls, name: str = "", route: typing.Optional[Route] = None, **kwargs) -> "TunDevice":
+		fd, _name = openTun(name)
+		return cls(fd, route, **kwargs)
+
+	def connection_made(self, transport) -> None:
+		self.transport = transport
+		if isinstance(transport, asyncio.DatagramTransport):
+			self.send = self._sendRouted
+		else:
+			self.send = transport.write
+
+		self.loop = asyncio.get_running_loop()
+		self.loop.add_reader(self.fd, self.readBatch)
+
+	def readBatch(self) -> int:
+		"""Reads up to `batchSize` packets and sends the routed ones, returns the count of the read ones."""
+		count = 0
+		pool = self.pool
+		for i in range(self.batchSize):
+			buf = pool.acquire()
+			try:
+				size = os.readv(self.fd, (buf,))
+				if not size:
+					# the stand-in was closed
+					self._stopReading()
+					break
+				self.send(memoryview(buf)[:size])
+				count += 1
+			except (BlockingIOError, InterruptedError):
+				break
+			finally:
+				pool.release(buf)
+
+		self.received += count
+		return count
+
+	def _sendRouted(self, packet: memoryview) -> None:
+		idx = self.route(packet) if self.route is not None else 0
+		if idx is None:
+			self.dropped += 1
+			return
+		self.transport.sendto(packet, idx)
+
+	def datagram_received(self, data: typing.Union[bytes, memoryview], addr) -> None:
+		"""Writes a decrypted packet into the device. The packets not fitting into the queue of the device are dropped, like by a kernel interface."""
+		try:
+			os.write(self.fd, data)
+			self.written += 1
+		except (BlockingIOError, InterruptedError):
+			self.dropped += 1
+
+	def pause_writing(self) -> None:
+		self._stopReading()
+
+	def resume_writing(self) -> None:
+		if self.loop is not None and self.fd is not None:
+			self.loop.add_reader(self.fd, self.readBatch)
+
+	def _stopReading(self) -> None:
+		if self.loop is not None:
+			self.loop.remove_reader(self.fd)
+
+	def connection_lost(self, exc) -> None:
+		self.close()
+
+	def error_received(self, exc) -> None:
+		pass
+
+	def close(self) -> None:
+		self._stopReading()
+		self.loop = None
+		self.transport = None
+		if self.ownsFd and self.fd is not None:
+			os.close(self.fd)
+		self.fd = None
+
+	def __repr__(self):
+		return self.__class__.__name__ + "<fd=" + repr(self.fd) + ", received=" + repr(self.received) + ", written=" + repr(self.written) + ", dropped=" + repr(self.dropped) + ">"
+
@@ -1,17 +1,46 @@
-__all__ = ("TunnPtr", "Opcode", "Action", "wireguard_write", "wireguard_read", "wireguard_tick", "wireguard_force_handshake", "prepareOutputBuffer", "wireguard_stats")
+__all__ = ("TunnPtr", "Opcode", "Action", "wireguard_write", "wireguard_read", "wireguard_tick", "wireguard_force_handshake", "wireguard_write_into", "wireguard_read_into", "wireguard_tick_into", "wireguard_force_handshake_into", "wireguard_write_many", "wireguard_read_many", "BatchResult", "batchSlotSize", "planBatch", "prepareOutputBuffer", "pooledAction", "bufferToPointer", "wireguard_stats")
 
 import typing
-from ctypes import c_char_p, c_ubyte, cast, pointer
+from array import array
+from ctypes import addressof, c_char_p, c_ubyte, c_void_p, cast, pointer
 
-from .ctypes import MAX_WIREGUARD_PACKET_SIZE, LP_c_ubyte, Opcode, TunnPtr, new_tunnel, tunnel_free, wireguard_force_handshake as ct_wireguard_force_handshake, wireguard_read as ct_wireguard_read, wireguard_result, wireguard_stats, wireguard_tick as ct_wireguard_tick, wireguard_write as ct_wireguard_write  # pylint:disable=unused-import
+from .bufferPool import BufferPool
+from .ctypes import MAX_WIREGUARD_PACKET_SIZE, LP_c_ubyte, Opcode, TunnPtr, new_tunnel, tunnel_free, wireguard_force_handshake as ct_wireguard_force_handshake, wireguard_read as ct_wireguard_read, wireguard_read_raw as ct_wireguard_read_raw, wireguard_result, wireguard_stats, wireguard_tick as ct_wireguard_tick, wireguard_write as ct_wireguard_write, wireguard_write_raw as ct_wireguard_write_raw  # pylint:disable=unused-import
 
 
 class Action:
-	__slots__ = ("opcode", "buf")
+	"""The result of a tunnel operation. `buf` is either `bytes` or a `memoryview` into a buffer borrowed from a `BufferPool`.
+	In the latter case the buffer must be given back by calling `release` (or by using the action as a context manager), after which `buf` must not be used anymore."""
 
-	def __init__(self, opcode: Opcode, buf: typing.Optional[bytes] = None):
+	__slots__ = ("opcode", "buf", "pool", "backing")
+
+	def __init__(self, opcode: Opcode, buf: typing.Optional[typing.Union[bytes, memoryview]] = None, pool: typing.Optional[BufferPool] = None, backing: typing.Optional[bytearray] = None):
 		self.opcode = opcode
 		self.buf = buf
+		self.pool = pool
+		self.backing = backing
+
+	def release(self) -> None:
+		if self.pool is not None:
+			self.buf.release()
+			self.buf = None
+			self.pool.release(self.backing)
+			self.pool = None
+			self.backing = None
+
+	def detach(self) -> "Action":
+		"""Materializes `buf` into `bytes` and gives the pooled buffer back."""
+		if self.pool is not None:
+			buf = bytes(self.buf)
+			self.release()
+			self.buf = buf
+		return self
+
+	def __enter__(self) -> "Action":
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback) -> None:
+		self.release()
 
 	def __repr__(self):
 		return self.__class__.__name__ + "(" + repr(self.opcode) + (", " + repr(self.buf) if self.buf else "") + ")"
@@ -21,6 +50,157 @@ class Action:
 		yield self.buf
 
 
+class BatchResult:
+	"""Results of a batched operation. All the outputs are stored in a single `arena`, the output for the i-th packet is `arena[offsets[i]:offsets[i] + sizes[i]]`.
+	For `Opcode.WIREGUARD_ERROR` `sizes[i]` is the error code."""
+
+	__slots__ = ("arena", "opcodes", "sizes", "offsets")
+
+	def __init__(self, arena: bytearray, opcodes: array, sizes: array, offsets: array) -> None:
+		self.arena = arena
+		self.opcodes = opcodes
+		self.sizes = sizes
+		self.offsets = offsets
+
+	def __len__(self) -> int:
+		return len(self.opcodes)
+
+	def __getitem__(self, i: int) -> typing.Tuple[Opcode, memoryview]:
+		opcode = Opcode(self.opcodes[i])
+		if opcode == Opcode.WIREGUARD_ERROR:
+			return opcode, None
+
+		offset = self.offsets[i]
+		return opcode, memoryview(self.arena)[offset : offset + self.sizes[i]]
+
+	def __iter__(self) -> typing.Iterator[typing.Tuple[Opcode, memoryview]]:
+		for i in range(len(self)):
+			yield self[i]
+
+	def asNumpy(self) -> typing.Tuple["numpy.ndarray", "numpy.ndarray", "numpy.ndarray", "numpy.ndarray"]:
+		"""Returns `(arena, opcodes, sizes, offsets)` as `numpy` arrays sharing memory with this object. Requires `numpy`."""
+		import numpy as np
+
+		return np.frombuffer(self.arena, dtype=np.uint8), np.frombuffer(self.opcodes, dtype=np.uint32), np.frombuffer(self.sizes, dtype=np.uint32), np.frombuffer(self.offsets, dtype=np.uint32)
+
+	def __repr__(self):
+		return self.__class__.__name__ + "<" + repr(len(self)) + " results, " + repr(len(self.arena)) + " bytes>"
+
+
+WIREGUARD_DATA_OVERHEAD = 32  # 16 bytes of the header and 16 bytes of the AEAD tag
+HANDSHAKE_INIT_SIZE = 148
+
+
+def batchSlotSize(srcSize: int) -> int:
+	"""Size of the output slot enough for any result of wrapping or unwrapping of a packet of `srcSize` bytes: a padded data packet or a handshake message."""
+	return max(((srcSize + 15) & ~15) + WIREGUARD_DATA_OVERHEAD, HANDSHAKE_INIT_SIZE)
+
+
+def bufferAddress(buf: typing.Union[bytes, bytearray, memoryview]) -> typing.Tuple[typing.Union[int, bytes], typing.Any]:
+	"""Returns something that can be passed as a `c_void_p` argument pointing to the memory of `buf` and an object that must be kept alive while the address is used."""
+	if isinstance(buf, bytes):
+		return buf, buf
+
+	try:
+		buf = memoryview(buf).cast("B")
+		arr = (c_ubyte * len(buf)).from_buffer(buf)
+	except TypeError:
+		# read-only buffers other than `bytes` cannot be pointed to by ctypes
+		buf = bytes(buf)
+		return buf, buf
+
+	return addressof(arr), arr
+
+
+def planBatch(packets: typing.Union[typing.Sequence[bytes], bytes, bytearray, memoryview], offsets: typing.Optional[typing.Sequence[int]], sizes: typing.Optional[typing.Sequence[int]]) -> typing.Tuple[int, typing.Sequence[int], typing.List[int], array, int]:
+	"""Computes the layout of the output arena of a batch. Returns the count of packets, their sizes, the sizes and the offsets of their output slots and the size of the arena."""
+	if offsets is None:
+		count = len(packets)
+		srcSizes = [len(p) for p in packets]
+	elif sizes is None:
+		count = len(offsets) - 1
+		srcSizes = [offsets[i + 1] - offsets[i] for i in range(count)]
+	else:
+		count = len(sizes)
+		srcSizes = sizes
+
+	slotSizes = [batchSlotSize(srcSize) for srcSize in srcSizes]
+	outOffsets = array("I", bytes(4 * count))
+	arenaSize = 0
+	for i, slotSize in enumerate(slotSizes):
+		outOffsets[i] = arenaSize
+		arenaSize += slotSize
+
+	return count, srcSizes, slotSizes, outOffsets, arenaSize
+
+
+def decorateBatchTransformer(rawFunc: typing.Callable) -> typing.Callable:
+	def batchTransformer(tPtr: TunnPtr, packets: typing.Union[typing.Sequence[bytes], bytes, bytearray, memoryview], offsets: typing.Optional[typing.Sequence[int]] = None, sizes: typing.Optional[typing.Sequence[int]] = None) -> BatchResult:
+		"""Processes many packets at once. `packets` is either a sequence of packets or a contiguous buffer.
+		In the latter case `offsets` are either the boundaries of the packets in it (so it has 1 element more than the count of packets), or, if `sizes` are given, the starts of the packets."""
+
+		count, srcSizes, slotSizes, outOffsets, arenaSize = planBatch(packets, offsets, sizes)
+
+		srcKeepAlive = None
+		if offsets is not None:
+			srcBase, srcKeepAlive = bufferAddress(packets)
+			if isinstance(srcBase, bytes):
+				srcBase = cast(c_char_p(srcBase), c_void_p).value
+
+		arena = bytearray(arenaSize)
+		arenaArr = (c_ubyte * arenaSize).from_buffer(arena)
+		arenaBase = addressof(arenaArr)
+		opcodes = array("I", outOffsets)
+		sizes = array("I", outOffsets)
+
+		for i in range(count):
+			if offsets is None:
+				src, srcKeepAlive = bufferAddress(packets[i])
+			else:
+				src = srcBase + offsets[i]
+
+			res = rawFunc(tPtr, src, srcSizes[i], arenaBase + outOffsets[i], slotSizes[i])
+			opcodes[i] = res.op
+			sizes[i] = res.size
+
+		del arenaArr, srcKeepAlive
+		return BatchResult(arena, opcodes, sizes, outOffsets)
+
+	batchTransformer.__name__ = rawFunc.__name__.replace("_raw", "_many")
+
+	return batchTransformer
+
+
+def bufferToPointer(buf: typing.Union[bytearray, memoryview]) -> LP_c_ubyte:
+	"""Returns a ctypes array over the memory of a writable buffer-protocol object, no copies are made. It is accepted wherever `LP_c_ubyte` is.
+	`cast` is not used intentionally: it creates a reference cycle, which would keep the buffer exported (so not resizable and not closeable) till the next GC."""
+	buf = memoryview(buf).cast("B")
+	return (c_ubyte * len(buf)).from_buffer(buf)
+
+
+def sourceToPointer(src: typing.Union[bytes, bytearray, memoryview]) -> LP_c_ubyte:
+	if isinstance(src, bytes):
+		return cast(c_char_p(src), LP_c_ubyte)
+
+	try:
+		return bufferToPointer(src)
+	except TypeError:
+		# read-only buffers other than `bytes` cannot be pointed to by ctypes
+		return cast(c_char_p(bytes(src)), LP_c_ubyte)
+
+
+def pooledAction(pool: BufferPool, intoFunc: typing.Callable, *args, view: bool = False) -> Action:
+	"""Calls an `*_into` function with a buffer borrowed from `pool`. If `view` is set, the returned `Action` holds a `memoryview` into the borrowed buffer and has to be released, otherwise the result is copied into `bytes` and the buffer is returned to the pool immediately."""
+	dst = pool.acquire()
+	opcode, size = intoFunc(*args, dst)
+	if view:
+		return Action(opcode, memoryview(dst)[:size], pool=pool, backing=dst)
+
+	res = Action(opcode, bytes(memoryview(dst)[:size]))
+	pool.release(dst)
+	return res
+
+
 def prepareOutputBuffer(dstSize: int) -> typing.Tuple[LP_c_ubyte, bytearray]:
 	dst = bytearray(dstSize)
 	dstBuff = (c_ubyte * dstSize).from_buffer(dst)
@@ -60,8 +240,37 @@ def decorateProcessTransformer(ctypesFunc: typing.Callable) -> typing.Callable:
 	return procTransformer
 
 
+def decorateReceiverInto(ctypesFunc: typing.Callable) -> typing.Callable:
+	def receiverInto(tPtr: TunnPtr, dst: typing.Union[bytearray, memoryview]) -> typing.Tuple[Opcode, int]:
+		res = ctypesFunc(tPtr, bufferToPointer(dst), memoryview(dst).nbytes)
+		return Opcode(res.op), res.size
+
+	receiverInto.__name__ = ctypesFunc.__name__ + "_into"
+
+	return receiverInto
+
+
+def decorateProcessTransformerInto(ctypesFunc: typing.Callable) -> typing.Callable:
+	def procTransformerInto(tPtr: TunnPtr, src: typing.Union[bytes, bytearray, memoryview], dst: typing.Union[bytearray, memoryview]) -> typing.Tuple[Opcode, int]:
+		res = ctypesFunc(tPtr, sourceToPointer(src), memoryview(src).nbytes, bufferToPointer(dst), memoryview(dst).nbytes)
+		return Opcode(res.op), res.size
+
+	procTransformerInto.__name__ = ctypesFunc.__name__ + "_into"
+
+	return procTransformerInto
+
+
 wireguard_write = decorateProcessTransformer(ct_wireguard_write)
 wireguard_read = decorateProcessTransformer(ct_wireguard_read)
 
 wireguard_tick = decorateReceiver(ct_wireguard_tick)
 wireguard_force_handshake = decorateReceiver(ct_wireguard_force_handshake)
+
+wireguard_write_into = decorateProcessTransformerInto(ct_wireguard_write)
+wireguard_read_into = decorateProcessTransformerInto(ct_wireguard_read)
+
+wireguard_tick_into = decorateReceiverInto(ct_wireguard_tick)
+wireguard_force_handshake_into = decorateReceiverInto(ct_wireguard_force_handshake)
+
+wireguard_write_many = decorateBatchTransformer(ct_wireguard_write_raw)
+wireguard_read_many = decorateBatchTransformer(ct_wireguard_read_raw)
@@ -0,0 +1,256 @@
+"""Byte streams over a tunnel. A tunnel moves IP packets and BoringTun checks the lengths in the IP headers of the decrypted ones, so a stream is framed into IPv4 packets of an experimental protocol, each carrying a 32-bit sequence number ahead of a segment of the stream. The IP checksum is not computed: the frames are for the other end of the stream, not for a kernel.
+The writes are cut into segments fitting `mtu`, the small ones are coalesced for `flushDelay` seconds (like Nagle's algorithm, `noDelay` turns it off), the segments of a flush (i.e. of a `writelines`) are wrapped in a single batch.
+The tunnel runs over UDP, so the frames can be lost or reordered. Nothing is retransmitted: the receiving side fails the stream with `StreamGapError` instead of giving corrupted data."""
+
+__all__ = ("TunnelStream", "StreamGapError", "FRAME_HEADER", "DEFAULT_MTU", "DEFAULT_FLUSH_DELAY")
+
+import asyncio
+import struct
+import typing
+from array import array
+
+FRAME_HEADER = struct.Struct("!BBHHHBBH4s4sI")  # IPv4 header without options and the sequence number
+IPV4_VERSION_IHL = 0x45
+IPV4_DONT_FRAGMENT = 0x4000
+IPV4_TTL = 64
+STREAM_IP_PROTOCOL = 253  # RFC 3692, for experimentation
+PROTOCOL_OFFSET = 9
+FRAME_ADDRESS = bytes((127, 0, 0, 1))
+SEQUENCE_MASK = 0xFFFFFFFF
+
+DEFAULT_MTU = 1420  # the default MTU of WireGuard interfaces
+DEFAULT_FLUSH_DELAY = 0.0  # coalesces the writes done within one iteration of the event loop
+
+
+class StreamGapError(ConnectionError):
+	"""A frame of the stream was lost or reordered."""
+
+
+class TunnelStream(asyncio.Transport, asyncio.DatagramProtocol):
+	"""The app protocol of an `asyncio.BoringTUNProtocol` or of a `WireGuardEndpoint` and the transport of a stream `protocol` (i.e. of `asyncio.StreamReaderProtocol`). For a `WireGuardEndpoint` `peer` is the index of the peer at the other end, the frames are sent to it one by one and only its frames are accepted."""
+
+	ACCEPTS_BORROWED_PACKETS = True  # the payloads are copied out of the frames
+
+	__slots__ = ("protocol", "tunnel", "peer", "segmentSize", "noDelay", "flushDelay", "pending", "flushHandle", "txSeq", "rxSeq", "closing", "eofSent", "loop", "framesSent", "framesReceived")
+
+	def __init__(self, protocol: asyncio.Protocol, mtu: int = DEFAULT_MTU, noDelay: bool = False, flushDelay: float = DEFAULT_FLUSH_DELAY, peer: typing.Optional[int] = None) -> None:
+		if mtu <= FRAME_HEADER.size:
+			raise ValueError("MTU must exceed the frame header", mtu, FRAME_HEADER.size)
+
+		super().__init__()
+		self.protocol = protocol
+		self.tunnel = None
+		self.peer = peer
+		self.segmentSize = mtu - FRAME_HEADER.size
+		self.noDelay = noDelay
+		self.flushDelay = flushDelay
+		self.pending = bytearray()
+		self.flushHandle = None
+		self.txSeq = 0
+		self.rxSeq = 0
+		self.closing = False
+		self.eofSent = False
+		self.loop = None
+		self.framesSent = 0
+		self.framesReceived = 0
+
+	# the side of the tunnel
+
+	def connection_made(self, transport) -> None:
+		self.tunnel = transport
+		self.loop = asyncio.get_running_loop()
+		self.protocol.connection_made(self)
+		if self.pending:
+			self.flush()
+		if self.eofSent:
+			self._sendEof()
+
+	def datagram_received(self, packet: typing.Union[bytes, memoryview], addr) -> None:
+		if self.peer is not None and addr != self.peer:
+			return
+		if len(packet) < FRAME_HEADER.size or packet[PROTOCOL_OFFSET] != STREAM_IP_PROTOCOL or self.protocol is None:
+			return
+
+		header = FRAME_HEADER.unpack_from(packet)
+		totalLength = header[2]
+		seq = header[-1]
+		if seq != self.rxSeq:
+			self._fail(StreamGapError("Expected frame " + str(self.rxSeq) + ", got " + str(seq)))
+			return
+
+		self.rxSeq = (seq + 1) & SEQUENCE_MASK
+		self.framesReceived += 1
+		if totalLength == FRAME_HEADER.size:
+			self.protocol.eof_received()
+		else:
+			self.protocol.data_received(bytes(packet[FRAME_HEADER.size : totalLength]))
+
+	def error_received(self, exc) -> None:
+		pass
+
+	def pause_writing(self) -> None:
+		if self.protocol is not None:
+			self.protocol.pause_writing()
+
+	def resume_writing(self) -> None:
+		if self.protocol is not None:
+			self.protocol.resume_writing()
+
+	def connection_lost(self, exc) -> None:
+		if self.flushHandle is not None:
+			self.flushHandle.cancel()
+			self.flushHandle = None
+		self.closing = True
+		if self.protocol is not None:
+			protocol = self.protocol
+			self.protocol = None
+			protocol.connection_lost(exc if isinstance(exc, BaseException) else None)
+
+	def _fail(self, exc: BaseException) -> None:
+		self.closing = True
+		protocol = self.protocol
+		self.protocol = None
+		protocol.connection_lost(exc)
+
+	# the side of the stream
+
+	def write(self, data: typing.Union[bytes, bytearray, memoryview]) -> None:
+		if self.closing or self.eofSent:
+			raise RuntimeError("Cannot write to a closing stream")
+		if not data:
+			return
+
+		self.pending += data
+		if self.noDelay:
+			self.flush()
+			return
+
+		if len(self.pending) >= self.segmentSize:
+			self._sendSegments(False)
+		if self.pending and self.flushHandle is None and self.loop is not None:
+			self.flushHandle = self.loop.call_later(self.flushDelay, self.flush)
+
+	def writelines(self, chunks: typing.Iterable[typing.Union[bytes, bytearray, memoryview]]) -> None:
+		"""Gathers `chunks` with the coalesced writes and sends them in a single batch."""
+		if self.closing or self.eofSent:
+			raise RuntimeError("Cannot write to a closing stream")
+
+		for chunk in chunks:
+			self.pending += chunk
+		self.flush()
+
+	def flush(self) -> None:
+		"""Sends all the coalesced data now."""
+		if self.flushHandle is not None:
+			self.flushHandle.cancel()
+			self.flushHandle = None
+		self._sendSegments(True)
+
+	def _sendSegments(self, final: bool) -> None:
+		"""Frames the pending data into a contiguous buffer and sends it. Unless `final`, the incomplete segment in the end is kept pending."""
+		if self.tunnel is None:
+			return  # flushed on `connection_made`
+
+		pending = self.pending
+		segmentSize = self.segmentSize
+		count, rest = divmod(len(pending), segmentSize)
+		if final and rest:
+			count += 1
+			size = len(pending)
+		else:
+			size = count * segmentSize
+		if not count:
+			return
+
+		frames = bytearray(size + count * FRAME_HEADER.size)
+		offsets = array("I", bytes(4 * (count + 1)))
+		o = 0
+		with memoryview(pending) as src:
+			for i in range(count):
+				start = i * segmentSize
+				segmentLen = min(segmentSize, size - start)
+				self._packHeader(frames, o, segmentLen)
+				o += FRAME_HEADER.size
+				frames[o : o + segmentLen] = src[start : start + segmentLen]
+				o += segmentLen
+				offsets[i + 1] = o
+		del pending[:size]
+
+		self._sendFrames(frames, offsets)
+
+	def _packHeader(self, buf: bytearray, offset: int, payloadSize: int) -> None:
+		FRAME_HEADER.pack_into(buf, offset, IPV4_VERSION_IHL, 0, FRAME_HEADER.size + payloadSize, 0, IPV4_DONT_FRAGMENT, IPV4_TTL, STREAM_IP_PROTOCOL, 0, FRAME_ADDRESS, FRAME_ADDRESS, self.txSeq)
+		self.txSeq = (self.txSeq + 1) & SEQUENCE_MASK
+
+	def _sendFrames(self, frames: bytearray, offsets: array) -> None:
+		count = len(offsets) - 1
+		self.framesSent += count
+		if self.peer is None:
+			self.tunnel.write_many(frames, offsets)
+		else:
+			view = memoryview(frames)
+			for i in range(count):
+				self.tunnel.sendto(view[offsets[i] : offsets[i + 1]], self.peer)
+
+	def can_write_eof(self) -> bool:
+		return True
+
+	def write_eof(self) -> None:
+		"""Flushes and sends an empty frame, the other side gets `eof_received`."""
+		if self.eofSent:
+			return
+		self.flush()
+		self.eofSent = True
+		if self.tunnel is not None:
+			self._sendEof()
+
+	def _sendEof(self) -> None:
+		frame = bytearray(FRAME_HEADER.size)
+		self._packHeader(frame, 0, 0)
+		self._sendFrames(frame, array("I", (0, len(frame))))
+
+	def get_write_buffer_size(self) -> int:
+		res = len(self.pending)
+		if self.tunnel is not None and self.peer is None:
+			res += self.tunnel.get_write_buffer_size()
+		return res
+
+	def get_write_buffer_limits(self) -> typing.Tuple[int, int]:
+		return self.tunnel.get_write_buffer_limits()
+
+	def set_write_buffer_limits(self, high: typing.Optional[int] = None, low: typing.Optional[int] = None) -> None:
+		self.tunnel.set_write_buffer_limits(high, low)
+
+	def is_reading(self) -> bool:
+		return not self.closing
+
+	def pause_reading(self) -> None:
+		pass  # the datagrams cannot be held back by the sender, so the stream buffers them anyway
+
+	def resume_reading(self) -> None:
+		pass
+
+	def is_closing(self) -> bool:
+		return self.closing
+
+	def close(self) -> None:
+		"""Flushes the coalesced data and closes the tunnel under the stream (for an endpoint, sends the EOF)."""
+		if self.closing:
+			return
+		if self.peer is not None:
+			# the endpoint is shared by the other peers, so the other side just gets the EOF
+			self.write_eof()
+			self.connection_lost(None)
+			return
+
+		self.flush()
+		self.closing = True
+		if self.tunnel is not None and self.tunnel.transport is not None:
+			self.tunnel.transport.close()
+
+	def abort(self) -> None:
+		self.pending.clear()
+		self.close()
+
+	def __repr__(self):
+		return self.__class__.__name__ + "<sent: " + repr(self.framesSent) + " frames, received: " + repr(self.framesReceived) + " frames, pending: " + repr(len(self.pending)) + " bytes>"
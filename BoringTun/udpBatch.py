@@ -0,0 +1,497 @@
+"""Batched UDP I/O. On Linux the datagrams are received with `recvmmsg` and sent with `sendmmsg`, so a single syscall moves a whole batch. On other platforms the same interface is implemented with loops of `recvfrom_into` and `send`/`sendto`."""
+
+__all__ = ("IS_MMSG_AVAILABLE", "DatagramBatch", "DatagramBatchReceiver", "DatagramBatchSender", "BatchedDatagramTransport", "createBatchedDatagramEndpoint")
+
+import asyncio
+import errno
+import os
+import platform
+import socket
+import struct
+import sys
+import typing
+from array import array
+from ctypes import CDLL, POINTER, Structure, addressof, c_char_p, c_int, c_size_t, c_ubyte, c_uint, c_uint32, c_void_p, cast, get_errno, memmove
+
+from .messageHeaders import MessageHeaders, parseHeaders
+from .tunnelMiddleLevel import bufferAddress
+
+# pylint:disable=too-few-public-methods
+
+DEFAULT_BATCH_SIZE = 32
+DEFAULT_SLOT_SIZE = 0x10000  # the max UDP payload fits
+SOCKADDR_STORAGE_SIZE = 128
+
+
+class iovec(Structure):
+	__slots__ = ("iov_base", "iov_len")
+	_fields_ = (
+		("iov_base", c_void_p),
+		("iov_len", c_size_t),
+	)
+
+
+class msghdr(Structure):
+	__slots__ = ("msg_name", "msg_namelen", "msg_iov", "msg_iovlen", "msg_control", "msg_controllen", "msg_flags")
+	_fields_ = (
+		("msg_name", c_void_p),
+		("msg_namelen", c_uint32),
+		("msg_iov", POINTER(iovec)),
+		("msg_iovlen", c_size_t),
+		("msg_control", c_void_p),
+		("msg_controllen", c_size_t),
+		("msg_flags", c_int),
+	)
+
+
+class mmsghdr(Structure):
+	__slots__ = ("msg_hdr", "msg_len")
+	_fields_ = (
+		("msg_hdr", msghdr),
+		("msg_len", c_uint),
+	)
+
+
+def _bindMMsg():
+	if platform.system() != "Linux":
+		return None, None
+
+	libc = CDLL(None, use_errno=True)
+	try:
+		recvmmsg = libc.recvmmsg
+		sendmmsg = libc.sendmmsg
+	except AttributeError:
+		return None, None
+
+	recvmmsg.argtypes = (c_int, POINTER(mmsghdr), c_uint, c_int, c_void_p)
+	recvmmsg.restype = c_int
+	sendmmsg.argtypes = (c_int, POINTER(mmsghdr), c_uint, c_int)
+	sendmmsg.restype = c_int
+	return recvmmsg, sendmmsg
+
+
+_recvmmsg, _sendmmsg = _bindMMsg()
+IS_MMSG_AVAILABLE = _recvmmsg is not None
+
+
+def decodeSockAddr(raw: typing.Union[bytes, memoryview]) -> typing.Optional[typing.Tuple[str, int]]:
+	family = int.from_bytes(raw[:2], sys.byteorder)
+	if family == socket.AF_INET:
+		return socket.inet_ntop(socket.AF_INET, raw[4:8]), int.from_bytes(raw[2:4], "big")
+	if family == socket.AF_INET6:
+		return socket.inet_ntop(socket.AF_INET6, raw[8:24]), int.from_bytes(raw[2:4], "big")
+	return None
+
+
+_sockaddrIn = struct.Struct("=H2s4s8x")
+_sockaddrIn6 = struct.Struct("=H2sI16sI")
+
+
+def encodeSockAddr(addr: typing.Tuple[str, int]) -> bytes:
+	host, port = addr[0], addr[1]
+	port = port.to_bytes(2, "big")
+	try:
+		return _sockaddrIn.pack(socket.AF_INET, port, socket.inet_pton(socket.AF_INET, host))
+	except OSError:
+		return _sockaddrIn6.pack(socket.AF_INET6, port, 0, socket.inet_pton(socket.AF_INET6, host), 0)
+
+
+class DatagramBatch:
+	"""A batch of received datagrams. They are stored in fixed-size slots of a single `buffer`: the i-th datagram is `buffer[offsets[i]:offsets[i] + sizes[i]]`, so `(buffer, offsets, sizes)` can be passed to `OpenTunnel.unwrap_many` as is.
+	The batch is owned by its receiver and is overwritten by the next `receive`, so consume it before that."""
+
+	__slots__ = ("buffer", "offsets", "sizes", "count", "rawAddresses", "addressSize")
+
+	def __init__(self, batchSize: int, slotSize: int) -> None:
+		self.buffer = bytearray(batchSize * slotSize)
+		self.offsets = array("I", range(0, batchSize * slotSize, slotSize))
+		self.sizes = array("I", bytes(4 * batchSize))
+		self.count = 0
+		self.rawAddresses = bytearray(batchSize * SOCKADDR_STORAGE_SIZE)
+		self.addressSize = SOCKADDR_STORAGE_SIZE
+
+	def __len__(self) -> int:
+		return self.count
+
+	def __getitem__(self, i: int) -> memoryview:
+		if i >= self.count:
+			raise IndexError(i)
+		offset = self.offsets[i]
+		return memoryview(self.buffer)[offset : offset + self.sizes[i]]
+
+	def __iter__(self) -> typing.Iterator[memoryview]:
+		for i in range(self.count):
+			yield self[i]
+
+	def address(self, i: int) -> typing.Optional[typing.Tuple[str, int]]:
+		"""Decodes the source address of the i-th datagram. Done lazily, since connected sockets don't need it."""
+		start = i * self.addressSize
+		return decodeSockAddr(memoryview(self.rawAddresses)[start : start + self.addressSize])
+
+	@property
+	def usedSizes(self) -> memoryview:
+		return memoryview(self.sizes)[: self.count]
+
+	@property
+	def usedOffsets(self) -> memoryview:
+		return memoryview(self.offsets)[: self.count]
+
+	def headers(self) -> MessageHeaders:
+		"""Parses the WireGuard headers of all the datagrams at once."""
+		return parseHeaders(self.buffer, self.usedOffsets, self.usedSizes)
+
+
+class DatagramBatchReceiver:
+	"""Receives up to `batchSize` datagrams from a non-blocking socket into preallocated memory."""
+
+	__slots__ = ("sock", "batch", "useMMsg", "_hdrs", "_iovs", "_hdrsTemplate", "_keepAlive")
+
+	def __init__(self, sock: socket.socket, batchSize: int = DEFAULT_BATCH_SIZE, slotSize: int = DEFAULT_SLOT_SIZE, useMMsg: typing.Optional[bool] = None) -> None:
+		self.sock = sock
+		self.batch = DatagramBatch(batchSize, slotSize)
+
+		if useMMsg is None:
+			useMMsg = IS_MMSG_AVAILABLE
+		self.useMMsg = useMMsg
+
+		self._hdrs = None
+		self._iovs = None
+		self._hdrsTemplate = None
+		self._keepAlive = None
+
+		if useMMsg:
+			self._prepareMMsg(batchSize, slotSize)
+
+	def _prepareMMsg(self, batchSize: int, slotSize: int) -> None:
+		buf = (c_ubyte * len(self.batch.buffer)).from_buffer(self.batch.buffer)
+		addrs = (c_ubyte * len(self.batch.rawAddresses)).from_buffer(self.batch.rawAddresses)
+		self._keepAlive = (buf, addrs)
+
+		self._iovs = (iovec * batchSize)()
+		self._hdrs = (mmsghdr * batchSize)()
+		bufBase = addressof(buf)
+		addrsBase = addressof(addrs)
+		for i in range(batchSize):
+			self._iovs[i].iov_base = bufBase + i * slotSize
+			self._iovs[i].iov_len = slotSize
+			hdr = self._hdrs[i].msg_hdr
+			hdr.msg_name = addrsBase + i * SOCKADDR_STORAGE_SIZE
+			hdr.msg_namelen = SOCKADDR_STORAGE_SIZE
+			hdr.msg_iov = cast(addressof(self._iovs[i]), POINTER(iovec))
+			hdr.msg_iovlen = 1
+
+		# the kernel overwrites `msg_namelen` and `msg_len`, they are restored with a single `memmove` before each call
+		self._hdrsTemplate = bytes(self._hdrs)
+
+	def receive(self) -> DatagramBatch:
+		"""Drains up to `batchSize` datagrams that are ready. Returns an empty batch if there are none."""
+		if self.useMMsg:
+			return self._receiveMMsg()
+		return self._receiveLoop()
+
+	def _receiveMMsg(self) -> DatagramBatch:
+		batch = self.batch
+		memmove(self._hdrs, self._hdrsTemplate, len(self._hdrsTemplate))
+		count = _recvmmsg(self.sock.fileno(), self._hdrs, len(batch.offsets), socket.MSG_DONTWAIT, None)
+		if count < 0:
+			err = get_errno()
+			if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+				count = 0
+			else:
+				raise OSError(err, "recvmmsg failed")
+
+		hdrs = self._hdrs
+		sizes = batch.sizes
+		for i in range(count):
+			sizes[i] = hdrs[i].msg_len
+		batch.count = count
+		return batch
+
+	def _receiveLoop(self) -> DatagramBatch:
+		batch = self.batch
+		buf = memoryview(batch.buffer)
+		slotSize = len(batch.buffer) // len(batch.offsets)
+		count = 0
+		addresses = []
+		try:
+			for offset in batch.offsets:
+				size, addr = self.sock.recvfrom_into(buf[offset : offset + slotSize])
+				batch.sizes[count] = size
+				addresses.append(addr)
+				count += 1
+		except (BlockingIOError, InterruptedError):
+			pass
+
+		for i, addr in enumerate(addresses):
+			if addr:
+				raw = encodeSockAddr(addr)
+				start = i * SOCKADDR_STORAGE_SIZE
+				batch.rawAddresses[start : start + len(raw)] = raw
+
+		batch.count = count
+		return batch
+
+
+class DatagramBatchSender:
+	"""Accumulates outgoing datagrams and sends them with as few syscalls as possible. The payloads that are not `bytes` are copied when queued, since the callers may reuse or release their buffers right after, i.e. the pooled `Action.buf`s."""
+
+	__slots__ = ("sock", "batchSize", "useMMsg", "queue", "queuedBytes", "_hdrs", "_iovs")
+
+	def __init__(self, sock: socket.socket, batchSize: int = DEFAULT_BATCH_SIZE, useMMsg: typing.Optional[bool] = None) -> None:
+		self.sock = sock
+		self.batchSize = batchSize
+
+		if useMMsg is None:
+			useMMsg = IS_MMSG_AVAILABLE
+		self.useMMsg = useMMsg
+
+		self.queue = []
+		self.queuedBytes = 0
+		if useMMsg:
+			self._iovs = (iovec * batchSize)()
+			self._hdrs = (mmsghdr * batchSize)()
+			for i in range(batchSize):
+				hdr = self._hdrs[i].msg_hdr
+				hdr.msg_iov = cast(addressof(self._iovs[i]), POINTER(iovec))
+				hdr.msg_iovlen = 1
+		else:
+			self._iovs = None
+			self._hdrs = None
+
+	def __len__(self) -> int:
+		return len(self.queue)
+
+	def enqueue(self, data: typing.Union[bytes, bytearray, memoryview], addr: typing.Optional[typing.Tuple[str, int]] = None) -> None:
+		if type(data) is not bytes:
+			data = bytes(data)
+		self.queue.append((data, addr))
+		self.queuedBytes += len(data)
+
+	def flush(self, onError: typing.Optional[typing.Callable[[Exception], None]] = None) -> bool:
+		"""Sends the queued datagrams. Returns `True` if everything was sent and `False` if the socket buffer got full, in that case the rest stays queued. A datagram that cannot be sent is dropped and the exception is given to `onError`, the rest are still sent."""
+		queue = self.queue
+		send = self._sendMMsg if self.useMMsg else self._sendLoop
+		done = 0
+		try:
+			while done < len(queue):
+				try:
+					sent = send(done)
+				except Exception as ex:  # pylint:disable=broad-except
+					done += 1
+					if onError is not None:
+						onError(ex)
+					continue
+				if not sent:
+					break
+				done += sent
+		finally:
+			for data, addr in queue[:done]:
+				self.queuedBytes -= len(data)
+			del queue[:done]
+		return not queue
+
+	def clear(self) -> None:
+		self.queue.clear()
+		self.queuedBytes = 0
+
+	def _sendMMsg(self, start: int) -> int:
+		"""Sends a chunk of the queue beginning at `start`. Returns the count of the sent datagrams, 0 if the socket buffer is full; raises if the first of them cannot be sent."""
+		chunk = self.queue[start : start + self.batchSize]
+		keepAlive = []
+		count = 0
+		try:
+			for i, (data, addr) in enumerate(chunk):
+				ptr, ka = bufferAddress(data)
+				if isinstance(ptr, bytes):
+					ptr = cast(c_char_p(ptr), c_void_p).value
+				keepAlive.append(ka)
+				self._iovs[i].iov_base = ptr
+				self._iovs[i].iov_len = len(data)
+				hdr = self._hdrs[i].msg_hdr
+				if addr is None:
+					hdr.msg_name = None
+					hdr.msg_namelen = 0
+				else:
+					rawAddr = encodeSockAddr(addr)
+					keepAlive.append(rawAddr)
+					hdr.msg_name = cast(c_char_p(rawAddr), c_void_p).value
+					hdr.msg_namelen = len(rawAddr)
+				count = i + 1
+		except Exception:
+			if not count:
+				raise
+			# the ones before the bad datagram are sent, the next call raises for it
+
+		res = _sendmmsg(self.sock.fileno(), self._hdrs, count, socket.MSG_DONTWAIT)
+		if res < 0:
+			err = get_errno()
+			if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR, errno.ENOBUFS):
+				return 0
+			raise OSError(err, "sendmmsg failed: " + os.strerror(err))
+		return res  # if fewer were sent, the next call gets the error of the next datagram
+
+	def _sendLoop(self, start: int) -> int:
+		"""The same as `_sendMMsg` with a syscall per datagram."""
+		queue = self.queue
+		total = 0
+		try:
+			for data, addr in queue[start:]:
+				if addr is None:
+					self.sock.send(data)
+				else:
+					self.sock.sendto(data, addr)
+				total += 1
+		except (BlockingIOError, InterruptedError):
+			pass
+		except Exception:
+			if not total:
+				raise
+		return total
+
+
+def _setResultUnlessCancelled(fut: asyncio.Future, result: typing.Any) -> None:
+	if not fut.cancelled():
+		fut.set_result(result)
+
+
+class BatchedDatagramTransport(asyncio.DatagramTransport):
+	"""A datagram transport doing batched I/O. If the protocol has `datagrams_received(batch)`, whole `DatagramBatch`es are given to it, otherwise `datagram_received` is called for each datagram.
+	`sendto` only queues, the queue is flushed once per event loop iteration."""
+
+	def __init__(self, loop: asyncio.AbstractEventLoop, sock: socket.socket, protocol: asyncio.DatagramProtocol, batchSize: int = DEFAULT_BATCH_SIZE, slotSize: int = DEFAULT_SLOT_SIZE, useMMsg: typing.Optional[bool] = None, waiter: typing.Optional[asyncio.Future] = None) -> None:
+		super().__init__(extra={"socket": sock, "sockname": sock.getsockname()})
+		try:
+			self._extra["peername"] = sock.getpeername()
+		except OSError:
+			self._extra["peername"] = None
+
+		self._loop = loop
+		self._sock = sock
+		self._protocol = protocol
+		self.receiver = DatagramBatchReceiver(sock, batchSize, slotSize, useMMsg)
+		self.sender = DatagramBatchSender(sock, batchSize, useMMsg)
+		self._flushScheduled = False
+		self._writerRegistered = False
+		self._closing = False
+		self._protocolPaused = False
+		self._highWater = self._lowWater = None
+		self.set_write_buffer_limits()
+		self._batchReceiver = getattr(protocol, "datagrams_received", None)
+
+		self._loop.add_reader(sock.fileno(), self._onReadable)
+		self._loop.call_soon(protocol.connection_made, self)
+		if waiter is not None:
+			self._loop.call_soon(_setResultUnlessCancelled, waiter, None)
+
+	def _onReadable(self) -> None:
+		try:
+			batch = self.receiver.receive()
+		except OSError as ex:
+			self._protocol.error_received(ex)
+			return
+
+		if not batch.count:
+			return
+
+		if self._batchReceiver is not None:
+			self._batchReceiver(batch)
+		else:
+			for i, datagram in enumerate(batch):
+				self._protocol.datagram_received(bytes(datagram), batch.address(i))
+
+		self._flush()
+
+	def sendto(self, data: typing.Union[bytes, bytearray, memoryview], addr: typing.Optional[typing.Tuple[str, int]] = None) -> None:
+		if self._closing:
+			return
+
+		self.sender.enqueue(data, addr)
+		if not self._protocolPaused and self.sender.queuedBytes > self._highWater:
+			self._protocolPaused = True
+			self._protocol.pause_writing()
+
+		if not self._flushScheduled and not self._writerRegistered:
+			self._flushScheduled = True
+			self._loop.call_soon(self._flush)
+
+	def _flush(self) -> None:
+		self._flushScheduled = False
+		done = self.sender.flush(self._protocol.error_received)
+
+		if self._protocolPaused and self.sender.queuedBytes <= self._lowWater:
+			self._protocolPaused = False
+			self._protocol.resume_writing()
+
+		if done:
+			if self._writerRegistered:
+				self._loop.remove_writer(self._sock.fileno())
+				self._writerRegistered = False
+		elif not self._writerRegistered:
+			self._loop.add_writer(self._sock.fileno(), self._flush)
+			self._writerRegistered = True
+
+	def get_write_buffer_size(self) -> int:
+		return self.sender.queuedBytes
+
+	def get_write_buffer_limits(self) -> typing.Tuple[int, int]:
+		return self._lowWater, self._highWater
+
+	def set_write_buffer_limits(self, high: typing.Optional[int] = None, low: typing.Optional[int] = None) -> None:
+		if high is None:
+			high = 4 * low if low is not None else 0x10000
+		if low is None:
+			low = high // 4
+		if not high >= low >= 0:
+			raise ValueError("high (" + repr(high) + ") must be >= low (" + repr(low) + ") must be >= 0")
+		self._highWater = high
+		self._lowWater = low
+
+	def is_closing(self) -> bool:
+		return self._closing
+
+	def close(self) -> None:
+		if self._closing:
+			return
+
+		self._closing = True
+		self._loop.remove_reader(self._sock.fileno())
+		if self._writerRegistered:
+			self._loop.remove_writer(self._sock.fileno())
+		self.sender.flush()
+		self._loop.call_soon(self._finishClose)
+
+	def _finishClose(self) -> None:
+		self._sock.close()
+		self._protocol.connection_lost(None)
+
+	def abort(self) -> None:
+		self.sender.clear()
+		self.close()
+
+
+async def createBatchedDatagramEndpoint(protocolFactory: typing.Callable[[], asyncio.DatagramProtocol], local_addr: typing.Optional[typing.Tuple[str, int]] = None, remote_addr: typing.Optional[typing.Tuple[str, int]] = None, batchSize: int = DEFAULT_BATCH_SIZE, slotSize: int = DEFAULT_SLOT_SIZE, useMMsg: typing.Optional[bool] = None) -> typing.Tuple[BatchedDatagramTransport, asyncio.DatagramProtocol]:
+	"""An analogue of `loop.create_datagram_endpoint` creating a `BatchedDatagramTransport`. As there, `connection_made` of the protocol has been called when it returns."""
+	loop = asyncio.get_running_loop()
+
+	addr = remote_addr if remote_addr is not None else local_addr
+	family = socket.AF_INET6 if addr is not None and ":" in str(addr[0]) else socket.AF_INET
+	sock = socket.socket(family, socket.SOCK_DGRAM)
+	try:
+		sock.setblocking(False)
+		if local_addr is not None:
+			sock.bind((str(local_addr[0]), local_addr[1]))
+		if remote_addr is not None:
+			sock.connect((str(remote_addr[0]), remote_addr[1]))
+	except BaseException:
+		sock.close()
+		raise
+
+	protocol = protocolFactory()
+	waiter = loop.create_future()
+	transport = BatchedDatagramTransport(loop, sock, protocol, batchSize, slotSize, useMMsg, waiter)
+	try:
+		await waiter
+	except BaseException:
+		transport.close()
+		raise
+	return transport, protocol
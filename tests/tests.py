@@ -14,6 +14,7 @@ dict = OrderedDict
 import BoringTUN
 from BoringTUN import *
 from BoringTUN.config import WGConfig, Interface, Peer
+from BoringTUN.ctypes import MAX_WIREGUARD_PACKET_SIZE
 
 pingPacket = (
 	b"\x45\x00\x00\x54\x84\xcb\x40\x00\x40\x01\xb7\xdb\x7f\x00\x00\x01\x7f\x00\x00\x01"  # IPv4 header
@@ -25,6 +26,77 @@ class Tests(unittest.TestCase):
 	def testPublicKeyExtraction(self):
 		self.assertEqual(KeyPair(sec=SecretKey.fromBase64("YJ1bbwR9OA+7AIZI0fnLA84lcltZXbsXej+rhYZvS3A="), pub=None).pub.base64(), "JHIy+6HJTke/0WzMVLDsRnV/n/YxfiCSZargR2ZmKAY=")
 
+	def testCodecsDontLoadLib(self):
+		import os
+		import subprocess
+
+		code = "import BoringTUN.ctypes as c\nfrom BoringTUN.KeyPair import Key, nativeCodecs\nk = Key.fromKeyBytes(bytes(range(32)))\nk.base64(), k.hex()\nprint(c._lib is None, all(not v for v in nativeCodecs().values()))"
+		res = subprocess.run([sys.executable, "-c", code], env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)), capture_output=True, text=True, check=True)
+		self.assertEqual(res.stdout.split(), ["True", "True"])
+
+		import BoringTUN.KeyPair
+		from BoringTUN.KeyPair import measureCodecs, nativeCodecs
+
+		self.addCleanup(setattr, BoringTUN.KeyPair, "_nativeCodecs", None)
+		k = Key.fromKeyBytes(bytes(range(32)))
+		self.assertEqual(measureCodecs(rounds=2), nativeCodecs())
+		self.assertEqual((k.base64(), k.hex()), (k._base64Python(), k._hexPython()))
+
+	def testNativeBenchmark(self):
+		from ctypes import c_int32, c_uint32
+		from BoringTUN.bench import MAX_NATIVE_BENCHMARKS, nativeBenchmark, nativeBenchmarks
+		from BoringTUN.ctypes import getLib
+
+		res = nativeBenchmarks()
+		self.assertTrue(all(isinstance(el, str) for el in res))
+		self.assertEqual(nativeBenchmark(0, 0), res[0] if res else None)
+		self.assertIsNone(nativeBenchmark(0, MAX_NATIVE_BENCHMARKS))
+		self.assertEqual(list(getLib().benchmark.argtypes), [c_int32, c_uint32])
+
+	def testBenchCLI(self):
+		import json
+		import os
+		import subprocess
+
+		argv = [sys.executable, "-m", "BoringTUN.bench", "--suites", "native,handshake,throughput,tick,open", "--packet-sizes", "64", "--packets", "4", "--handshakes", "2", "--tunnels", "2", "--rounds", "1"]
+		res = json.loads(subprocess.run(argv, env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)), capture_output=True, text=True, check=True).stdout)
+		self.assertEqual(sorted(res["results"]), ["handshake", "native", "open", "throughput", "tick"])
+		self.assertEqual(res["results"]["handshake"]["handshakes"], 2)
+		self.assertEqual([el["packetSize"] for el in res["results"]["throughput"]], [64])
+
+	def testKeyBatches(self):
+		secrets = SecretKey.generate_many(10)
+		encoded = Key.base64_many(secrets)
+		self.assertEqual([encoded[i * 44 : (i + 1) * 44].decode("ascii") for i in range(10)], [k._base64Python() for k in secrets])
+		self.assertEqual([bytes(k) for k in SecretKey.public_many(secrets)], [bytes(k.getPublic()) for k in secrets])
+		self.assertEqual(Key.base64_many([]), b"")
+
+	def testLibraryLookup(self):
+		import os
+		from unittest import mock
+		from BoringTUN.ctypes import LIBRARY_PATH_ENV_VAR, libraryCandidates
+		from BoringTUN.KeyPair import check_base64_encoded_x25519_key
+
+		with mock.patch.dict(os.environ, {LIBRARY_PATH_ENV_VAR: "/opt/boringtun/libboringtun.so"}):
+			self.assertEqual(list(libraryCandidates()), ["/opt/boringtun/libboringtun.so"])
+		with mock.patch.dict(os.environ, {LIBRARY_PATH_ENV_VAR: ""}):
+			self.assertEqual(Path(next(libraryCandidates())).parent, Path(BoringTUN.__file__).parent)
+
+		self.assertTrue(check_base64_encoded_x25519_key("JHIy+6HJTke/0WzMVLDsRnV/n/YxfiCSZargR2ZmKAY="))
+		self.assertFalse(check_base64_encoded_x25519_key("JHIy+6HJTke/0WzMVLDsRnV/n/YxfiCSZargR2ZmKA=="))
+		self.assertFalse(check_base64_encoded_x25519_key("not a key"))
+
+	def testBackend(self):
+		from BoringTUN.backend import BACKEND_FUNCTIONS, BACKENDS, loadBackend
+
+		self.assertIn(BACKEND_NAME, BACKENDS)
+		name, backend = loadBackend("ctypes")
+		self.assertEqual(name, "ctypes")
+		for funcName in BACKEND_FUNCTIONS:
+			self.assertTrue(callable(getattr(backend, funcName)))
+		with self.assertRaises(ValueError):
+			loadBackend("nonexistent")
+
 	def testRoundTrip(self):
 		p1 = KeyPair(sec=None, pub=None)
 		p2 = KeyPair(sec=None, pub=None)
@@ -73,6 +145,37 @@ class Tests(unittest.TestCase):
 				self.assertEqual(rx.opcode, Opcode.WRITE_TO_TUNNEL_IPV4)
 				self.assertEqual(rx.buf, pingPacket)
 
+				# zero-copy API
+				dst = bytearray(MAX_WIREGUARD_PACKET_SIZE)
+				opcode, size = t1.wrap_into(pingPacket, dst)
+				self.assertEqual(opcode, Opcode.WRITE_TO_NETWORK)
+				rxBuf = bytearray(size)  # BoringTun needs the space for the whole ciphertext
+				with self.assertRaises(ValueError):
+					t2.unwrap_into(memoryview(dst)[:size], rxBuf[:len(pingPacket)])
+				with self.assertRaises(ValueError):
+					t1.wrap_into(pingPacket, bytearray(len(pingPacket) + 31))
+				opcode, size = t2.unwrap_into(memoryview(dst)[:size], rxBuf)
+				self.assertEqual(opcode, Opcode.WRITE_TO_TUNNEL_IPV4)
+				self.assertEqual(rxBuf[:size], pingPacket)
+
+				# pooled actions
+				t1.pooledActions = True
+				t2.pooledActions = True
+				with t1.wrap(pingPacket) as tx:
+					self.assertIsInstance(tx.buf, memoryview)
+					with t2.unwrap(tx.buf) as rx:
+						self.assertEqual(rx.opcode, Opcode.WRITE_TO_TUNNEL_IPV4)
+						self.assertEqual(rx.buf, pingPacket)
+				self.assertIsNone(tx.buf)
+				self.assertEqual(len(t1.pool), 1)
+
+				# batches
+				txs = t1.wrap_many([pingPacket, bytearray(pingPacket)])
+				self.assertEqual(list(txs.opcodes), [Opcode.WRITE_TO_NETWORK] * 2)
+				contiguous = b"".join(bytes(buf) for opcode, buf in txs)
+				rxs = t2.unwrap_many(contiguous, [0, txs.sizes[0], txs.sizes[0] + txs.sizes[1]])
+				self.assertEqual([(opcode, bytes(buf)) for opcode, buf in rxs], [(Opcode.WRITE_TO_TUNNEL_IPV4, pingPacket)] * 2)
+
 				#test ticks
 				#tx = t1.tick()
 				#self.assertEqual(tx.opcode, Opcode.WRITE_TO_NETWORK)
@@ -81,11 +184,755 @@ class Tests(unittest.TestCase):
 
 				# test_stats
 				s1 = t1.stats()
-				self.assertEqual(s1.tx_bytes, 84)
+				self.assertEqual(s1.tx_bytes, 5 * 84)
 				self.assertEqual(s1.rx_bytes, 0)
 				s2 = t2.stats()
 				self.assertEqual(s2.tx_bytes, 0)
-				self.assertEqual(s2.rx_bytes, 84)
+				self.assertEqual(s2.rx_bytes, 5 * 84)
+
+	def testPeerTable(self):
+		from ipaddress import ip_address
+		from BoringTUN.config import PeerTable
+
+		pubs = [KeyPair(sec=None, pub=None).pub for i in range(3)]
+		peers = [Peer(pub=pubs[0], ip=ip_address("127.0.0.1"), port=51820), Peer(pub=pubs[1], ip=ip_address("::1"), port=51821, psk="psk"), Peer(pub=pubs[2], ip=None, port=None, keepAliveTimeout=None)]
+		table = PeerTable.fromPeers(peers)
+		self.assertEqual(len(table), 3)
+		self.assertEqual(bytes(table.keys), b"".join(bytes(k) for k in pubs))
+		for i, (orig, peer) in enumerate(zip(peers, table)):
+			self.assertEqual((bytes(peer.pub), peer.ip, peer.port, peer.psk, peer.keepAliveTimeout), (bytes(orig.pub), orig.ip, orig.port, orig.psk, orig.keepAliveTimeout))
+			view = table.view(i)
+			self.assertEqual((bytes(view.pub), view.ip, view.port, view.psk, view.keepAliveTimeout), (bytes(orig.pub), orig.ip, orig.port, orig.psk, orig.keepAliveTimeout))
+		self.assertEqual(table.indexOfKey(pubs[1]), 1)
+		self.assertEqual(table.indexOfEndpoint("127.0.0.1", 51820), 0)
+		self.assertEqual(table.indexOfEndpoint("::1", 51821), 1)
+		table.setEndpoint(0, "127.0.0.2", 1)
+		self.assertIsNone(table.indexOfEndpoint("127.0.0.1", 51820))
+		self.assertEqual(table.indexOfEndpoint("127.0.0.2", 1), 0)
+		with self.assertRaises(KeyError):
+			table.appendPeer(peers[0])
+
+	def testConfigParsing(self):
+		import tempfile
+		from BoringTUN.confParser import readConfig
+
+		ifaceKeys = KeyPair(sec=None, pub=None)
+		peerKeys = [KeyPair(sec=None, pub=None).pub for i in range(5)]
+		text = "[Interface]\nPrivateKey = " + ifaceKeys.sec.base64() + "  # comment\nListenPort = 51820\n\n"
+		for i, pub in enumerate(peerKeys):
+			text += "[Peer]\npublickey = " + pub.base64() + "\nAllowedIPs = 10.0.0." + str(i) + "/32\nAllowedIPs = fd00::" + str(i) + "/128\n"
+			if i % 2:
+				text += "Endpoint = [::1]:" + str(1000 + i) + "\nPersistentKeepalive = 25\n"
+			elif i:
+				text += "PersistentKeepalive = " + ("off" if i == 2 else "0") + "\n"
+
+		with tempfile.TemporaryDirectory() as d:
+			p = Path(d) / "wg0.conf"
+			p.write_text(text)
+			for table in (False, True):
+				with self.subTest(table=table):
+					cfg = readConfig(p, table=table, batchSize=2)
+					self.assertEqual(bytes(cfg.interface.sec), bytes(ifaceKeys.sec))
+					self.assertEqual([bytes(peer.pub) for peer in cfg.peers], [bytes(k) for k in peerKeys])
+					self.assertEqual([(str(peer.ip), peer.port, peer.keepAliveTimeout) for peer in cfg.peers][:2], [("None", None, 10), ("::1", 1001, 25)])
+					self.assertEqual([str(n) for n in cfg.peers[1].allowedIPs], ["10.0.0.1/32", "fd00::1/128"])
+					self.assertEqual([peer.keepAliveTimeout for peer in cfg.peers], [10, 25, None, 25, None])
+					Tunnel.open_many(cfg).close()
+
+			p.write_text(text.replace(peerKeys[3].base64(), "AAAA"))
+			with self.assertRaisesRegex(ValueError, "line " + str(text.count("\n", 0, text.index(peerKeys[3].base64())))):
+				readConfig(p)
+
+	def testAllowedIPs(self):
+		from BoringTUN.allowedIPs import NO_PEER, AllowedIPs
+		from BoringTUN.bench import IPV4_HEADER
+
+		def packet(dst, src="10.9.9.9"):
+			from ipaddress import ip_address
+
+			dst, src = ip_address(dst), ip_address(src)
+			if dst.version == 4:
+				return IPV4_HEADER.pack(0x45, 0, 20, 0, 0, 64, 17, 0, src.packed, dst.packed)
+			return b"\x60" + bytes(7) + ip_address("fd00::9").packed + dst.packed
+
+		table = AllowedIPs.fromPeers([Peer(pub=None, ip=None, port=None, allowedIPs=["10.0.0.0/8", "fd00::/64"]), Peer(pub=None, ip=None, port=None, allowedIPs=["10.1.0.7/16", "10.1.2.3/32"])])
+		self.assertEqual([table.lookup(a) for a in ("10.2.0.1", "10.1.5.5", "10.1.2.3", "11.0.0.1", "fd00::5", "fd01::5")], [0, 1, 1, None, 0, None])
+		packets = [packet("10.1.2.3"), packet("10.2.3.4"), packet("192.168.0.1"), packet("fd00::1"), b"\x45"]
+		self.assertEqual([table.route(p) for p in packets], [1, 0, None, 0, None])
+		self.assertEqual(list(table.routeMany(packets)), [1, 0, NO_PEER, 0, NO_PEER])
+		offsets = list(itertools.accumulate([len(p) for p in packets], initial=0))
+		self.assertEqual(list(table.routeMany(b"".join(packets), offsets)), [1, 0, NO_PEER, 0, NO_PEER])
+		self.assertTrue(table.allowsSource(packets[0], 0))
+		self.assertFalse(table.allowsSource(packets[0], 1))
+
+		table.insert("10.0.0.0/8", 1)  # moved
+		table.removePeer(0)
+		self.assertEqual([table.lookup(a) for a in ("10.2.0.1", "fd00::5")], [1, None])
+		self.assertEqual(len(table), 3)
+
+	def testOpenMany(self):
+		iface = KeyPair(sec=None, pub=None)
+		cfg = WGConfig(interface=Interface(iface.sec), peers=[Peer(pub=KeyPair(sec=None, pub=None).pub, ip=None, port=None) for i in range(16)])
+		opened = Tunnel.open_many(cfg, startIdx=10)
+		try:
+			self.assertEqual([t.idx for t in opened], list(range(10, 26)))
+			self.assertTrue(all(t.openTunnel is not None for t in opened))
+			self.assertIs(opened[0].b64c.sec, opened[1].b64c.sec)  # encoded once
+		finally:
+			opened.close()
+		self.assertTrue(all(t.openTunnel is None for t in opened))
+
+	def testOpenManyFromPeerTable(self):
+		from BoringTUN.config import PeerTable, PeerView
+
+		iface = KeyPair(sec=None, pub=None)
+		pubs = [KeyPair(sec=None, pub=None).pub for i in range(16)]
+		table = PeerTable()
+		for i, pub in enumerate(pubs):
+			table.append(pub, psk="psk" if i == 3 else None)
+		opened = Tunnel.open_many(WGConfig(interface=Interface(iface.sec), peers=table))
+		try:
+			self.assertTrue(all(isinstance(t.peer, PeerView) for t in opened))
+			self.assertEqual([t.b64c.pub for t in opened], [pub.base64().encode("ascii") for pub in pubs])
+			self.assertEqual([t.b64c.psk for t in opened], [b"psk" if i == 3 else None for i in range(16)])
+			self.assertTrue(all(t.openTunnel is not None for t in opened))
+		finally:
+			opened.close()
+
+	def testEndpointRouting(self):
+		import hashlib
+		from BoringTUN.endpoint import checkMac1, mac1Key, tunnelIndexOf
+
+		self.assertEqual(tunnelIndexOf(b"\x04\x00\x00\x00" + (0x123456 << 8 | 7).to_bytes(4, "little") + bytes(24)), 0x123456)
+		self.assertEqual(tunnelIndexOf(b"\x02\x00\x00\x00" + bytes(4) + (42 << 8).to_bytes(4, "little") + bytes(80)), 42)
+		self.assertIsNone(tunnelIndexOf(b"\x01" + bytes(147)))
+
+		key = mac1Key(bytes(32))
+		msg = b"\x01" + bytes(115)
+		msg += hashlib.blake2s(msg, digest_size=16, key=key).digest() + bytes(16)
+		self.assertTrue(checkMac1(msg, key))
+		self.assertFalse(checkMac1(msg, mac1Key(b"\x01" * 32)))
+
+	def testMessageHeaders(self):
+		from BoringTUN.messageHeaders import parseHeaders
+		from BoringTUN.udpBatch import DatagramBatch
+
+		msgs = [b"\x04\x00\x00\x00" + (0x123456 << 8 | 7).to_bytes(4, "little") + (5).to_bytes(8, "little") + bytes(32), b"\x02\x00\x00\x00" + bytes(4) + (42 << 8).to_bytes(4, "little") + bytes(80), b"\x01" + bytes(147), b"\x04" + bytes(20), b"\x09" + bytes(40), b""]
+		expected = ([4, 2, 1, 0, 0, 0], [0x123456 << 8 | 7, 42 << 8, 0, 0, 0, 0], [5, 0, 0, 0, 0, 0])
+
+		batch = DatagramBatch(len(msgs), 256)
+		for i, msg in enumerate(msgs):
+			batch.buffer[batch.offsets[i] : batch.offsets[i] + len(msg)] = msg
+			batch.sizes[i] = len(msg)
+		batch.count = len(msgs)
+		offsets = list(itertools.accumulate([len(m) for m in msgs], initial=0))
+		for name, args in (("strided", (batch.buffer, batch.usedOffsets, batch.usedSizes)), ("boundaries", (b"".join(msgs), offsets))):
+			with self.subTest(name):
+				headers = parseHeaders(*args, useNumpy=False)
+				self.assertEqual((list(headers.types), list(headers.receivers), list(headers.counters)), expected)
+				self.assertEqual(list(headers.sizes), [len(m) for m in msgs])
+				self.assertEqual(headers.positions(4), [0])
+
+	def testEndpointReload(self):
+		from ipaddress import ip_address
+		from BoringTUN.endpoint import WireGuardEndpoint
+
+		iface = Interface(KeyPair(sec=None, pub=None).sec)
+		pubs = [KeyPair(sec=None, pub=None).pub for i in range(5)]
+		cfg = WGConfig(iface, [Peer(pub=pub, ip=ip_address("127.0.0.1"), port=1000 + i) for i, pub in enumerate(pubs[:4])])
+		endpoint = WireGuardEndpoint.fromConfig(cfg)
+		try:
+			openTunnels = {idx: ep.openTunnel for idx, ep in endpoint.peers.items()}
+			newCfg = WGConfig(iface, [
+				Peer(pub=pubs[0], ip=ip_address("127.0.0.1"), port=1000),  # kept
+				Peer(pub=pubs[1], ip=ip_address("127.0.0.2"), port=2000),  # endpoint changed
+				Peer(pub=pubs[2], ip=ip_address("127.0.0.1"), port=1002, keepAliveTimeout=25),  # recreated
+				Peer(pub=pubs[4], ip=None, port=None),  # added
+			])
+			res = endpoint.reload(newCfg)
+			self.assertEqual((res.kept, res.updated, res.recreated, res.added, res.removed), ([0], [1], [2], [4], [3]))
+			self.assertIs(endpoint.peers[0].openTunnel, openTunnels[0])
+			self.assertIs(endpoint.peers[1].openTunnel, openTunnels[1])
+			self.assertIsNot(endpoint.peers[2].openTunnel, openTunnels[2])
+			self.assertIs(endpoint.peersByAddr[("127.0.0.2", 2000)], endpoint.peers[1])
+			self.assertNotIn(("127.0.0.1", 1001), endpoint.peersByAddr)
+			self.assertEqual(sorted(endpoint.peers), [0, 1, 2, 4])
+		finally:
+			endpoint.close()
+
+	def testEndpointUnknownPeer(self):
+		import asyncio
+		from BoringTUN.endpoint import UnknownPeerError, WireGuardEndpoint
+
+		class App(asyncio.DatagramProtocol):
+			def __init__(self):
+				self.errors = []
+
+			def error_received(self, exc):
+				self.errors.append(exc)
+
+		app = App()
+		endpoint = WireGuardEndpoint(Interface(KeyPair(sec=None, pub=None).sec), app)
+		try:
+			idx = endpoint.addPeer(Peer(pub=KeyPair(sec=None, pub=None).pub, ip=None, port=None)).idx
+			endpoint.removePeer(idx)
+			endpoint.sendto(pingPacket, idx)
+			self.assertEqual(len(app.errors), 1)
+			self.assertIsInstance(app.errors[0], UnknownPeerError)
+		finally:
+			endpoint.close()
+
+	def testEndpointBorrowedPacketsBatched(self):
+		import asyncio
+		from BoringTUN.asyncio import BoringTUNProtocol
+		from BoringTUN.bench import _EchoClientApp, ipv4Packet, tunnelsPair
+		from BoringTUN.endpoint import WireGuardEndpoint
+
+		class BorrowingEchoApp(asyncio.DatagramProtocol):
+			ACCEPTS_BORROWED_PACKETS = True
+
+			def __init__(self):
+				self.endpoint = None
+
+			def connection_made(self, transport):
+				self.endpoint = transport
+
+			def datagram_received(self, data, addr):
+				self.endpoint.sendto(data, addr)  # the packet is a view into a pooled buffer, reused right after the call
+
+		async def echo():
+			t1, t2 = tunnelsPair()
+			server = WireGuardEndpoint(t2.interface, BorrowingEchoApp(), batchedIO=True)
+			server.addPeer(t2.peer)
+			transport, _ = await server.listen(("127.0.0.1", 0))
+			t1.peer.ip = "127.0.0.1"
+			t1.peer.port = transport.get_extra_info("sockname")[1]
+			app = _EchoClientApp(ipv4Packet(100), 50, 8)
+			client, _ = await BoringTUNProtocol.createConnection(lambda: app, t1, batchedIO=True)
+			try:
+				await asyncio.wait_for(app.connected, 5)
+				app.send()
+				await asyncio.wait_for(app.done, 5)
+			finally:
+				client.transport.close()
+				server.close()
+			return app.received
+
+		self.assertEqual(asyncio.run(echo()), 50)
+
+	def testProtocolFlowControl(self):
+		import asyncio
+		from BoringTUN.asyncio import BoringTUNProtocol
+
+		class FakeOpenTunnel:
+			def wrap(self, data):
+				return Action(Opcode.WRITE_TO_NETWORK, bytes(data))
+
+		class FakeTransport:
+			def __init__(self):
+				self.sent = []
+
+			def sendto(self, data, addr=None):
+				self.sent.append(data)
+
+			def get_write_buffer_size(self):
+				return 0
+
+		class App(asyncio.Protocol):
+			def __init__(self):
+				self.events = []
+				self.received = []
+
+			def pause_writing(self):
+				self.events.append("pause")
+
+			def resume_writing(self):
+				self.events.append("resume")
+
+			def datagram_received(self, data, addr):
+				self.received.append(data)
+
+		async def run():
+			app = App()
+			proto = BoringTUNProtocol(None, app)
+			proto.openTunnel = FakeOpenTunnel()
+			proto.transport = transport = FakeTransport()
+			proto.set_write_buffer_limits(high=1000, low=200)
+			proto.startEventProcessor()
+			try:
+				proto.pause_writing()  # the UDP transport is full
+				packet = bytes(100)
+				for i in range(10):
+					proto.write(packet)
+				self.assertEqual(app.events, [])
+				proto.write(packet)
+				self.assertEqual(app.events, ["pause"])
+				self.assertEqual(proto.get_write_buffer_size(), 1100)
+
+				proto.dispatch(Action(Opcode.WRITE_TO_TUNNEL_IPV4, pingPacket))
+				self.assertEqual(app.received, [pingPacket])  # the decrypted packets are not held back
+
+				while not proto.droppedPackets:
+					proto.write(packet)
+				self.assertEqual(proto.get_write_buffer_size(), 8 * 1000)  # the hard limit
+				self.assertEqual(transport.sent, [])
+
+				proto.resume_writing()
+				for i in range(10):
+					await asyncio.sleep(0)
+				self.assertEqual(app.events, ["pause", "resume"])
+				self.assertEqual(len(transport.sent), 80)
+				self.assertEqual(proto.get_write_buffer_size(), 0)
+			finally:
+				proto.stopEventProcessor()
+
+		asyncio.run(run())
+
+	def testProtocolDispatchErrors(self):
+		import asyncio
+		import contextlib
+		import io
+		from BoringTUN.asyncio import BoringTUNProtocol
+
+		class FaultyApp(asyncio.DatagramProtocol):
+			def __init__(self):
+				self.received = []
+
+			def datagram_received(self, data, addr):
+				if data == b"bad":
+					raise ValueError(data)
+				self.received.append(data)
+
+		async def run():
+			app = FaultyApp()
+			proto = BoringTUNProtocol(None, app)
+			log = io.StringIO()
+			with contextlib.redirect_stdout(log):
+				# queued, since the event processor is not started yet
+				for data in (b"bad", b"good"):
+					proto.dispatch(Action(Opcode.WRITE_TO_TUNNEL_IPV4, data))
+				proto.startEventProcessor()
+				await asyncio.sleep(0.01)
+				self.assertEqual(app.received, [b"good"])
+
+				# handled right away
+				for data in (b"bad", b"good"):
+					proto.dispatch(Action(Opcode.WRITE_TO_TUNNEL_IPV4, data))
+				self.assertEqual(app.received, [b"good"] * 2)
+				self.assertFalse(proto._eventProcessorTask.done())
+				proto.stopEventProcessor()
+			self.assertEqual(log.getvalue().count("ValueError: b'bad'"), 2)
+
+		asyncio.run(run())
+
+	def testHandshakeScheduler(self):
+		import asyncio
+		from BoringTUN.handshakeScheduler import HandshakeScheduler
+
+		now = [0.0]
+		processed = []
+		initiation = b"\x01" + bytes(147)
+		cookied = initiation[:-16] + b"\x01" * 16
+
+		async def run():
+			s = HandshakeScheduler(handshakesPerSecond=2, perSourceRate=1, perSourceBurst=2, queueLimit=3, jitter=0, clock=lambda: now[0])
+			for i in range(4):
+				s.submitIncoming(initiation, ("a" + str(i), 0), processed.append)
+			self.assertEqual(len(processed), 2)  # the burst of the global budget
+			self.assertEqual(s.pending(), {"cookied": 0, "forced": 0, "fresh": 2})
+			self.assertTrue(s.submitIncoming(cookied, ("b", 0), processed.append))
+			self.assertTrue(s.submitIncoming(cookied, ("b", 0), processed.append))  # replaces a fresh one in the full queue
+			self.assertFalse(s.submitIncoming(cookied, ("b", 0), processed.append))  # over the budget of the source
+			self.assertFalse(s.submitIncoming(initiation, ("c", 0), processed.append))  # the queue is full
+			self.assertEqual(s.dropped, 3)
+
+			now[0] = 1.0
+			s.drain()
+			self.assertEqual(processed[2:], [cookied, cookied])
+			now[0] = 2.0
+			s.drain()
+			self.assertEqual(processed[4:], [initiation])
+			self.assertEqual(len(s), 0)
+
+			now[0] = 10.0
+			self.assertEqual([s.submitIncoming(initiation, ("d", 1000 + i), processed.append) for i in range(3)], [True, True, False])  # the ports share the bucket of the host
+			self.assertEqual(s.dropped, 4)
+
+		asyncio.run(run())
+
+	def testTunDevice(self):
+		import asyncio
+		import socket
+		from BoringTUN.tunDevice import TunDevice
+
+		# a datagram socket pair preserves the boundaries of the packets, like a TUN fd
+		dev, kernel = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+		packets = [bytes([i]) * (i + 20) for i in range(5)]
+
+		class FakeTransport(asyncio.DatagramTransport):
+			def __init__(self):
+				super().__init__()
+				self.sent = []
+
+			def sendto(self, data, addr=None):
+				self.sent.append((bytes(data), addr))
+
+		async def run():
+			t = FakeTransport()
+			tun = TunDevice(dev.fileno(), route=lambda p: None if p[0] == 4 else p[0] % 2, batchSize=3, ownsFd=False)
+			tun.connection_made(t)
+			for p in packets:
+				kernel.send(p)
+			self.assertEqual(tun.readBatch(), 3)
+			self.assertEqual(tun.readBatch(), 2)
+			self.assertEqual(tun.readBatch(), 0)
+			self.assertEqual(t.sent, [(p, p[0] % 2) for p in packets[:4]])
+			self.assertEqual(tun.dropped, 1)
+
+			tun.datagram_received(memoryview(b"decrypted"), 0)
+			self.assertEqual(kernel.recv(100), b"decrypted")
+			tun.close()
+
+		try:
+			asyncio.run(run())
+		finally:
+			dev.close()
+			kernel.close()
+
+	def testTunnelStream(self):
+		import asyncio
+		from BoringTUN.tunnelStream import FRAME_HEADER, StreamGapError, TunnelStream
+
+		class FakeTunnel:
+			def __init__(self):
+				self.batches = []
+				self.peer = None
+
+			def write_many(self, frames, offsets):
+				frames = [bytes(frames[offsets[i] : offsets[i + 1]]) for i in range(len(offsets) - 1)]
+				self.batches.append(frames)
+				for frame in frames:
+					self.peer.datagram_received(frame, None)
+
+			def get_write_buffer_size(self):
+				return 0
+
+		async def run():
+			loop = asyncio.get_running_loop()
+			reader = asyncio.StreamReader(loop=loop)
+			rx = TunnelStream(asyncio.StreamReaderProtocol(reader, loop=loop))
+			tx = TunnelStream(asyncio.Protocol(), mtu=FRAME_HEADER.size + 100)
+			tunnel = FakeTunnel()
+			tunnel.peer = rx
+			tx.write(b"early")  # before the handshake
+			tx.connection_made(tunnel)
+			rx.connection_made(FakeTunnel())
+			self.assertEqual(await reader.readexactly(5), b"early")
+
+			for i in range(10):
+				tx.write(bytes([i]) * 15)
+			self.assertEqual([len(frames) for frames in tunnel.batches], [1, 1])  # only the full segment is sent
+			await asyncio.sleep(0.01)  # the flush
+			self.assertEqual([len(frame) - FRAME_HEADER.size for frame in tunnel.batches[-1]], [50])
+
+			tx.writelines([b"a" * 150, b"b" * 70])
+			self.assertEqual([len(frame) - FRAME_HEADER.size for frame in tunnel.batches[-1]], [100, 100, 20])
+			self.assertEqual(await reader.readexactly(370), b"".join(bytes([i]) * 15 for i in range(10)) + b"a" * 150 + b"b" * 70)
+
+			tx.write_eof()
+			self.assertEqual(await reader.read(), b"")
+
+			reader = asyncio.StreamReader(loop=loop)
+			rx = TunnelStream(asyncio.StreamReaderProtocol(reader, loop=loop))
+			rx.connection_made(FakeTunnel())
+			rx.datagram_received(tunnel.batches[0][0], None)
+			rx.datagram_received(tunnel.batches[2][0], None)
+			with self.assertRaises(StreamGapError):
+				await reader.read()
+
+		asyncio.run(run())
+
+	def testTimerWheel(self):
+		import asyncio
+		from BoringTUN.timerWheel import TimerWheel
+
+		released = []
+
+		class PooledAction(Action):
+			__slots__ = ()
+
+			def release(self):
+				released.append(self.opcode)
+
+		class FakeTunnel:
+			def __init__(self, opcode):
+				self.ticks = 0
+				self.opcode = opcode
+
+			def tick(self):
+				self.ticks += 1
+				return PooledAction(self.opcode, b"keepalive")
+
+		async def run():
+			wheel = TimerWheel(resolution=0.01, maxIdleInterval=0.08, slotsCount=16)
+			idle, busy, removed = FakeTunnel(Opcode.WIREGUARD_DONE), FakeTunnel(Opcode.WRITE_TO_NETWORK), FakeTunnel(Opcode.WIREGUARD_DONE)
+			sent = []
+			wheel.register(idle, sent.append)
+			wheel.register(busy, sent.append)
+			removedEntry = wheel.register(removed, sent.append)
+			wheel.start()
+			await asyncio.sleep(0.015)
+			wheel.unregister(removedEntry)
+			await asyncio.sleep(0.5)
+			wheel.stop()
+			return idle.ticks, busy.ticks, removed.ticks, len(sent), len(wheel)
+
+		idleTicks, busyTicks, removedTicks, sentCount, registered = asyncio.run(run())
+		self.assertGreater(busyTicks, 3 * idleTicks)
+		self.assertGreater(idleTicks, 3)
+		self.assertLessEqual(removedTicks, 2)
+		self.assertEqual(sentCount, busyTicks)
+		self.assertEqual(registered, 2)
+		self.assertEqual(released, [Opcode.WIREGUARD_DONE] * (idleTicks + removedTicks))  # the sent ones are released by the sink
+
+	def testOffloaderOrdering(self):
+		import threading
+		from concurrent.futures import ThreadPoolExecutor
+		from BoringTUN.offload import TunnelOffloader
+
+		class FakeTunnel:
+			def __init__(self):
+				self.inFlight = 0
+				self.overlapped = False
+
+			def wrap_many(self, packets):
+				self.inFlight += 1
+				self.overlapped |= self.inFlight > 1
+				threading.Event().wait(0.001)
+				self.inFlight -= 1
+				return list(packets)
+
+		got = []
+		closed = threading.Event()
+		t = FakeTunnel()
+		with ThreadPoolExecutor(4) as executor:
+			o = TunnelOffloader(t, lambda datagrams, unwrapped, wrapped: got.extend(wrapped), executor)
+			for i in range(200):
+				o.wrap(bytes([i]))
+			o.close(closed.set)
+			o.wrap(b"late")
+			self.assertTrue(closed.wait(5))
+
+		self.assertEqual(got, [bytes([i]) for i in range(len(got))])
+		self.assertFalse(t.overlapped)
+
+	def testMetrics(self):
+		from BoringTUN.metrics import MetricsRegistry
+		from BoringTUN.Tunnel import OpenTunnel
+
+		registry = MetricsRegistry()
+		p1 = KeyPair(sec=None, pub=None)
+		p2 = KeyPair(sec=None, pub=None)
+		with Tunnel(Interface(p1.sec), Peer(pub=p2.pub, ip=None, port=None)) as t:
+			self.assertIs(type(t), OpenTunnel)
+			m = registry.enable(t, "t1")
+			self.assertIsNot(type(t), OpenTunnel)
+			t.force_handshake()
+			t.wrap_many([pingPacket] * 3)
+			m.countResult(Opcode.WIREGUARD_ERROR, 9)
+
+			s = registry.snapshot()["t1"]
+			self.assertEqual(s["latencies"]["force_handshake"]["count"], 1)
+			self.assertEqual(s["batchSizes"]["wrap_many"]["count"], 1)
+			self.assertEqual(s["errors"], {"InvalidAeadTag": 1})
+			self.assertIn('boringtun_errors_total{tunnel="t1",error="InvalidAeadTag"} 1', registry.toPrometheus())
+
+			registry.disable(t)
+			self.assertIs(type(t), OpenTunnel)
+			self.assertEqual(registry.snapshot(), {})
+
+	def testCaptureReplay(self):
+		import tempfile
+		from BoringTUN.bench import closeTunnels, connectedTunnels
+		from BoringTUN.capture import CaptureReader, CaptureWriter, RecordKind, replay, startCapture, stopCapture
+		from BoringTUN.Tunnel import OpenTunnel
+
+		with tempfile.TemporaryDirectory() as d:
+			path = Path(d) / "t.btcap"
+			t1, ot1, t2, ot2 = connectedTunnels()
+			try:
+				with CaptureWriter(path) as w:
+					startCapture(ot1, w, stream=7)
+					for i in range(5):
+						ot2.unwrap(ot1.wrap(pingPacket).buf)
+					ot1.unwrap(ot2.wrap(pingPacket).buf)
+					stopCapture(ot1)
+					self.assertIs(type(ot1), OpenTunnel)
+					ot1.wrap(pingPacket)  # not captured
+			finally:
+				closeTunnels(t1, t2)
+
+			with CaptureReader(path) as r:
+				records = [(rec.kind, rec.stream, bytes(rec.payload)) for rec in r]
+				self.assertEqual([k for k, s, p in records], [RecordKind.PLAINTEXT_OUT, RecordKind.CIPHERTEXT_OUT] * 5 + [RecordKind.CIPHERTEXT_IN, RecordKind.PLAINTEXT_IN])
+				self.assertEqual({s for k, s, p in records}, {7})
+				self.assertEqual(records[0][2], pingPacket)
+
+				res = replay(r)
+				self.assertEqual((res["packets"], res["streams"], res["errors"], res["bytes"]), (6, 1, 0, 6 * len(pingPacket)))
+				self.assertLessEqual(res["latencyNs"]["p50"], res["latencyNs"]["max"])
+
+	def testShmRing(self):
+		import multiprocessing
+		from BoringTUN.sharding import ShmRing
+
+		for lock in (None, multiprocessing.Lock()):
+			with self.subTest(locked=lock is not None):
+				r = ShmRing(capacity=256, lock=lock)
+				try:
+					pushed, got = [], []
+					for i in range(200):
+						p = bytes([i]) * (i % 50)
+						while not r.push(i, p):
+							tag, payload = r.peek()
+							got.append((tag, bytes(payload)))
+							del payload
+							r.pop()
+						pushed.append((i, p))
+					while len(r):
+						tag, payload = r.peek()
+						got.append((tag, bytes(payload)))
+						del payload
+						r.pop()
+					self.assertEqual(got, pushed)
+					self.assertIsNone(r.peek())
+					self.assertTrue(r.push(0, bytes(r.maxPayloadSize)))
+					with self.assertRaises(ValueError):
+						r.push(0, bytes(r.maxPayloadSize + 1))
+				finally:
+					r.close()
+
+	def testShardedEngine(self):
+		import threading
+		import time
+		from BoringTUN.bench import closeTunnels, tunnelsPair
+		from BoringTUN.sharding import ShardedEngine
+		from BoringTUN.Tunnel import Opcode, Tunnel
+
+		results, statuses = [], {}
+		engine = ShardedEngine(1, lambda idx, opcode, payload: results.append((idx, opcode, bytes(payload))), ringSize=1 << 18, onUnwrapped=lambda idx, seq, authentic: statuses.__setitem__(seq, authentic))
+
+		def roundTrip(datagram, seq):
+			results.clear()
+			self.assertTrue(engine.unwrap(1, datagram, seq))
+			engine.flush()
+			deadline = time.monotonic() + 10
+			while seq not in statuses and time.monotonic() < deadline:
+				engine.poll()
+				time.sleep(0.001)
+			engine.poll()
+			return statuses.pop(seq), results[:]
+
+		t1, t2 = tunnelsPair()
+		try:
+			garbage = bytes([4]) + bytes(31)
+			self.assertFalse(roundTrip(garbage, 0)[0])  # the tunnel is missing, that also waits for the worker to start
+
+			# nobody drains the results, so the worker blocks on the full responses ring and the requests ring gets full too
+			for i in range(40000):
+				engine.unwrap(1, garbage, i)
+				if i % 64 == 0:
+					engine.flush()
+			self.assertGreater(engine.droppedRequests, 0)
+
+			adder = threading.Thread(target=engine.addTunnel, args=(Tunnel(t2.interface, t2.peer, idx=1),))
+			adder.start()
+			adder.join(20)
+			self.assertFalse(adder.is_alive())
+			engine.poll()
+			statuses.clear()
+
+			ot1 = t1.__enter__()
+			authentic, res = roundTrip(ot1.force_handshake().buf, 1)
+			self.assertTrue(authentic)
+			self.assertEqual([(idx, opcode) for idx, opcode, payload in res], [(1, Opcode.WRITE_TO_NETWORK)])
+			keepAlive = ot1.unwrap(res[0][2])
+			if keepAlive.opcode == Opcode.WRITE_TO_NETWORK:
+				roundTrip(keepAlive.buf, 2)
+
+			authentic, res = roundTrip(ot1.wrap(pingPacket).buf, 3)
+			self.assertTrue(authentic)
+			self.assertEqual(res, [(1, Opcode.WRITE_TO_TUNNEL_IPV4, pingPacket)])
+		finally:
+			engine.close()
+			closeTunnels(t1)
+
+	def testBatchedUDPLoopback(self):
+		import asyncio
+		from BoringTUN.udpBatch import IS_MMSG_AVAILABLE, createBatchedDatagramEndpoint
+
+		class Receiver(asyncio.DatagramProtocol):
+			def __init__(self):
+				self.batches = []
+				self.transport = None
+
+			def connection_made(self, transport):
+				self.transport = transport
+
+			def datagrams_received(self, batch):
+				self.batches.append([(bytes(d), batch.address(i)) for i, d in enumerate(batch)])
+
+		async def loopback(useMMsg):
+			rxTransport, rx = await createBatchedDatagramEndpoint(Receiver, local_addr=("127.0.0.1", 0), batchSize=8, useMMsg=useMMsg)
+			self.assertIs(rx.transport, rxTransport)
+			txTransport, tx = await createBatchedDatagramEndpoint(asyncio.DatagramProtocol, remote_addr=rxTransport.get_extra_info("sockname"), useMMsg=useMMsg)
+			for i in range(20):
+				txTransport.sendto(pingPacket[:i + 1])
+			await asyncio.sleep(0.1)
+			txTransport.close()
+			rxTransport.close()
+			return rx.batches, txTransport.get_extra_info("sockname")
+
+		for useMMsg in {False, IS_MMSG_AVAILABLE}:
+			with self.subTest(useMMsg=useMMsg):
+				batches, txAddr = asyncio.run(loopback(useMMsg))
+				self.assertEqual([d for b in batches for d, addr in b], [pingPacket[:i + 1] for i in range(20)])
+				self.assertEqual(batches[0][0][1], txAddr)
+				self.assertLessEqual(max(len(b) for b in batches), 8)
+
+
+	def testBatchedUDPSendErrors(self):
+		import asyncio
+		from BoringTUN.udpBatch import IS_MMSG_AVAILABLE, createBatchedDatagramEndpoint
+
+		class Receiver(asyncio.DatagramProtocol):
+			def __init__(self):
+				self.datagrams = []
+				self.errors = []
+
+			def datagram_received(self, data, addr):
+				self.datagrams.append(data)
+
+			def error_received(self, exc):
+				self.errors.append(exc)
+
+		async def sendWithBadOne(useMMsg):
+			rxTransport, rx = await createBatchedDatagramEndpoint(Receiver, local_addr=("127.0.0.1", 0), useMMsg=useMMsg)
+			txTransport, tx = await createBatchedDatagramEndpoint(Receiver, local_addr=("127.0.0.1", 0), useMMsg=useMMsg)
+			rxAddr = rxTransport.get_extra_info("sockname")
+			for i in range(6):
+				txTransport.sendto(pingPacket[:i + 1], rxAddr if i != 2 else ("127.0.0.1", 0x10000))
+			await asyncio.sleep(0.1)
+			txTransport.close()
+			rxTransport.close()
+			return rx.datagrams, tx.errors, len(txTransport.sender), txTransport.get_write_buffer_size()
+
+		for useMMsg in {False, IS_MMSG_AVAILABLE}:
+			with self.subTest(useMMsg=useMMsg):
+				datagrams, errors, queued, queuedBytes = asyncio.run(sendWithBadOne(useMMsg))
+				self.assertEqual(datagrams, [pingPacket[:i + 1] for i in range(6) if i != 2])
+				self.assertEqual(len(errors), 1)
+				self.assertEqual((queued, queuedBytes), (0, 0))
 
 if __name__ == "__main__":
 	unittest.main()